@@ -2,23 +2,181 @@
 This is a basic flask app that allows for simple one time 
 registering & password changes.
 """
-import re
+import hmac
+import json
 import os
+import threading
+import time
 
-from flask import Flask, request, render_template
+from flask import (Flask, request, render_template, g, Response, abort,
+                   jsonify)
+from markupsafe import Markup
 
 from electobot.database import (event_from_token, create_voter,
-                                voter_from_token, poll_from_id,
-                                has_voter_voted, cast_vote, get_session)
-from electobot.main import (event_register_url, voting_url, poll_list,
-                            poll_options, parse_vote_form, poll_url)
+                                has_voter_voted, cast_vote, cast_votes,
+                                create_default_session, enqueue_message,
+                                voter_context_from_token, voted_poll_ids,
+                                open_polls_from_event, options_from_poll,
+                                poll_version, poll_from_id, VoterContext)
+from electobot.main import (event_register_url, voting_url,
+                            poll_options, parse_vote_form, poll_url,
+                            voter_poll, parse_vote_json, ballot_url,
+                            proxy_message, vote_count_message,
+                            parse_ballots_json)
 from electobot.exceptions import (VoteExceptionTooFew, VoteExceptionTooMany,
                          VoteExceptionWrongId, VoteExceptionNegative,
                          VoteExceptionWrongTime, VoteExceptionWrongEvent,
-                         VoteExceptionAlreadyVoted, DBExceptionEmailAlreadyUsed)
-from electobot.send_email import send_message
+                         VoteExceptionAlreadyVoted, DBExceptionEmailAlreadyUsed,
+                         VoteExceptionInvalidBallot)
+from electobot.mail_worker import MailWorker
+from electobot.scheduler import PollScheduler
+from electobot.live import watch_poll, stop_watching, poll_changed
+from electobot.admission import admission_from_env, BUSY_RETRY_AFTER
+from electobot.cache import LRUCache
+from electobot.email_pattern import email_allowed
+from electobot.metrics import (REGISTRY, REQUEST_DURATION, REQUEST_DB_DURATION,
+                               REGISTRATIONS, VOTES_CAST, BALLOTS_REJECTED,
+                               REQUESTS_SHED)
+from electobot.profiling import (PROFILE, start_tracking, stop_tracking,
+                                 start_profile, finish_profile)
 
 app = Flask(__name__)
+# 'thread' sends queued mail from a thread in this process, 'off' leaves it to
+# a separate `electobot-cli.py mail_worker` process.
+app.config.setdefault('MAIL_WORKER',
+                      os.environ.get('ELECTOBOT_MAIL_WORKER', 'thread'))
+
+# 'thread' opens and closes scheduled polls from a thread in this process, 'off'
+# leaves it to a separate `electobot-cli.py scheduler` process.
+app.config.setdefault('SCHEDULER',
+                      os.environ.get('ELECTOBOT_SCHEDULER', 'thread'))
+
+# Shared secret for the organizer pages under /admin. Unset disables them.
+app.config.setdefault('ADMIN_TOKEN', os.environ.get('ELECTOBOT_ADMIN_TOKEN'))
+# Seconds between checks for new votes on a live tally
+app.config.setdefault('LIVE_TALLY_INTERVAL',
+                      float(os.environ.get('ELECTOBOT_LIVE_TALLY_INTERVAL', 1)))
+app.config.setdefault('LIVE_TALLY_KEEPALIVE', 15.0)
+# Streams end after this many seconds, and the page opens a new one. Each open
+# stream takes a worker thread, so there are at most LIVE_TALLY_MAX_STREAMS.
+app.config.setdefault('LIVE_TALLY_MAX_STREAM_SECONDS', 600.0)
+app.config.setdefault('LIVE_TALLY_MAX_STREAMS',
+                      int(os.environ.get('ELECTOBOT_LIVE_TALLY_MAX_STREAMS', 8)))
+# Reuse the rendered poll and option lists until the polls of an event change
+app.config.setdefault('RENDER_CACHE', True)
+# Route group -> `Admission`. Requests over the limits wait up to MAX_WAIT
+# seconds and then get a 503 with Retry-After.
+app.config.setdefault('ADMISSION', {
+    'register': admission_from_env('register', concurrency=8, rate=50,
+                                   burst=100),
+    'vote': admission_from_env('vote', concurrency=16, rate=200, burst=400),
+})
+ADMISSION_ROUTES = {
+    '/register': 'register',
+    '/vote': 'vote',
+    '/api/v1/voter': 'vote',
+    '/api/v1/polls': 'vote',
+    '/api/v1/polls/<int:poll_id>/ballot': 'vote',
+    '/ballot': 'vote',
+    '/api/v1/ballots': 'vote',
+}
+
+_mail_worker = None
+_mail_worker_lock = threading.Lock()
+
+def notify_mail_worker():
+    """Wakes the in-process mail worker, starting it on first use."""
+    global _mail_worker
+    if app.config['MAIL_WORKER'] != 'thread':
+        return
+    if _mail_worker is None:
+        with _mail_worker_lock:
+            if _mail_worker is None:
+                _mail_worker = MailWorker()
+                _mail_worker.start()
+    _mail_worker.notify()
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def polls_changed(changes):
+    for poll_id, _ in changes:
+        poll_changed(poll_id)
+
+@app.before_request
+def start_scheduler():
+    """Starts the in-process poll scheduler with the first request."""
+    global _scheduler
+    if app.config['SCHEDULER'] != 'thread' or _scheduler is not None:
+        return
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PollScheduler(on_change=polls_changed)
+            _scheduler.start()
+
+def db_session():
+    """Returns the session of the current request, opening it on first use."""
+    if 'db_session' not in g:
+        g.db_session = create_default_session()
+    return g.db_session
+
+@app.teardown_appcontext
+def close_db_session(exception):
+    session = g.pop('db_session', None)
+    if session is not None:
+        session.close()
+
+@app.before_request
+def start_request_timer():
+    g.profiler = start_profile()
+    g.query_stats = start_tracking(fingerprints=PROFILE)
+    g.request_start_time = time.perf_counter()
+
+@app.before_request
+def admit_request():
+    rule = request.url_rule.rule if request.url_rule else None
+    admission = app.config['ADMISSION'].get(ADMISSION_ROUTES.get(rule))
+    if admission is None:
+        return None
+    retry_after = admission.enter(write=request.method == 'POST')
+    if retry_after is None:
+        g.admission = admission
+        return None
+    REQUESTS_SHED.inc(route=rule)
+    if rule.startswith('/api/'):
+        response = api_error(503, 'busy', "Too many requests, retry in {} "
+                             "seconds.".format(retry_after))
+    else:
+        response = Response(render_template(
+            'blank.html', message="Very busy right now! Please try again in "
+            "{} seconds.".format(retry_after)), status=503)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start_time' in g:
+        elapsed = time.perf_counter() - g.request_start_time
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_DURATION.observe(elapsed, route=route, method=request.method,
+                                 status=response.status_code)
+        REQUEST_DB_DURATION.observe(g.query_stats.time, route=route)
+        finish_profile(g.profiler, '{} {}'.format(request.method, route),
+                       elapsed, g.query_stats)
+    return response
+
+@app.teardown_request
+def stop_request_tracking(exception):
+    admission = g.pop('admission', None)
+    if admission is not None:
+        admission.leave()
+    # Also runs when the request raised and after_request was skipped
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+    query_stats = g.pop('query_stats', None)
+    if query_stats is not None:
+        stop_tracking(query_stats)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -28,7 +186,8 @@ def register():
     if not token:
         return render_template('register.html',
                               errors=["Please provide an event token in the URL"])
-    event = event_from_token(token)
+    session = db_session()
+    event = event_from_token(token, session=session)
     if not event:
         return render_template('register.html',
                               errors=["Unfortunately token {} does not refer to an event.".format(
@@ -39,93 +198,385 @@ def register():
                               event_name=event.name)
     elif request.method == 'POST':
         email = request.form.get('email')
-        match = re.search(event.email_pattern, email)
-        if not match:
+        if not email_allowed(event, email):
+            REGISTRATIONS.inc(result='not_permitted')
             return render_template('register.html',
                               errors=['Email address not permitted.'], 
                               event_token=event.token,
                               event_name=event.name)
-        session = get_session()
         try:
             voter = create_voter(event.event_id, email, session=session)
         except DBExceptionEmailAlreadyUsed:
+            REGISTRATIONS.inc(result='already_registered')
             return render_template('register.html',
                               warnings=['Email already used. Check your email. If you did not get an email, contact the host of the vote.'], 
                               event_token=event.token,
                               event_name=event.name)
+        REGISTRATIONS.inc(result='created')
         url = voting_url(voter, session=session)
-        send_message(email, "{} voting link".format(event.name),
-                     "The URL to vote is: {}".format(url))
+        enqueue_message(email, "{} voting link".format(event.name),
+                        "The URL to vote is: {}".format(url), session=session)
+        notify_mail_worker()
         return render_template('blank.html', message="Voting email sent! Check your {} mail.".format(email))
 
+# Per-voter values are rendered as these markers, which escaped text can't
+# contain, and filled in after the fragment is taken from the cache
+VOTER_TOKEN_SLOT = Markup('<voter-token/>')
+VOTE_COUNT_SLOT = Markup('<vote-count/>')
+
+# (kind, id) -> (poll version, rendered fragment)
+_fragments = LRUCache(maxsize=1024)
+
+def cached_fragment(key, event_id: int, render, session):
+    """Returns a fragment of a page that is the same for every voter of an
+    event, rendering it again only after the poll version of the event
+    changed.
+    """
+    if not app.config['RENDER_CACHE']:
+        return render()
+    version = poll_version(event_id, session=session)
+    entry = _fragments.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    fragment = render()
+    _fragments.set(key, (version, fragment))
+    return fragment
+
+def render_poll_list(voter: VoterContext, session) -> Markup:
+    """Renders the links to the open polls of the voter's event."""
+    def with_slot(url):
+        # Markup.join escapes the URL, but not the slot
+        return VOTER_TOKEN_SLOT.join(url.split(VOTER_TOKEN_SLOT))
+
+    def render():
+        polls = open_polls_from_event(voter.event_id, session=session)
+        return Markup(render_template('_poll_list.html', polls=[
+            {'href': with_slot(poll_url(VOTER_TOKEN_SLOT, poll.poll_id)),
+             'name': poll.name}
+            for poll in polls
+        ], ballot_href=with_slot(ballot_url(VOTER_TOKEN_SLOT))).strip())
+    fragment = cached_fragment(('polls', voter.event_id), voter.event_id,
+                               render, session)
+    return fragment.replace(VOTER_TOKEN_SLOT, voter.token)
+
+def render_option_list(voter: VoterContext, poll, session) -> Markup:
+    """Renders the inputs for the options of a poll."""
+    def render():
+        return Markup(render_template(
+            '_vote_options.html', vote_count=VOTE_COUNT_SLOT,
+            tally_method=poll.tally_method,
+            option_list=options_from_poll(poll, session=session)).strip())
+    fragment = cached_fragment(('options', poll.poll_id), poll.event_id,
+                               render, session)
+    return fragment.replace(VOTE_COUNT_SLOT, str(voter.vote_weight))
+
+# Exception -> message for the voting pages
+VOTE_ERRORS = {
+    VoteExceptionTooFew: "Not all possible votes assigned. Try again.",
+    VoteExceptionTooMany: "Too many votes assigned. Try again.",
+    VoteExceptionWrongId: "Wrong id. Try again.",
+    VoteExceptionWrongTime: "Wrong time to vote. The vote may be closed already, or has not started yet.",
+    VoteExceptionWrongEvent: "Wrong event.",
+    VoteExceptionNegative: "Can't cast negative votes. Try again.",
+    VoteExceptionInvalidBallot: "Invalid ballot. Number your choices 1, 2, 3 and so on, without gaps or repeats. Try again.",
+}
+
 @app.route('/vote', methods=['GET', 'POST'])
 def vote():
     token = request.args.get('token')
     if not token:
         return render_template('available_votes.html',
                               errors=["Invalid token. Please use the link from your email."])
-    voter = voter_from_token(token)
+    session = db_session()
+    voter = voter_context_from_token(token, session=session)
     if not voter:
         return render_template('available_votes.html',
                               errors=["Invalid token. Please use the link from your email."])
-    polls = poll_list(token)
+    polls = render_poll_list(voter, session)
     if request.method == 'GET':
         poll_id = request.args.get('poll_id')
         if not poll_id: # Send a list of possible polls
-            return render_template('available_votes.html', list=polls)
+            return render_template('available_votes.html', poll_list_html=polls)
         else: # Otherwise send the list of options
-            poll = poll_from_id(poll_id)
+            poll = voter_poll(voter, poll_id, session=session)
             if poll is None or poll.event_id != voter.event_id:
-                return render_template('available_votes.html', list=polls,
+                return render_template('available_votes.html', poll_list_html=polls,
                                       errors=["No poll with such id: {}.".format(poll_id)])
-            if has_voter_voted(voter, poll):
-                return render_template('available_votes.html', list=polls,
+            if has_voter_voted(voter, poll, session=session):
+                return render_template('available_votes.html', poll_list_html=polls,
                                       warnings=["You already voted for this poll."])
-            proxy_message, vote_count, option_list = poll_options(voter, poll)
+            proxy_message, vote_count, _ = poll_options(voter, poll,
+                                                        session=session)
             return render_template('vote_options.html',
                                   voter_token=token, poll_id=poll_id,
                                   proxy_message=proxy_message,
-                                  option_list=option_list, vote_count=vote_count)
+                                  option_list_html=render_option_list(
+                                      voter, poll, session),
+                                  vote_count=vote_count,
+                                  tally_method=poll.tally_method,
+                                  seats=poll.seats)
     elif request.method == 'POST':
         poll_id = request.args.get('poll_id')
         if not poll_id:
-            return render_template('available_votes.html', list=polls,
+            return render_template('available_votes.html', poll_list_html=polls,
                                   errors=["Broken request. No poll id. {}".format(poll_id)])
-        poll = poll_from_id(poll_id)
+        poll = voter_poll(voter, poll_id, session=session)
         if poll is None or poll.event_id != voter.event_id:
-            return render_template('available_votes.html', list=polls,
+            return render_template('available_votes.html', poll_list_html=polls,
                                   errors=["No poll with such id: {}.".format(poll_id)])
         try:
             vote_dict = parse_vote_form(request.form)
         except ValueError:
-            return render_template('available_votes.html', list=polls,
+            return render_template('available_votes.html', poll_list_html=polls,
                                   errors=["Broken request. Try again."])
         try:
-            cast_vote(voter, vote_dict)
-        except VoteExceptionTooFew:
-            return render_template('available_votes.html', list=polls,
-                                  errors=["Not all possible votes assigned. Try again."])
-        except VoteExceptionTooMany:
-            return render_template('available_votes.html', list=polls,
-                                  errors=["Too many votes assigned. Try again."])
-        except VoteExceptionWrongId:
-            return render_template('available_votes.html', list=polls,
-                                  errors=["Wrong id. Try again."])
-        except VoteExceptionWrongTime:
-            return render_template('available_votes.html', list=polls,
-                                  errors=["Wrong time to vote. The vote may be closed already, or has not started yet."])
-        except VoteExceptionWrongEvent:
-            return render_template('available_votes.html', list=polls,
-                                  errors=["Wrong event."])
-        except VoteExceptionNegative:
-            return render_template('available_votes.html', list=polls,
-                                  errors=["Can't cast negative votes. Try again."])
+            with BALLOTS_REJECTED.count_exceptions('reason'):
+                cast_vote(voter, vote_dict, poll_id=poll.poll_id,
+                          session=session)
         except VoteExceptionAlreadyVoted:
-            return render_template('available_votes.html', list=polls,
+            return render_template('available_votes.html', poll_list_html=polls,
                                   warnings=["You already voted for this poll. "])
-                                  
-        return render_template('available_votes.html', list=polls, successes=['Successfully voted for {}!'.format(poll.name)])
+        except tuple(VOTE_ERRORS) as e:
+            return render_template('available_votes.html', poll_list_html=polls,
+                                  errors=[VOTE_ERRORS[type(e)]])
+        VOTES_CAST.inc(poll_id=poll.poll_id)
+        return render_template('available_votes.html', poll_list_html=polls, successes=['Successfully voted for {}!'.format(poll.name)])
         
+@app.route('/ballot', methods=['GET', 'POST'])
+def ballot():
+    """All open polls the voter hasn't voted in yet on one page, cast
+    together in one transaction.
+    """
+    token = request.args.get('token')
+    session = db_session()
+    voter = voter_context_from_token(token, session=session) if token else None
+    if not voter:
+        return render_template('available_votes.html',
+                              errors=["Invalid token. Please use the link from your email."])
+    polls = render_poll_list(voter, session)
+    open_polls = {poll.poll_id: poll for poll in
+                  open_polls_from_event(voter.event_id, session=session)}
+    if request.method == 'GET':
+        voted = voted_poll_ids(voter, open_polls, session=session)
+        pending = [poll for poll_id, poll in open_polls.items()
+                   if poll_id not in voted]
+        if len(pending) == 0:
+            return render_template('available_votes.html', poll_list_html=polls,
+                                  warnings=["You already voted in every open poll."])
+        return render_template('ballot.html', voter_token=token,
+                              proxy_message=proxy_message(voter), polls=[
+            {'poll_id': poll.poll_id, 'name': poll.name,
+             'tally_method': poll.tally_method, 'seats': poll.seats,
+             'vote_count_message': vote_count_message(voter, poll),
+             'option_list_html': render_option_list(voter, poll, session)}
+            for poll in pending
+        ])
+    poll_ids = request.form.getlist('poll_ids', type=int)
+    if len(poll_ids) == 0 or any(poll_id not in open_polls
+                                 for poll_id in poll_ids):
+        return render_template('available_votes.html', poll_list_html=polls,
+                              errors=["A poll on this page has closed in the meantime. Nothing was cast, try again."])
+    try:
+        vote_entries = parse_vote_form(request.form)
+    except ValueError:
+        return render_template('available_votes.html', poll_list_html=polls,
+                              errors=["Broken request. Try again."])
+    # Option ids are unique over all polls
+    vote_dicts = {poll_id: {} for poll_id in poll_ids}
+    for poll_id in poll_ids:
+        for option in options_from_poll(open_polls[poll_id], session=session):
+            if option.poll_option_id in vote_entries:
+                vote_dicts[poll_id][option.poll_option_id] = \
+                    vote_entries.pop(option.poll_option_id)
+    if len(vote_entries) > 0:
+        return render_template('available_votes.html', poll_list_html=polls,
+                              errors=[VOTE_ERRORS[VoteExceptionWrongId]])
+    try:
+        with BALLOTS_REJECTED.count_exceptions('reason'):
+            cast_votes(voter, vote_dicts, session=session)
+    except VoteExceptionAlreadyVoted:
+        return render_template('available_votes.html', poll_list_html=polls,
+                              warnings=["You already voted in one of these polls. Nothing was cast, vote in the others one by one."])
+    except tuple(VOTE_ERRORS) as e:
+        return render_template('available_votes.html', poll_list_html=polls,
+                              errors=["{}: {} Nothing was cast.".format(
+                                  open_polls[e.poll_id].name,
+                                  VOTE_ERRORS[type(e)])])
+    for poll_id in poll_ids:
+        VOTES_CAST.inc(poll_id=poll_id)
+    return render_template('available_votes.html', poll_list_html=polls,
+                          successes=['Successfully voted for {}!'.format(
+                              ', '.join(open_polls[poll_id].name
+                                        for poll_id in poll_ids))])
+
+# Exception -> (HTTP status, error code, message) for the JSON API
+API_VOTE_ERRORS = {
+    VoteExceptionTooFew: (422, 'too_few_votes',
+                          "Not all possible votes assigned."),
+    VoteExceptionTooMany: (422, 'too_many_votes', "Too many votes assigned."),
+    VoteExceptionNegative: (422, 'negative_votes', "Can't cast negative votes."),
+    VoteExceptionWrongId: (422, 'wrong_option',
+                           "Options must belong to this poll."),
+    VoteExceptionWrongTime: (409, 'poll_closed',
+                             "The poll is closed or has not started yet."),
+    VoteExceptionWrongEvent: (403, 'wrong_event',
+                              "This poll is not in your event."),
+    VoteExceptionAlreadyVoted: (409, 'already_voted',
+                                "You already voted for this poll."),
+    VoteExceptionInvalidBallot: (422, 'invalid_ballot',
+                                 "Approvals must be 0 or 1, and ranks 1, 2, 3 "
+                                 "and so on without gaps or repeats."),
+}
+
+def api_error(status: int, code: str, message: str, **details):
+    response = jsonify(error=dict(details, code=code, message=message))
+    response.status_code = status
+    return response
+
+def api_voter():
+    """Returns the voter of an API request, which carries the voting token
+    as a bearer token or a `token` query argument.
+    """
+    token = request.args.get('token', '')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    voter = None
+    if token:
+        voter = voter_context_from_token(token, session=db_session())
+    if voter is None:
+        abort(api_error(401, 'invalid_token',
+                        "Invalid token. Use the token from your email."))
+    return voter
+
+@app.route('/api/v1/voter', methods=['GET'])
+def api_voter_context():
+    voter = api_voter()
+    return jsonify(event_id=voter.event_id, vote_weight=voter.vote_weight,
+                   proxies=list(voter.proxy_emails))
+
+@app.route('/api/v1/polls', methods=['GET'])
+def api_polls():
+    voter = api_voter()
+    session = db_session()
+    polls = open_polls_from_event(voter.event_id, session=session)
+    voted = voted_poll_ids(voter, [poll.poll_id for poll in polls],
+                           session=session)
+    return jsonify(polls=[
+        {'poll_id': poll.poll_id, 'name': poll.name,
+         'tally_method': poll.tally_method, 'seats': poll.seats,
+         'voted': poll.poll_id in voted,
+         'options': [{'poll_option_id': option.poll_option_id,
+                      'name': option.name}
+                     for option in options_from_poll(poll, session=session)]}
+        for poll in polls
+    ])
+
+@app.route('/api/v1/polls/<int:poll_id>/ballot', methods=['POST'])
+def api_ballot(poll_id):
+    voter = api_voter()
+    session = db_session()
+    poll = voter_poll(voter, poll_id, session=session)
+    if poll is None:
+        return api_error(404, 'unknown_poll',
+                         "No poll with such id: {}.".format(poll_id))
+    try:
+        vote_dict = parse_vote_json(request.get_json(silent=True))
+    except ValueError as e:
+        return api_error(400, 'bad_request', str(e))
+    try:
+        with BALLOTS_REJECTED.count_exceptions('reason'):
+            cast_vote(voter, vote_dict, poll_id=poll.poll_id,
+                      session=session)
+    except tuple(API_VOTE_ERRORS) as e:
+        return api_error(*API_VOTE_ERRORS[type(e)])
+    VOTES_CAST.inc(poll_id=poll.poll_id)
+    return jsonify(poll_id=poll.poll_id, voted=True)
+
+@app.route('/api/v1/ballots', methods=['POST'])
+def api_ballots():
+    """Votes in several polls at once; either all votes count or none."""
+    voter = api_voter()
+    session = db_session()
+    try:
+        vote_dicts = parse_ballots_json(request.get_json(silent=True))
+    except ValueError as e:
+        return api_error(400, 'bad_request', str(e))
+    try:
+        with BALLOTS_REJECTED.count_exceptions('reason'):
+            cast_votes(voter, vote_dicts, session=session)
+    except tuple(API_VOTE_ERRORS) as e:
+        return api_error(*API_VOTE_ERRORS[type(e)],
+                         poll_id=getattr(e, 'poll_id', None))
+    for poll_id in vote_dicts:
+        VOTES_CAST.inc(poll_id=poll_id)
+    return jsonify(poll_ids=sorted(vote_dicts), voted=True)
+
+def require_admin():
+    """Aborts unless the request carries the admin token, either as an
+    `admin_token` query argument (EventSource can't set headers) or as a
+    bearer token.
+    """
+    expected = app.config['ADMIN_TOKEN']
+    if not expected:
+        abort(404)
+    given = request.args.get('admin_token', '')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        given = authorization[len('Bearer '):]
+    if not hmac.compare_digest(given.encode(), expected.encode()):
+        abort(403)
+
+@app.route('/admin/polls/<int:poll_id>/stream', methods=['GET'])
+def poll_stream(poll_id):
+    require_admin()
+    # Before a watcher is kept for it
+    if poll_from_id(poll_id, session=db_session()) is None:
+        abort(404)
+    watcher = watch_poll(poll_id, interval=app.config['LIVE_TALLY_INTERVAL'],
+                         max_subscribers=app.config['LIVE_TALLY_MAX_STREAMS'])
+    if watcher is None:
+        REQUESTS_SHED.inc(route=request.url_rule.rule)
+        return Response("Too many live tallies open.", status=503,
+                        headers={'Retry-After': str(BUSY_RETRY_AFTER)})
+    keepalive = app.config['LIVE_TALLY_KEEPALIVE']
+    end = time.monotonic() + app.config['LIVE_TALLY_MAX_STREAM_SECONDS']
+
+    def events():
+        seen_version = 0
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            version, snapshot = watcher.wait(
+                seen_version, timeout=min(keepalive, remaining))
+            if version == seen_version:
+                yield ': keepalive\n\n'
+                continue
+            seen_version = version
+            yield 'event: tally\ndata: {}\n\n'.format(json.dumps(snapshot))
+
+    response = Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    # Also when the client goes away before the stream ends
+    response.call_on_close(lambda: stop_watching(watcher))
+    return response
+
+@app.route('/admin/polls/<int:poll_id>', methods=['GET'])
+def poll_live_tally(poll_id):
+    require_admin()
+    if poll_from_id(poll_id, session=db_session()) is None:
+        abort(404)
+    return render_template('live_tally.html', poll_id=poll_id,
+                           admin_token=request.args.get('admin_token', ''))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    require_admin()
+    return Response(REGISTRY.exposition(),
+                    mimetype='text/plain; version=0.0.4')
+
 @app.route('/', methods=['GET'])
 def welcome():
     return render_template('blank.html',
@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 import argparse
+import csv
+import logging
 import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
 
 from tabulate import tabulate
 
@@ -8,11 +14,27 @@ from electobot.database import (create_event, delete_event, create_poll,
                                 Event, Voter, Poll, PollOption, VoteCast,
                                 Proxy, render_table, create_engine,
                                 create_default_session, create_session,
-                                create_all_tables, create_voter,
+                                upgrade_tables, create_voter,
                                 most_recent_poll, create_poll_option,
                                 create_proxy, event_from_identifier,
-                                votes_to_table, close_poll, open_poll)
-from electobot.main import event_register_url, voting_url
+                                votes_to_table, close_poll, open_poll,
+                                OutboxMessage, Ballot, create_voters,
+                                create_proxies, get_event, enqueue_message,
+                                rotate_voter_tokens, delete_proxy,
+                                check_vote_weights, TALLY_METHODS,
+                                RANKED_METHODS, unsafe_email_patterns)
+from electobot.main import (event_register_url, voting_url,
+                            voting_url_from_token)
+from electobot.exceptions import (DBExceptionInvalidEmailPattern,
+                                  DBExceptionInvalidTallyMethod,
+                                  DBExceptionInvalidSchedule,
+                                  DBExceptionUpgradeFailed)
+from electobot.imports import read_csv_rows
+from electobot.export import EXPORT_FORMATS, export_table, export_poll
+from electobot.mail_worker import MailWorker
+from electobot.scheduler import PollScheduler
+from electobot.profiling import PROFILE, profiled
+from electobot.tally import tally_to_table
 
 NAME_TYPE_MAPPING = {
     'events': Event,
@@ -20,15 +42,53 @@ NAME_TYPE_MAPPING = {
     'polls': Poll,
     'poll_options': PollOption,
     'vote_casts': VoteCast,
-    'proxies': Proxy
+    'proxies': Proxy,
+    'ballots': Ballot,
+    'outbox': OutboxMessage
 }
 
 DEFAULT_MAIL_PATTERN = os.environ.get('ELECTOBOT_EMAIL_PATTERN', ".*@.*\..*")
 
+RELATIVE_TIME = re.compile(r'^\+(\d+)([mh])$')
+
+def parse_time(value: str) -> datetime:
+    """Parses `+<n>m`, `+<n>h` or an ISO date and time into a naive UTC
+    datetime, as stored in the database. ISO times without a UTC offset are
+    local time.
+    """
+    match = RELATIVE_TIME.match(value)
+    if match:
+        unit = 'minutes' if match.group(2) == 'm' else 'hours'
+        return datetime.utcnow() + timedelta(**{unit: int(match.group(1))})
+    try:
+        time_ = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Expected +<minutes>m, +<hours>h or an ISO date and time, got {}"
+            .format(value))
+    return time_.astimezone(timezone.utc).replace(tzinfo=None)
+
+def write_voting_links(tokens, output=None):
+    """Prints (email, token) pairs as voting links, or writes them to the
+    CSV file `output`.
+    """
+    rows = [[email, voting_url_from_token(token)] for email, token in tokens]
+    if output is None:
+        print(tabulate(rows, headers=['Email', 'Voting link']))
+    else:
+        with open(output, 'w', newline='') as file_:
+            writer = csv.writer(file_)
+            writer.writerow(['email', 'voting_link'])
+            writer.writerows(rows)
+
 def main():
     parser = argparse.ArgumentParser(description='Manage elections.')
     parser.add_argument('-p', '--path', default=None,
                                     help='sqlite database path')
+    parser.add_argument('--database-url', default=None,
+                        help='SQLAlchemy database URL (default: '
+                             'ELECTOBOT_DATABASE_URL, or the sqlite database in '
+                             'the data directory)')
     subparsers = parser.add_subparsers(help='commands', dest='command')
     
     # Setup
@@ -47,6 +107,15 @@ def main():
                                                       help="Add poll")
     create_poll_parser.add_argument('name')
     create_poll_parser.add_argument('-e', '--event', default=None)
+    create_poll_parser.add_argument('--method', default='plurality',
+                                    choices=TALLY_METHODS,
+                                    help="How ballots are cast and counted (default: plurality)")
+    create_poll_parser.add_argument('--seats', type=int, default=1,
+                                    help="Number of options to elect (default: 1)")
+    create_poll_parser.add_argument('--start', type=parse_time, default=None,
+                                    help="Open the poll at this time, e.g. +10m or 2021-05-01T14:00 (default: open it by hand)")
+    create_poll_parser.add_argument('--end', type=parse_time, default=None,
+                                    help="Close the poll at this time, e.g. +1h (default: close it by hand)")
     ## Create poll option
     create_voter_parser = create_subparsers.add_parser('poll_option',
                                                        help="Add options to a poll")
@@ -57,6 +126,14 @@ def main():
                                                        help="Manually create voters")
     create_voter_parser.add_argument('email')
     create_voter_parser.add_argument('-e', '--event', default=None)
+    ## Create voters from a CSV file
+    create_voters_parser = create_subparsers.add_parser('voters',
+                                                        help="Create voters from a CSV file of emails")
+    create_voters_parser.add_argument('--csv', required=True,
+                                      help="CSV file with an 'email' column")
+    create_voters_parser.add_argument('-e', '--event', default=None)
+    create_voters_parser.add_argument('-o', '--output', default=None,
+                                      help="Write email,voting link rows to this CSV file instead of printing them")
     ## Create voter proxy
     create_voter_parser = create_subparsers.add_parser('proxy', 
                                                        help="Create proxy votes")
@@ -64,6 +141,17 @@ def main():
     create_voter_parser.add_argument('proxy_email')
     create_voter_parser.add_argument('-e', '--event', default=None)
 
+    ## Create proxies from a CSV file
+    create_proxies_parser = create_subparsers.add_parser('proxies',
+                                                         help="Create proxy votes from a CSV file")
+    create_proxies_parser.add_argument('--csv', required=True,
+                                       help="CSV file with 'present_voter_email' and 'proxy_email' columns")
+    create_proxies_parser.add_argument('-e', '--event', default=None)
+    create_proxies_parser.add_argument('--max_per_voter', type=int, default=None,
+                                       help="Most proxies a single voter may hold")
+    create_proxies_parser.add_argument('--rejects', default=None,
+                                       help="Where to write skipped rows (default: <csv>.rejects.csv)")
+
     # Delete
     delete_parser = subparsers.add_parser('delete')
     delete_subparsers = delete_parser.add_subparsers(help='commands',
@@ -71,10 +159,23 @@ def main():
     ## Delete event
     delete_event_parser = delete_subparsers.add_parser('event', help="Add event")
     delete_event_parser.add_argument('id')
+    ## Delete proxy
+    delete_proxy_parser = delete_subparsers.add_parser('proxy', help="Remove a proxy vote")
+    delete_proxy_parser.add_argument('-e', '--event', default=None)
+    delete_proxy_parser.add_argument('proxy_email')
     # Print low level table
     print_table_parser = subparsers.add_parser('print_table',
                                                help='Print underlying SQL table')
     print_table_parser.add_argument('object')
+    # Export a table or the ballots of a poll
+    export_parser = subparsers.add_parser('export',
+                                          help='Write a table, or the ballots of a poll, as CSV or JSON Lines')
+    export_parser.add_argument('object',
+                               help="A table name as for print_table, or 'poll' for the ballots of a poll")
+    export_parser.add_argument('--poll_id', default=None)
+    export_parser.add_argument('--format', default='csv', choices=EXPORT_FORMATS)
+    export_parser.add_argument('-o', '--output', default=None,
+                               help="File to write to (default: standard output)")
     # List high level things (with links)
     list_parser = subparsers.add_parser('list',
                                         help='List objects')
@@ -90,6 +191,13 @@ def main():
     # Tally
     tally_parser = subparsers.add_parser('tally', help="Count votes for a poll")
     tally_parser.add_argument('--poll_id', default=None)
+    tally_parser.add_argument('--recount', action='store_true',
+                              help="Count all ballots again instead of "
+                                   "continuing from the last tally")
+    tally_parser.add_argument('--method', default=None, choices=TALLY_METHODS,
+                              help="Count with another method taking the same ballots, e.g. stv for an irv poll")
+    tally_parser.add_argument('--seats', type=int, default=None,
+                              help="Number of options to elect (default: that of the poll)")
     # Close poll
     close_parser = subparsers.add_parser('close', help="Close a poll")
     close_parser.add_argument('--poll_id', default=None)
@@ -97,30 +205,92 @@ def main():
     open_parser = subparsers.add_parser('open', help="Open a poll")
     open_parser.add_argument('--poll_id', default=None)
 
+    # Check vote weights
+    check_weights_parser = subparsers.add_parser('check_vote_weights',
+                                                 help="Check that every voter's vote weight matches their proxies")
+    check_weights_parser.add_argument('-e', '--event', default=None,
+                                      help="Only check this event (default: all events)")
+    check_weights_parser.add_argument('--repair', action='store_true',
+                                      help="Fix the vote weights that are wrong")
+
+    # Rotate voter tokens
+    rotate_parser = subparsers.add_parser('rotate_tokens',
+                                          help="Revoke all voting links of an event and make new, signed ones")
+    rotate_parser.add_argument('-e', '--event', default=None)
+    rotate_parser.add_argument('-o', '--output', default=None,
+                               help="Write email,voting link rows to this CSV file instead of printing them")
+    rotate_parser.add_argument('--send', action='store_true',
+                               help="Queue an email with the new link to every voter")
+
+    # Mail worker
+    mail_worker_parser = subparsers.add_parser('mail_worker',
+                                               help="Send queued emails")
+    mail_worker_parser.add_argument('--once', action='store_true',
+                                    help="Send what is due and exit")
+
+    # Poll scheduler
+    scheduler_parser = subparsers.add_parser('scheduler',
+                                             help="Open and close polls at their scheduled times")
+    scheduler_parser.add_argument('--once', action='store_true',
+                                  help="Apply what is due and exit")
+
     args = parser.parse_args()
-    if args.path is None:
+    if args.path is None and args.database_url is None:
+        engine = None
         session = create_default_session()
     else:
-        engine = create_engine(path=args.path)
+        engine = create_engine(path=args.path, url=args.database_url)
         session = create_session(engine)
     if args.command == 'setup':
-        if args.path is None:
+        if engine is None:
             engine = create_engine()
-        else:
-            engine = create_engine(path=args.path)
-        create_all_tables(engine)
+        try:
+            upgrade_tables(engine)
+        except DBExceptionUpgradeFailed as e:
+            print("Upgrade failed: {}. Remove the duplicates and run setup "
+                  "again.".format(e), file=sys.stderr)
+            exit(1)
+        for event_id, name, email_pattern, reason in unsafe_email_patterns(
+                session=session):
+            print("Email pattern {!r} of event {} ({}) can make registration "
+                  "slow: {}".format(email_pattern, event_id, name, reason),
+                  file=sys.stderr)
     elif args.command == 'delete':
         if args.object == 'event':
-            if delete_event(args.id):
+            if delete_event(args.id, session=session):
                 print("Event {} deleted.".format(args.id))
             else:
                 print("Failed to delete event {}".format(args.id))
+        elif args.object == 'proxy':
+            if delete_proxy(args.event, args.proxy_email, session=session):
+                print("Proxy {} deleted.".format(args.proxy_email))
+            else:
+                print("No proxy {} at this event".format(args.proxy_email))
     elif args.command == 'create':
         if args.object == 'event':
-            event = create_event(args.name, session=session, email_pattern=args.email_pattern)
+            try:
+                event = create_event(args.name, session=session, email_pattern=args.email_pattern)
+            except DBExceptionInvalidEmailPattern as e:
+                print("Invalid email pattern: {}".format(e), file=sys.stderr)
+                exit(1)
             print("Event {} created: {}".format(event.name, event_register_url(event.event_id, session=session)))
         elif args.object == 'poll':
-            create_poll(args.event, args.name, session=session)
+            try:
+                poll = create_poll(args.event, args.name,
+                                   start_time=args.start, end_time=args.end,
+                                   tally_method=args.method, seats=args.seats,
+                                   scheduled=args.start is not None,
+                                   session=session)
+            except (DBExceptionInvalidTallyMethod,
+                    DBExceptionInvalidSchedule) as e:
+                print(e, file=sys.stderr)
+                exit(1)
+            if args.start is not None:
+                print("Poll {} opens at {} UTC".format(poll.name,
+                                                      poll.start_time))
+            if args.end is not None:
+                print("Poll {} closes at {} UTC".format(poll.name,
+                                                       poll.end_time))
         elif args.object == 'poll_option':
             if args.poll_id is None:
                 poll = most_recent_poll(session=session)
@@ -132,20 +302,75 @@ def main():
             print("Poll option {} created for poll {}".format(args.name,
                                                               poll.name))
         elif args.object == 'voter':
-            event = event_from_identifier(args.event)
+            event = event_from_identifier(args.event, session=session)
             voter = create_voter(args.event, args.email, session=session)
             print("Voter {} created for event {}".format(voter.email,
                                                          event.name))
             print("Token: {}".format(voter.token))
+        elif args.object == 'voters':
+            start = time.perf_counter()
+            with open(args.csv, newline='') as file_:
+                emails = [email for (email,) in read_csv_rows(file_, ['email'])]
+            created, rejected = create_voters(args.event, emails,
+                                              session=session)
+            duration = time.perf_counter() - start
+            write_voting_links(created, args.output)
+            for email, reason in rejected:
+                print("Skipped {}: {}".format(email, reason), file=sys.stderr)
+            print("Created {} voters, skipped {} in {:.2f}s".format(
+                len(created), len(rejected), duration), file=sys.stderr)
         elif args.object == 'proxy':
             create_proxy(args.event, args.present_voter_email,
                          args.proxy_email, session=session)
             print("Proxy created: {} will vote for {}".format(args.present_voter_email, args.proxy_email))
+        elif args.object == 'proxies':
+            with open(args.csv, newline='') as file_:
+                pairs = list(read_csv_rows(file_, ['present_voter_email',
+                                                   'proxy_email']))
+            created, rejected = create_proxies(
+                args.event, pairs, max_proxies_per_voter=args.max_per_voter,
+                session=session)
+            print("Created {} proxies".format(len(created)))
+            if len(rejected) > 0:
+                rejects_path = args.rejects
+                if rejects_path is None:
+                    rejects_path = os.path.splitext(args.csv)[0] + '.rejects.csv'
+                with open(rejects_path, 'w', newline='') as file_:
+                    writer = csv.writer(file_)
+                    writer.writerow(['present_voter_email', 'proxy_email',
+                                     'reason'])
+                    writer.writerows(rejected)
+                print("Skipped {} rows, see {}".format(len(rejected),
+                                                       rejects_path))
     elif args.command == 'print_table':
         if args.object not in NAME_TYPE_MAPPING:
             print("Unknown object. Possible values:", list(NAME_TYPE_MAPPING))
             exit(1)
         print(render_table(NAME_TYPE_MAPPING[args.object], session=session))
+    elif args.command == 'export':
+        if args.object != 'poll' and args.object not in NAME_TYPE_MAPPING:
+            print("Unknown object. Possible values:",
+                  ['poll'] + list(NAME_TYPE_MAPPING), file=sys.stderr)
+            exit(1)
+        if args.object == 'poll':
+            if args.poll_id is None:
+                poll_id = most_recent_poll(session=session).poll_id
+            else:
+                poll_id = int(args.poll_id)
+
+            def export(file_):
+                return export_poll(poll_id, file_, format=args.format,
+                                   session=session)
+        else:
+            def export(file_):
+                return export_table(NAME_TYPE_MAPPING[args.object], file_,
+                                    format=args.format, session=session)
+        if args.output is None:
+            count = export(sys.stdout)
+        else:
+            with open(args.output, 'w', newline='') as file_:
+                count = export(file_)
+        print("Exported {} rows".format(count), file=sys.stderr)
     elif args.command == 'list':
         if args.object == 'events':
             events = session.query(Event).all()
@@ -171,7 +396,18 @@ def main():
             poll = most_recent_poll(session=session)
         else:
             poll = session.query(Poll).filter_by(poll_id=int(args.poll_id)).first()
-        print(votes_to_table(poll.poll_id, session=session))
+        if (poll.tally_method in RANKED_METHODS or args.method is not None
+                or args.seats is not None):
+            try:
+                print(tally_to_table(poll.poll_id, method=args.method,
+                                     seats=args.seats, recount=args.recount,
+                                     session=session))
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                exit(1)
+        else:
+            print(votes_to_table(poll.poll_id, recount=args.recount,
+                                 session=session))
     elif args.command == 'close':
         if args.poll_id is None:
             poll = most_recent_poll(session=session)
@@ -186,9 +422,70 @@ def main():
             poll = session.query(Poll).filter_by(poll_id=int(args.poll_id)).first()
         open_poll(poll.poll_id, session=session)
         print("Poll {} opened".format(poll.name))
+    elif args.command == 'check_vote_weights':
+        event_id = None if args.event is None else \
+            get_event(args.event, session=session).event_id
+        mismatches = check_vote_weights(event_id, repair=args.repair,
+                                        session=session)
+        if len(mismatches) == 0:
+            print("All vote weights are correct.")
+        else:
+            print(tabulate(mismatches,
+                           headers=['Email', 'Stored weight', 'Actual weight']))
+            if args.repair:
+                print("Repaired {} vote weights".format(len(mismatches)))
+            else:
+                print("Run with --repair to fix them")
+                exit(1)
+    elif args.command == 'rotate_tokens':
+        event = get_event(args.event, session=session)
+        tokens = rotate_voter_tokens(event.event_id, session=session)
+        write_voting_links(tokens, args.output)
+        if args.send:
+            for email, token in tokens:
+                enqueue_message(email, "{} voting link".format(event.name),
+                                "Your voting link has changed. The URL to vote is: {}".format(
+                                    voting_url_from_token(token)),
+                                session=session)
+            print("Queued {} emails, send them with `mail_worker`".format(
+                len(tokens)), file=sys.stderr)
+        print("New voting links for {} voters of {}".format(len(tokens),
+                                                           event.name),
+              file=sys.stderr)
+    elif args.command == 'mail_worker':
+        if engine is None:
+            worker = MailWorker()
+        else:
+            worker = MailWorker(session_factory=lambda: create_session(engine))
+        if args.once:
+            worker.flush()
+        else:
+            try:
+                worker.run()
+            except KeyboardInterrupt:
+                pass
+    elif args.command == 'scheduler':
+        if engine is None:
+            scheduler = PollScheduler()
+        else:
+            scheduler = PollScheduler(
+                session_factory=lambda: create_session(engine))
+        if args.once:
+            for poll_id, is_open in scheduler.run_due():
+                print("Poll {} {}".format(poll_id,
+                                          'opened' if is_open else 'closed'))
+        else:
+            logging.basicConfig(level=logging.INFO)
+            try:
+                scheduler.run()
+            except KeyboardInterrupt:
+                pass
     else:
         exit(1)
         print("Unknown command")
 
 if __name__ == '__main__':
-    main()
+    if PROFILE:
+        logging.basicConfig(level=logging.INFO)
+    with profiled(' '.join(['electobot-cli.py'] + sys.argv[1:])):
+        main()
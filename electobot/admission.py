@@ -0,0 +1,144 @@
+"""
+Admission control for bursts of requests, such as everyone registering at
+once when the chair asks them to. Requests beyond what a route can handle wait
+briefly in a bounded queue and are otherwise turned away with a time to retry,
+instead of piling up on the worker threads and the SQLite write lock.
+
+Limits hold per process; with several worker processes, divide them.
+"""
+import math
+import os
+import threading
+import time
+from typing import Union
+
+# Seconds after which a client turned away by a concurrency limit may retry
+BUSY_RETRY_AFTER = 1
+
+class TokenBucket:
+    """Allows `rate` requests per second on average and bursts of up to
+    `burst` requests.
+    """
+
+    def __init__(self, rate: float, burst: int, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float):
+        """Takes a token if one is available within `max_wait` seconds.
+
+        Returns (True, seconds to wait before using it), or (False, seconds
+        until a token would be available within `max_wait`), taking nothing.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens
+                               + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                return False, wait - max_wait
+            # Tokens can go negative: later requests queue behind this one
+            self._tokens -= 1
+            return True, wait
+
+    def refund(self) -> None:
+        """Gives back a token taken by a request that didn't go ahead."""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+class ConcurrencyLimit:
+    """At most `limit` requests at once. Up to `max_queue` more may wait for
+    a free slot; anything beyond that is refused right away.
+    """
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+            deadline = time.monotonic() + timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self) -> None:
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+class Admission:
+    """The limits of one group of routes. The concurrency limit applies to
+    every request, the rate only to writes.
+    """
+
+    def __init__(self, concurrency: Union[int, None]=None,
+                 rate: Union[float, None]=None, burst: Union[int, None]=None,
+                 max_queue=32, max_wait=2.0, sleep=time.sleep):
+        self.limit = ConcurrencyLimit(concurrency, max_queue) \
+            if concurrency else None
+        self.bucket = TokenBucket(rate, burst or max(1, int(rate))) \
+            if rate else None
+        self.max_wait = max_wait
+        self._sleep = sleep
+
+    def enter(self, write: bool) -> Union[int, None]:
+        """Returns None if the request may go ahead, and `leave` must be
+        called after it. Otherwise returns the whole seconds after which the
+        client should retry.
+        """
+        start = time.monotonic()
+        if write and self.bucket is not None:
+            admitted, wait = self.bucket.reserve(self.max_wait)
+            if not admitted:
+                return max(1, math.ceil(wait))
+            if wait > 0:
+                self._sleep(wait)
+        if self.limit is not None:
+            remaining = self.max_wait - (time.monotonic() - start)
+            if not self.limit.acquire(max(0.0, remaining)):
+                # A refused request doesn't count against the rate
+                if write and self.bucket is not None:
+                    self.bucket.refund()
+                return BUSY_RETRY_AFTER
+        return None
+
+    def leave(self) -> None:
+        if self.limit is not None:
+            self.limit.release()
+
+def admission_from_env(name: str, concurrency=None, rate=None, burst=None,
+                       max_queue=32, max_wait=2.0) -> Admission:
+    """Builds an `Admission` whose settings can be overridden by
+    ELECTOBOT_<NAME>_CONCURRENCY, _RATE, _BURST, _QUEUE and _MAX_WAIT. A
+    concurrency or rate of 0 turns that limit off.
+    """
+    def setting(key, default, type_):
+        value = os.environ.get('ELECTOBOT_{}_{}'.format(name.upper(), key))
+        return default if value is None else type_(value)
+    return Admission(concurrency=setting('CONCURRENCY', concurrency, int),
+                     rate=setting('RATE', rate, float),
+                     burst=setting('BURST', burst, int),
+                     max_queue=setting('QUEUE', max_queue, int),
+                     max_wait=setting('MAX_WAIT', max_wait, float))
@@ -3,16 +3,24 @@ This module is responsible for fetching data from and into the database.
 """
 import logging
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Union
 import re
+import threading
 from copy import copy
+from collections import Counter, namedtuple
+from contextlib import contextmanager
 
 from sqlalchemy.orm.session import Session as SQLAlchemySession
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy import create_engine as sqlalchemy_create_engine
+from sqlalchemy import event as sqlalchemy_event
 from sqlalchemy import (Column, Integer, ForeignKey, String, Table, Float,
-                        DateTime, Boolean)
+                        DateTime, Boolean, Index, func, bindparam, text)
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool, QueuePool, SingletonThreadPool, StaticPool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.expression import desc
 from tabulate import tabulate
@@ -20,29 +28,174 @@ from tabulate import tabulate
 from .exceptions import (VoteExceptionTooFew, VoteExceptionTooMany,
                          VoteExceptionWrongId, VoteExceptionNegative,
                          VoteExceptionWrongTime, VoteExceptionWrongEvent,
-                         VoteExceptionAlreadyVoted, DBExceptionEmailAlreadyUsed)
-from .token import gen_token
+                         VoteExceptionAlreadyVoted, DBExceptionEmailAlreadyUsed,
+                         VoteExceptionInvalidBallot,
+                         DBExceptionInvalidTallyMethod,
+                         DBExceptionInvalidSchedule,
+                         DBExceptionInvalidEmailPattern,
+                         DBExceptionUpgradeFailed)
+from .token import (gen_token, gen_secret, is_random_token, sign_voter_token,
+                    parse_signed_token, check_signature)
+from .cache import LRUCache
+from .email_pattern import (compile_email_pattern, email_allowed,
+                            forget_event_pattern)
 
 logger = logging.getLogger('databases')
 
 DATA_DIR = os.environ.get('ELECTOBOT_DATA_DIR', 'data')
 ABSTAIN_KEY = 'abstain'
+# How the ballots of a poll are cast and counted, see `electobot.tally`
+TALLY_METHODS = ('plurality', 'approval', 'irv', 'stv')
+RANKED_METHODS = ('irv', 'stv')
+VOTER_CACHE_SIZE = int(os.environ.get('ELECTOBOT_VOTER_CACHE_SIZE', 4096))
+# Seconds. Bounds how long a proxy added by another process can go unseen.
+VOTER_CACHE_TTL = float(os.environ.get('ELECTOBOT_VOTER_CACHE_TTL', 60))
+POLL_CACHE_SIZE = int(os.environ.get('ELECTOBOT_POLL_CACHE_SIZE', 1024))
+# Give new voters signed tokens (see `sign_voter_token`) instead of random ones
+SIGNED_VOTER_TOKENS = os.environ.get('ELECTOBOT_SIGNED_VOTER_TOKENS') == '1'
 
-def create_engine(path=os.path.join(DATA_DIR, 'db.sqlite'), echo=False):
-    if path != ":memory:" and not os.path.exists(os.path.dirname(path)):
-        os.makedirs(os.path.dirname(path))
-    engine = sqlalchemy_create_engine('sqlite:///' + path, echo=echo)
-    with engine.connect() as connection:
-        connection.execute('PRAGMA foreign_keys=ON')
+# PRAGMAs set on every connection, by profile name. `safe` keeps full
+# durability; `throughput` may lose the last transactions on power loss (but
+# never corrupts the database) in exchange for fewer fsyncs. Both use WAL, so
+# readers don't wait for writers. `legacy` is SQLite's defaults.
+SQLITE_PROFILES = {
+    'legacy': {},
+    'safe': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': 5000,
+        'cache_size': -8192,
+    },
+    'throughput': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 10000,
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+}
+SQLITE_PROFILE = os.environ.get('ELECTOBOT_SQLITE_PROFILE', 'safe')
+
+def _sqlite_pragma_listener(pragmas: dict):
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        """Runs on every new DBAPI connection the pool opens."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+    return set_sqlite_pragmas
+
+# Any SQLAlchemy URL. When unset, the SQLite file in DATA_DIR is used.
+DATABASE_URL = os.environ.get('ELECTOBOT_DATABASE_URL')
+# Pool settings. Size the pool to the number of threads of one app process.
+POOL_SIZE = int(os.environ.get('ELECTOBOT_DB_POOL_SIZE', 5))
+POOL_MAX_OVERFLOW = int(os.environ.get('ELECTOBOT_DB_MAX_OVERFLOW', 10))
+# Seconds before a connection is replaced, -1 to keep connections forever
+POOL_RECYCLE = int(os.environ.get('ELECTOBOT_DB_POOL_RECYCLE', 3600))
+POOL_PRE_PING = os.environ.get('ELECTOBOT_DB_POOL_PRE_PING', '1') != '0'
+# How SQLite file connections are pooled:
+#  - `queue`: up to POOL_SIZE + POOL_MAX_OVERFLOW connections shared by threads
+#  - `singleton`: one connection per thread
+#  - `static`: a single connection for everything
+#  - `null`: a new connection per checkout, as in older versions
+# `:memory:` databases always use `singleton` or `static`, since every new
+# connection would be a new, empty database.
+SQLITE_POOLS = {
+    'queue': QueuePool,
+    'singleton': SingletonThreadPool,
+    'static': StaticPool,
+    'null': NullPool,
+}
+SQLITE_POOL = os.environ.get('ELECTOBOT_SQLITE_POOL', 'queue')
+
+def _sqlite_engine_options(url, pool: str) -> dict:
+    if pool not in SQLITE_POOLS:
+        raise ValueError("Unknown SQLite pool {}, expected one of {}".format(
+            pool, list(SQLITE_POOLS)))
+    if url.database in (None, '', ':memory:') and pool not in ('singleton',
+                                                                'static'):
+        pool = 'singleton'
+    options = {'poolclass': SQLITE_POOLS[pool]}
+    if pool != 'null':
+        # Pooled connections move between threads; each is still only used
+        # by one thread at a time.
+        options['connect_args'] = {'check_same_thread': False}
+    if pool == 'queue':
+        options.update(pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW,
+                       pool_recycle=POOL_RECYCLE)
+    elif pool == 'singleton':
+        options['pool_size'] = POOL_SIZE
+    return options
+
+def create_engine(path: Union[str, None]=None, echo=False,
+                  profile: Union[str, None]=None, url: Union[str, None]=None,
+                  sqlite_pool: Union[str, None]=None):
+    """Creates an engine for the database at `url`, or for the SQLite database
+    at `path`.
+
+    Without either, ELECTOBOT_DATABASE_URL is used if set, and otherwise the
+    SQLite file in DATA_DIR. `profile` names an entry of `SQLITE_PROFILES` and
+    defaults to the ELECTOBOT_SQLITE_PROFILE environment variable, or `safe`;
+    `sqlite_pool` names an entry of `SQLITE_POOLS`. Both only apply to SQLite.
+    """
+    if profile is None:
+        profile = SQLITE_PROFILE
+    if profile not in SQLITE_PROFILES:
+        raise ValueError("Unknown SQLite profile {}, expected one of {}".format(
+            profile, list(SQLITE_PROFILES)))
+    if url is None and path is None:
+        url = DATABASE_URL
+    if url is None:
+        if path is None:
+            path = os.path.join(DATA_DIR, 'db.sqlite')
+        if path != ":memory:" and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        url = 'sqlite:///' + path
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        options = _sqlite_engine_options(
+            url, SQLITE_POOL if sqlite_pool is None else sqlite_pool)
+    else:
+        options = {'pool_size': POOL_SIZE, 'max_overflow': POOL_MAX_OVERFLOW,
+                   'pool_recycle': POOL_RECYCLE,
+                   'pool_pre_ping': POOL_PRE_PING}
+    engine = sqlalchemy_create_engine(url, echo=echo, **options)
+    if url.get_backend_name() == 'sqlite':
+        sqlalchemy_event.listen(engine, 'connect',
+                                _sqlite_pragma_listener(SQLITE_PROFILES[profile]))
     return engine
 
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Returns the process-wide engine, creating it on first use.
+
+    All default sessions share this engine (and therefore its connection pool)
+    instead of building a new engine per call.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine()
+    return _engine
+
+def set_engine(engine) -> None:
+    """Replaces the process-wide engine, e.g. with a test database."""
+    global _engine
+    with _engine_lock:
+        _engine = engine
+
 def create_session(engine):
     logger.debug("Connecting to: %s", engine.url.database)
     Event = scoped_session(sessionmaker(bind=engine))
     return Event()
 
 def create_default_session():
-    return create_session(create_engine())
+    return create_session(get_engine())
 
 def get_session(session: Union[SQLAlchemySession, None]=None) -> SQLAlchemySession:
     session = session if session else create_default_session()
@@ -71,6 +224,9 @@ def simplify_event_name(name: str, datetime: datetime):
 
 class Event(Base):
     __tablename__ = 'events'
+    __table_args__ = (
+        Index('ix_events_create_time', 'create_time'),
+    )
 
     event_id = Column(Integer, primary_key=True)
     simple_name = Column(String, nullable=False, unique=True)
@@ -151,35 +307,64 @@ def get_event(event_identifier,
     return event
 
 def create_event(name: str, email_pattern: str , session: Union[SQLAlchemySession, None]=None) -> Event:
+    """Creates an event. Raises `DBExceptionInvalidEmailPattern` if the
+    email pattern is not a safe regular expression.
+    """
+    compile_email_pattern(email_pattern)
     session = get_session(session)
-    token = gen_token()
-    while event_from_token(token, session=session) is not None:
-        token = gen_token()
-    event = Event(name=name, token=token, email_pattern=email_pattern)
+    # Random tokens don't collide in practice; the unique constraint would
+    # catch it if one ever did
+    event = Event(name=name, token=gen_token(), email_pattern=email_pattern)
     add_and_commit(event, session)
     return event
 
+def unsafe_email_patterns(session: Union[SQLAlchemySession, None]=None
+                          ) -> list:
+    """Returns (event_id, name, email_pattern, reason) for the events whose
+    pattern was stored before it was validated and is unsafe.
+    """
+    session = get_session(session)
+    unsafe = []
+    for event_id, name, email_pattern in session.query(
+            Event.event_id, Event.name, Event.email_pattern).order_by(
+            Event.event_id):
+        try:
+            compile_email_pattern(email_pattern)
+        except DBExceptionInvalidEmailPattern as e:
+            unsafe.append((event_id, name, email_pattern, str(e)))
+    return unsafe
+
 def delete_event(id: int, session: Union[SQLAlchemySession, None]=None) -> Boolean:
     session = get_session(session)
-    token = gen_token()
-    while event_from_token(token, session=session) is not None:
-        token = gen_token()
-    
     event=session.query(Event).filter(Event.event_id==id).first()
     if event is not None:
+        event_id = event.event_id
         session.delete(event)
         session.commit()
+        _voter_contexts.discard_where(
+            lambda context: context.event_id == event_id)
+        forget_event_pattern(event_id)
+        _event_token_keys.pop(event_id)
         return True
     return False
 
 class Voter(Base):
     __tablename__ = 'voters'
+    __table_args__ = (
+        # A unique index rather than a constraint, so `upgrade_tables` can
+        # add it to existing databases
+        Index('uq_voters_event_email', 'event_id', 'email', unique=True),
+    )
 
     voter_id = Column(Integer, primary_key=True)
     event_id = Column(ForeignKey('events.event_id', ondelete="CASCADE"),
                       nullable=False)
     email = Column(String, nullable=False)
     token = Column(String, nullable=False, unique=True)
+    # 1 + number of proxies. Updated in the same transaction as the proxies,
+    # so validating a ballot doesn't need to count them.
+    vote_weight = Column(Integer, nullable=False, default=1,
+                         server_default='1')
 
 def voter_from_email(event_identifier: Union[int, str, None],
                      email: str, session: Union[SQLAlchemySession, None]=None) -> Union[Voter, None]:
@@ -197,16 +382,75 @@ def create_voter(event_identifier: Union[int, str, None],
     """Creates a voter for an event. If the event is None, the voter will be
     for the most recent event.
     """
-    if voter_from_email(event_identifier, email, session=session):
-        raise DBExceptionEmailAlreadyUsed
-    token = gen_token()
-    while voter_from_token(token, session=session) is not None:
-        token = gen_token()
+    session = get_session(session)
     event = get_event(event_identifier, session=session)
-    voter = Voter(event_id=event.event_id, email=email, token=token)
-    add_and_commit(voter, session)
+    key = event_token_key(event.event_id, create=True, session=session) \
+        if SIGNED_VOTER_TOKENS else None
+    voter = Voter(event_id=event.event_id, email=email, token=gen_token())
+    try:
+        session.add(voter)
+        if key is not None:
+            # The signature covers the voter_id, which only exists once the
+            # row is inserted
+            session.flush()
+            voter.token = sign_voter_token(voter.voter_id, event.event_id,
+                                           *key)
+        session.commit()
+    except IntegrityError:
+        # The unique index on (event_id, email) catches duplicates, also
+        # when two registrations for the same email race each other
+        session.rollback()
+        if voter_from_email(event.event_id, email, session=session):
+            raise DBExceptionEmailAlreadyUsed
+        raise
     return voter
 
+def create_voters(event_identifier: Union[int, str, None], emails,
+                  session: Union[SQLAlchemySession, None]=None):
+    """Creates voters for many emails at once, in a single transaction.
+
+    Emails that don't match the event's email pattern, that appear twice, or
+    that already belong to a voter of the event are skipped. Returns a tuple
+    of two lists: (email, token) for the created voters and (email, reason)
+    for the skipped ones.
+    """
+    session = get_session(session)
+    event = get_event(event_identifier, session=session)
+    existing = {
+        email for (email,) in
+        session.query(Voter.email).filter_by(event_id=event.event_id)
+    }
+    created = []
+    rejected = []
+    for email in emails:
+        if not email_allowed(event, email):
+            rejected.append((email, "email address not permitted"))
+        elif email in existing:
+            rejected.append((email, "email already used"))
+        else:
+            existing.add(email)
+            created.append((email, gen_token()))
+    # Random tokens don't collide in practice; if one ever did, the unique
+    # index would fail the whole batch instead of creating a bad voter.
+    if len(created) > 0:
+        session.execute(Voter.__table__.insert(), [
+            {'event_id': event.event_id, 'email': email, 'token': token}
+            for email, token in created
+        ])
+        if SIGNED_VOTER_TOKENS:
+            key = event_token_key(event.event_id, create=True,
+                                  session=session)
+            new_emails = {email for email, _ in created}
+            tokens = _sign_voter_tokens(
+                event.event_id, key,
+                [(voter_id, email) for voter_id, email in session.query(
+                    Voter.voter_id, Voter.email).filter_by(
+                    event_id=event.event_id) if email in new_emails],
+                session)
+            created = [(email, tokens[email]) for email, _ in created]
+    session.commit()
+    return created, rejected
+
 def voter_from_token(token: str, session: Union[SQLAlchemySession, None]=None) -> Union[Voter, None]:
     """Returns the Voter with a given token, if exists. Otherwise, 
     returns None.
@@ -214,8 +458,99 @@ def voter_from_token(token: str, session: Union[SQLAlchemySession, None]=None) -
     session = get_session(session)
     return session.query(Voter).filter_by(token=token).first()
 
+class EventTokenKey(Base):
+    """The secret that signs the voter tokens of an event.
+
+    Tokens carry the `key_version` they were signed with, so rotating the key
+    revokes every signed token of the event at once.
+    """
+    __tablename__ = 'event_token_keys'
+
+    event_id = Column(ForeignKey('events.event_id', ondelete="CASCADE"),
+                      primary_key=True)
+    key_version = Column(Integer, nullable=False)
+    secret = Column(String, nullable=False)
+
+# event_id -> (key_version, secret), or None for events without a key. Keys
+# rotated by another process are picked up within the TTL; until then the
+# stored voter token, checked on every context lookup, still revokes.
+_event_token_keys = LRUCache(maxsize=VOTER_CACHE_SIZE, ttl=VOTER_CACHE_TTL)
+
+def event_token_key(event_id: int, create=False,
+                    session: Union[SQLAlchemySession, None]=None):
+    """Returns the (key_version, secret) of an event, or None if it has no
+    key. With `create`, a missing key is created and committed first.
+    """
+    key = _event_token_keys.get(event_id, False)
+    if key is not False and (key is not None or not create):
+        return key
+    session = get_session(session)
+    row = session.query(EventTokenKey.key_version, EventTokenKey.secret
+                        ).filter_by(event_id=event_id).first()
+    if row is None and create:
+        session.add(EventTokenKey(event_id=event_id, key_version=1,
+                                  secret=gen_secret()))
+        try:
+            session.commit()
+        except IntegrityError:
+            # Created by someone else in the meantime
+            session.rollback()
+        row = session.query(EventTokenKey.key_version, EventTokenKey.secret
+                            ).filter_by(event_id=event_id).first()
+    key = tuple(row) if row is not None else None
+    _event_token_keys.set(event_id, key)
+    return key
+
+def _sign_voter_tokens(event_id: int, key, voters,
+                       session: SQLAlchemySession) -> dict:
+    """Replaces the tokens of (voter_id, email) `voters` by tokens signed
+    with `key`. Returns email -> new token. Does not commit.
+    """
+    tokens = {email: sign_voter_token(voter_id, event_id, *key)
+              for voter_id, email in voters}
+    if len(tokens) > 0:
+        session.execute(
+            Voter.__table__.update().where(
+                Voter.voter_id == bindparam('b_voter_id')).values(
+                token=bindparam('b_token')),
+            [{'b_voter_id': voter_id, 'b_token': tokens[email]}
+             for voter_id, email in voters])
+    return tokens
+
+def rotate_voter_tokens(event_identifier: Union[int, str, None],
+                        session: Union[SQLAlchemySession, None]=None):
+    """Gives the event a new signing key and every voter of the event a new
+    signed token, revoking all the old ones. Returns (email, token) per voter;
+    voters need their new voting links.
+    """
+    session = get_session(session)
+    event = get_event(event_identifier, session=session)
+    event_id = event.event_id
+    secret = gen_secret()
+    updated = session.query(EventTokenKey).filter_by(event_id=event_id).update(
+        {EventTokenKey.key_version: EventTokenKey.key_version + 1,
+         EventTokenKey.secret: secret}, synchronize_session=False)
+    if updated == 0:
+        session.add(EventTokenKey(event_id=event_id, key_version=1,
+                                  secret=secret))
+        session.flush()
+    key_version = session.query(EventTokenKey.key_version).filter_by(
+        event_id=event_id).scalar()
+    voters = session.query(Voter.voter_id, Voter.email).filter_by(
+        event_id=event_id).order_by(Voter.voter_id).all()
+    tokens = _sign_voter_tokens(event_id, (key_version, secret), voters,
+                                session)
+    session.commit()
+    _event_token_keys.pop(event_id)
+    _voter_contexts.discard_where(lambda context: context.event_id == event_id)
+    return [(email, tokens[email]) for _, email in voters]
+
 class Proxy(Base):
     __tablename__ = 'proxies'
+    # Lookups by voter_id use the primary key index
+    __table_args__ = (
+        Index('ix_proxies_email', 'email'),
+    )
 
     voter_id = Column(ForeignKey('voters.voter_id', ondelete="CASCADE"),
                       primary_key=True, nullable=False)
@@ -229,28 +564,214 @@ def create_proxy(event_identifier: Union[str, int, None],
     session = get_session(session)
     voter = voter_from_email(event_identifier, voter_email, session=session)
     proxy = Proxy(voter_id=voter.voter_id, email=proxy_email)
-    add_and_commit(proxy, session)
+    session.add(proxy)
+    session.query(Voter).filter_by(voter_id=voter.voter_id).update(
+        {Voter.vote_weight: Voter.vote_weight + 1}, synchronize_session=False)
+    session.commit()
+    _voter_contexts.pop(voter.token)
     return proxy
 
+def delete_proxy(event_identifier: Union[str, int, None], proxy_email: str,
+                 session: Union[SQLAlchemySession, None]=None) -> bool:
+    """Removes a proxy at an event. Returns whether there was one."""
+    session = get_session(session)
+    event = get_event(event_identifier, session=session)
+    row = session.query(Proxy, Voter.token).join(
+        Voter, Voter.voter_id == Proxy.voter_id).filter(
+        Voter.event_id == event.event_id, Proxy.email == proxy_email).first()
+    if row is None:
+        return False
+    proxy, token = row
+    session.query(Voter).filter_by(voter_id=proxy.voter_id).update(
+        {Voter.vote_weight: Voter.vote_weight - 1}, synchronize_session=False)
+    session.delete(proxy)
+    session.commit()
+    _voter_contexts.pop(token)
+    return True
+
+def create_proxies(event_identifier: Union[str, int, None], pairs,
+                   max_proxies_per_voter: Union[int, None]=None,
+                   session: Union[SQLAlchemySession, None]=None):
+    """Creates many proxies at once, in a single transaction.
+
+    `pairs` are (present voter email, proxy email) tuples. A pair is skipped
+    if the present voter is not registered for the event, if the proxy is
+    registered as a voter or is already a proxy at the event, or if it would
+    give the voter more than `max_proxies_per_voter` proxies. Returns a tuple
+    of two lists: the created pairs, and (voter email, proxy email, reason)
+    for the skipped ones.
+    """
+    session = get_session(session)
+    event = get_event(event_identifier, session=session)
+    voters = {
+        email: (voter_id, token) for email, voter_id, token in
+        session.query(Voter.email, Voter.voter_id, Voter.token)
+            .filter_by(event_id=event.event_id)
+    }
+    proxy_counts = {}
+    taken_proxies = set()
+    for voter_id, proxy_email in session.query(Proxy.voter_id, Proxy.email).join(
+            Voter, Voter.voter_id == Proxy.voter_id).filter(
+            Voter.event_id == event.event_id):
+        proxy_counts[voter_id] = proxy_counts.get(voter_id, 0) + 1
+        taken_proxies.add(proxy_email)
+    created = []
+    rejected = []
+    for voter_email, proxy_email in pairs:
+        if voter_email not in voters:
+            reason = "present voter is not registered"
+        elif proxy_email in voters:
+            reason = "proxy is registered as a voter"
+        elif proxy_email in taken_proxies:
+            reason = "proxy already assigned"
+        elif (max_proxies_per_voter is not None
+              and proxy_counts.get(voters[voter_email][0], 0)
+                  >= max_proxies_per_voter):
+            reason = "voter already holds the maximum of {} proxies".format(
+                max_proxies_per_voter)
+        else:
+            voter_id = voters[voter_email][0]
+            proxy_counts[voter_id] = proxy_counts.get(voter_id, 0) + 1
+            taken_proxies.add(proxy_email)
+            created.append((voter_email, proxy_email))
+            continue
+        rejected.append((voter_email, proxy_email, reason))
+    if len(created) > 0:
+        session.execute(Proxy.__table__.insert(), [
+            {'voter_id': voters[voter_email][0], 'email': proxy_email}
+            for voter_email, proxy_email in created
+        ])
+        added = Counter(voters[voter_email][0] for voter_email, _ in created)
+        session.execute(
+            Voter.__table__.update().where(
+                Voter.voter_id == bindparam('b_voter_id')).values(
+                vote_weight=Voter.vote_weight + bindparam('b_added')),
+            [{'b_voter_id': voter_id, 'b_added': count}
+             for voter_id, count in added.items()])
+    session.commit()
+    for voter_email in {voter_email for voter_email, _ in created}:
+        _voter_contexts.pop(voters[voter_email][1])
+    return created, rejected
+
 def proxies_from_voter(voter: Voter,
                        session: Union[SQLAlchemySession, None]=None) -> Proxy:
     session = get_session(session)
     return session.query(Proxy).filter_by(voter_id=voter.voter_id).all()
 
-def votes_for_voter(voter: Voter,
-                    session: Union[SQLAlchemySession, None]=None) -> Proxy:
+def votes_for_voter(voter: Union[Voter, 'VoterContext'],
+                    session: Union[SQLAlchemySession, None]=None) -> int:
     """
     Returns the number of votes that a voter must give, defined as
     1 + number of proxies. If voter doesn't exist, return 0.
+
+    The weight is read from the database, not from `voter`, which may be a
+    cached `VoterContext` from before a proxy was added.
     """
     if voter is None:
         return 0
-    proxies = proxies_from_voter(voter,
-                                 session=session)
-    return 1 + len(proxies)
+    session = get_session(session)
+    vote_weight = session.query(Voter.vote_weight).filter(
+        Voter.voter_id == voter.voter_id).scalar()
+    return 0 if vote_weight is None else vote_weight
+
+def check_vote_weights(event_id: Union[int, None]=None, repair=False,
+                       session: Union[SQLAlchemySession, None]=None):
+    """Compares the stored vote weight of every voter of an event (or of all
+    events if `event_id` is None) with their proxies. Returns (email, stored,
+    actual) for the voters that differ, and fixes them if `repair` is set.
+    """
+    session = get_session(session)
+    proxy_counts = session.query(
+        Proxy.voter_id, func.count().label('proxies')).group_by(
+        Proxy.voter_id).subquery()
+    actual = 1 + func.coalesce(proxy_counts.c.proxies, 0)
+    query = session.query(Voter.voter_id, Voter.email, Voter.token,
+                          Voter.vote_weight, actual).outerjoin(
+        proxy_counts, proxy_counts.c.voter_id == Voter.voter_id).filter(
+        Voter.vote_weight != actual)
+    if event_id is not None:
+        query = query.filter(Voter.event_id == event_id)
+    rows = query.order_by(Voter.voter_id).all()
+    if repair and len(rows) > 0:
+        session.execute(
+            Voter.__table__.update().where(
+                Voter.voter_id == bindparam('b_voter_id')).values(
+                vote_weight=bindparam('b_vote_weight')),
+            [{'b_voter_id': voter_id, 'b_vote_weight': weight}
+             for voter_id, _, _, _, weight in rows])
+        session.commit()
+        for _, _, token, _, _ in rows:
+            _voter_contexts.pop(token)
+    return [(email, stored, weight) for _, email, _, stored, weight in rows]
+
+VoterContext = namedtuple('VoterContext', ['voter_id', 'event_id', 'token',
+                                           'vote_weight', 'proxy_emails'])
+VoterContext.__doc__ = """What the voting pages need to know about a voter.
+
+It has the `voter_id` and `event_id` of a `Voter`, so it can be passed to
+functions like `has_voter_voted` and `cast_vote` in place of one.
+"""
+
+_voter_contexts = LRUCache(maxsize=VOTER_CACHE_SIZE, ttl=VOTER_CACHE_TTL)
+
+def voter_context_from_token(token: str,
+                             session: Union[SQLAlchemySession, None]=None
+                             ) -> Union[VoterContext, None]:
+    """Returns the `VoterContext` for a token, or None if there is no such
+    voter. Contexts are cached per token, so repeated page views of a voter
+    don't touch the database.
+    """
+    context = _voter_contexts.get(token)
+    if context is not None:
+        return context
+    session = get_session(session)
+    signed = parse_signed_token(token)
+    if signed is not None:
+        # Forged and revoked tokens are turned away without a query once
+        # the event key is cached
+        key = event_token_key(signed.event_id, session=session)
+        if (key is None or key[0] != signed.key_version
+                or not check_signature(signed, key[1])):
+            return None
+        rows = session.query(Voter.token, Voter.vote_weight,
+                             Proxy.email).outerjoin(
+            Proxy, Proxy.voter_id == Voter.voter_id).filter(
+            Voter.voter_id == signed.voter_id).all()
+        # Also catches tokens revoked by another process whose new key
+        # isn't in our cache yet
+        if len(rows) == 0 or rows[0][0] != token:
+            return None
+        voter_id, event_id = signed.voter_id, signed.event_id
+        vote_weight = rows[0][1]
+        proxy_emails = tuple(email for _, _, email in rows
+                             if email is not None)
+    elif is_random_token(token):
+        voter = voter_from_token(token, session=session)
+        if voter is None:
+            return None
+        voter_id, event_id = voter.voter_id, voter.event_id
+        vote_weight = voter.vote_weight
+        proxy_emails = tuple(
+            email for (email,) in
+            session.query(Proxy.email).filter_by(voter_id=voter_id)
+        )
+    else:
+        return None
+    context = VoterContext(voter_id=voter_id, event_id=event_id,
+                           token=token,
+                           vote_weight=vote_weight,
+                           proxy_emails=proxy_emails)
+    _voter_contexts.set(token, context)
+    return context
+
+def clear_voter_contexts() -> None:
+    _voter_contexts.clear()
 
 class Poll(Base):
     __tablename__ = 'polls'
+    __table_args__ = (
+        Index('ix_polls_event_start_time', 'event_id', 'start_time'),
+    )
 
     poll_id = Column(Integer, primary_key=True)
     event_id = Column(ForeignKey('events.event_id', ondelete="CASCADE"),
@@ -259,18 +780,43 @@ class Poll(Base):
     start_time = Column(DateTime, nullable=False)
     end_time = Column(DateTime, nullable=True)
     is_open = Column(Boolean, default=False)
+    tally_method = Column(String, nullable=False, default='plurality',
+                          server_default='plurality')
+    # Number of options elected
+    seats = Column(Integer, nullable=False, default=1, server_default='1')
+    # Opened by the scheduler at `start_time`, rather than by hand
+    scheduled = Column(Boolean, nullable=False, default=False,
+                       server_default='0')
 
 def create_poll(event_identifier: Union[int, str, None],
                 name: str, start_time: Union[datetime, None]=None,
                 end_time: Union[datetime, None]=None,
+                tally_method='plurality', seats=1, scheduled=False,
                 session: Union[SQLAlchemySession, None]=None) -> Voter:
+    """Adds a poll. A `scheduled` poll is opened at `start_time` by the
+    scheduler; any open poll is closed by it at `end_time`.
+    """
     session = get_session(session)
+    if tally_method not in TALLY_METHODS:
+        raise DBExceptionInvalidTallyMethod(
+            "Unknown tally method {}, use one of {}".format(
+                tally_method, ', '.join(TALLY_METHODS)))
+    if seats < 1 or (tally_method == 'irv' and seats != 1):
+        raise DBExceptionInvalidTallyMethod(
+            "Invalid number of seats for {}: {}".format(tally_method, seats))
     if start_time is None:
         start_time = datetime.utcnow()
+    if end_time is not None and end_time <= start_time:
+        raise DBExceptionInvalidSchedule(
+            "The poll would close before it opens: {} is not after {}".format(
+                end_time, start_time))
     event = get_event(event_identifier, session=session)
     poll = Poll(event_id=event.event_id, name=name, start_time=start_time,
-                end_time=end_time)
-    add_and_commit(poll, session)
+                end_time=end_time, tally_method=tally_method, seats=seats,
+                scheduled=scheduled)
+    session.add(poll)
+    bump_poll_version(event.event_id, session=session)
+    session.commit()
     return poll
 
 def polls_from_event(event_identifier: Union[int, str, None],
@@ -297,17 +843,26 @@ def most_recent_poll(session: Union[SQLAlchemySession, None]=None):
 
 class PollOption(Base):
     __tablename__ = 'poll_options'
+    __table_args__ = (
+        Index('ix_poll_options_poll', 'poll_id'),
+    )
 
     poll_option_id = Column(Integer, primary_key=True)
     name = Column(String)
     poll_id = Column(ForeignKey('polls.poll_id', ondelete="CASCADE"),
                      nullable=False)
+    # Counter used before the ballot ledger existed. Votes are no longer
+    # added here; `upgrade_tables` turns old counts into ballots.
     total_votes = Column(Integer, default=0)
 
 def create_poll_option(poll_id: int, name: str,
                        session: Union[SQLAlchemySession, None]=None) -> PollOption:
+    session = get_session(session)
     poll_option = PollOption(poll_id=poll_id, name=name)
-    add_and_commit(poll_option, session)
+    session.add(poll_option)
+    event_id = session.query(Poll.event_id).filter_by(poll_id=poll_id).scalar()
+    bump_poll_version(event_id, session=session)
+    session.commit()
     return poll_option
 
 def poll_options_from_poll(poll_id: int,
@@ -324,18 +879,188 @@ def close_poll(poll_id: int, time: Union[datetime, None]=None,
     assert poll.start_time <= time
     poll.end_time = time
     poll.is_open = False
+    # Closed by hand: the scheduler won't open it again
+    poll.scheduled = False
+    bump_poll_version(poll.event_id, session=session)
     session.commit()
 
 def open_poll(poll_id: int, time: Union[datetime, None]=None,
                session: Union[SQLAlchemySession, None]=None):
     session = get_session(session)
+    if time is None:
+        time = datetime.utcnow()
     poll = session.query(Poll).filter_by(poll_id=poll_id).first()
-    poll.end_time = None
+    # Reopening a closed poll; a scheduled end still applies
+    if poll.end_time is not None and poll.end_time <= time:
+        poll.end_time = None
     poll.is_open = True
+    bump_poll_version(poll.event_id, session=session)
     session.commit()
 
+def poll_schedule(session: Union[SQLAlchemySession, None]=None):
+    """Returns the upcoming (time, poll_id) transitions: the start of
+    scheduled polls that haven't opened yet and the end of open polls.
+    Times may be in the past if a transition is overdue.
+    """
+    session = get_session(session)
+    pending = session.query(Poll.start_time, Poll.poll_id).filter(
+        Poll.scheduled == True, Poll.is_open == False)
+    ending = session.query(Poll.end_time, Poll.poll_id).filter(
+        Poll.is_open == True, Poll.end_time != None)
+    return [(time, poll_id) for time, poll_id in pending.union_all(ending)]
+
+def schedule_version(session: Union[SQLAlchemySession, None]=None) -> tuple:
+    """A value that changes whenever any poll is added, opened or closed,
+    in one query over the poll versions.
+    """
+    session = get_session(session)
+    count, total = session.query(
+        func.count(), func.coalesce(func.sum(PollVersion.version), 0)).one()
+    return count, total
+
+def apply_poll_schedule(poll_ids, time: Union[datetime, None]=None,
+                        session: Union[SQLAlchemySession, None]=None) -> list:
+    """Opens the scheduled polls among `poll_ids` whose start time has come
+    and closes those whose end time has passed. Polls that aren't due are
+    left alone, so calling this more often than needed is harmless. Returns
+    the (poll_id, is_open) of the polls that changed.
+    """
+    session = get_session(session)
+    if time is None:
+        time = datetime.utcnow()
+    poll_ids = list(poll_ids)
+    if len(poll_ids) == 0:
+        return []
+    changed = []
+    for poll in session.query(Poll).filter(Poll.poll_id.in_(poll_ids)):
+        ended = poll.end_time is not None and poll.end_time <= time
+        if poll.is_open and ended:
+            poll.is_open = False
+        elif poll.scheduled and not poll.is_open and poll.start_time <= time:
+            if ended:
+                # Its whole time passed while no scheduler was running
+                poll.scheduled = False
+                continue
+            poll.is_open = True
+        else:
+            continue
+        changed.append((poll.poll_id, poll.is_open))
+        bump_poll_version(poll.event_id, session=session)
+    session.commit()
+    return changed
+
+class PollVersion(Base):
+    """Counts changes to the polls and poll options of an event.
+
+    Every function that changes which polls are open or what options they
+    have bumps the version in the same transaction. Caches compare against it,
+    which also picks up changes made by other processes such as the CLI.
+    """
+    __tablename__ = 'poll_versions'
+
+    event_id = Column(ForeignKey('events.event_id', ondelete="CASCADE"),
+                      primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+def bump_poll_version(event_id: int,
+                      session: Union[SQLAlchemySession, None]=None) -> None:
+    """Marks the polls of an event as changed. Does not commit."""
+    session = get_session(session)
+    _transaction_poll_versions(session).pop(event_id, None)
+    updated = session.query(PollVersion).filter_by(event_id=event_id).update(
+        {PollVersion.version: PollVersion.version + 1},
+        synchronize_session=False)
+    if updated == 0:
+        session.add(PollVersion(event_id=event_id, version=1))
+
+def _transaction_poll_versions(session: SQLAlchemySession) -> dict:
+    """event_id -> poll version, as read in the current transaction."""
+    transaction = session.get_transaction()
+    entry = session.info.get('poll_versions')
+    if entry is None or entry[0] is not transaction:
+        entry = (transaction, {})
+        session.info['poll_versions'] = entry
+    return entry[1]
+
+def poll_version(event_id: int,
+                 session: Union[SQLAlchemySession, None]=None) -> int:
+    """Returns the poll version of an event. It is read once per
+    transaction, so a request that looks up several cached things pays for
+    one query.
+    """
+    session = get_session(session)
+    versions = _transaction_poll_versions(session)
+    if event_id in versions:
+        return versions[event_id]
+    version = session.query(PollVersion.version).filter_by(
+        event_id=event_id).scalar()
+    version = version if version is not None else 0
+    # Reading may have begun the transaction
+    _transaction_poll_versions(session)[event_id] = version
+    return version
+
+PollSummary = namedtuple('PollSummary', ['poll_id', 'event_id', 'name',
+                                         'start_time', 'end_time', 'is_open',
+                                         'tally_method', 'seats'])
+PollOptionSummary = namedtuple('PollOptionSummary', ['poll_option_id',
+                                                     'poll_id', 'name'])
+
+# (kind, id) -> (poll version, value)
+_poll_structure = LRUCache(maxsize=POLL_CACHE_SIZE)
+
+def _cached_by_poll_version(key, event_id, load,
+                            session: SQLAlchemySession):
+    version = poll_version(event_id, session=session)
+    entry = _poll_structure.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    value = load()
+    _poll_structure.set(key, (version, value))
+    return value
+
+def open_polls_from_event(event_id: int,
+                          session: Union[SQLAlchemySession, None]=None):
+    """Returns `PollSummary`s of the open polls of an event, most recent
+    first. Cached until the poll version of the event changes.
+    """
+    session = get_session(session)
+
+    def load():
+        polls = session.query(Poll).filter_by(
+            event_id=event_id, is_open=True).order_by(desc('start_time'))
+        return tuple(
+            PollSummary(poll.poll_id, poll.event_id, poll.name,
+                        poll.start_time, poll.end_time, poll.is_open,
+                        poll.tally_method, poll.seats)
+            for poll in polls
+        )
+    return _cached_by_poll_version(('polls', event_id), event_id, load,
+                                   session)
+
+def options_from_poll(poll: Union[Poll, PollSummary],
+                      session: Union[SQLAlchemySession, None]=None):
+    """Returns `PollOptionSummary`s of a poll. Cached until the poll version
+    of its event changes.
+    """
+    session = get_session(session)
+    poll_id = poll.poll_id
+
+    def load():
+        options = session.query(PollOption).filter_by(
+            poll_id=poll_id).order_by(PollOption.poll_option_id)
+        return tuple(
+            PollOptionSummary(option.poll_option_id, option.poll_id,
+                              option.name)
+            for option in options
+        )
+    return _cached_by_poll_version(('options', poll_id), poll.event_id, load,
+                                   session)
+
 class VoteCast(Base):
     __tablename__ = 'votes_cast'
+    __table_args__ = (
+        Index('ix_votes_cast_poll', 'poll_id'),
+    )
 
     voter_id = Column(ForeignKey('voters.voter_id', ondelete="CASCADE"), primary_key=True)
     poll_id = Column(ForeignKey('polls.poll_id', ondelete="CASCADE"), primary_key=True)
@@ -354,109 +1079,519 @@ def has_voter_voted(voter: Voter, poll: Poll,
     else:
         return True
 
-def _cast_vote_into_table(voter: Voter, poll: Poll,
-                          session: Union[SQLAlchemySession, None]=None) -> VoteCast:
-    vote_cast = VoteCast(voter_id=voter.voter_id, poll_id=poll.poll_id)
-    add_and_commit(vote_cast, session)
-    return vote_cast
+def voted_poll_ids(voter: Voter, poll_ids,
+                   session: Union[SQLAlchemySession, None]=None) -> set:
+    """Returns which of `poll_ids` the voter has voted in, in one query."""
+    session = get_session(session)
+    poll_ids = list(poll_ids)
+    if len(poll_ids) == 0:
+        return set()
+    return {poll_id for (poll_id,) in session.query(VoteCast.poll_id).filter(
+        VoteCast.voter_id == voter.voter_id, VoteCast.poll_id.in_(poll_ids))}
+
+def _ballot_entries(poll: Poll, option_votes: dict, abstain: int,
+                    available_votes: int):
+    """Validates a vote for the tally method of the poll. Returns its ballot
+    rows as (poll_option_id, weight, rank) tuples.
+    """
+    if poll.tally_method == 'plurality':
+        total = sum(option_votes.values()) + abstain
+        if total < available_votes:
+            raise VoteExceptionTooFew
+        if total > available_votes:
+            raise VoteExceptionTooMany
+        return [(option_id, votes, None)
+                for option_id, votes in option_votes.items() if votes > 0]
+    # The whole ballot carries the voter's weight. Marking nothing abstains.
+    marked = {option_id: value for option_id, value in option_votes.items()
+              if value > 0}
+    if abstain > 0 and len(marked) > 0:
+        raise VoteExceptionInvalidBallot
+    if poll.tally_method == 'approval':
+        if any(value > 1 for value in marked.values()):
+            raise VoteExceptionInvalidBallot
+        return [(option_id, available_votes, None) for option_id in marked]
+    ranking = sorted(marked, key=marked.get)
+    if sorted(marked.values()) != list(range(1, len(marked) + 1)):
+        raise VoteExceptionInvalidBallot
+    return [(option_id, available_votes, rank)
+            for rank, option_id in enumerate(ranking, start=1)]
 
 def cast_vote(voter: Voter, vote_dict: dict,
               time: Union[datetime, None]=None,
+              poll_id: Union[int, None]=None,
               session: Union[SQLAlchemySession, None]=None) -> None:
     """Casts a vote. The vote_dict is a dictionary of 
-        <poll_option_id>: <number of votes>.
-    
+        <poll_option_id>: <number>.
+
+    What the numbers mean depends on the tally method of the poll:
+        - plurality: votes for the option. The total number of votes must be
+          equal to the number of available votes for a voter. There is a
+          possible option "None" for abstaining.
+        - approval: 1 to approve of the option, 0 otherwise.
+        - irv and stv: 1 for the first choice, 2 for the second and so on, 0
+          for options left unranked. Ranks can't repeat or skip a number.
+    Approval and ranked ballots count as many times as the voter has votes,
+    and abstain if nothing is marked.
+
     The vote is validated:
-        - The total number of votes must be equal to the number of available
-          votes for a voter. There is a possible option "None" for abstaining.
         - The votes must be nonnegative.
-        - The `poll_option_id`s must refer to options from a single poll.
+        - The `poll_option_id`s must refer to options from a single poll, the
+          one with `poll_id` if given. Without `poll_id`, at least one option
+          must be in the vote_dict.
         - The `time` is after the start time of the poll and before the end
           time. If it's not given, it's taken to be `datetime.utcnow()`
         - The voter did not yet cast a vote in this poll.
         - The voter is registered for the event where this poll is.
+
+    The `VoteCast` row and the ballots are written in a single transaction.
+    Ballots are only ever appended, so concurrent votes on the same poll never
+    update the same rows.
     """
     session = get_session(session)
     if time is None:
         time = datetime.utcnow()
     # Validate
-    if sum(vote_dict.values()) < votes_for_voter(voter, session=session):
-        raise VoteExceptionTooFew
-    if sum(vote_dict.values()) > votes_for_voter(voter, session=session):
-        raise VoteExceptionTooMany
+    option_votes, abstain = _parse_vote_dict(vote_dict)
+    poll_ids = set() if poll_id is None else {poll_id}
+    if len(option_votes) > 0:
+        option_polls = session.query(PollOption.poll_option_id,
+                                     PollOption.poll_id).filter(
+            PollOption.poll_option_id.in_(option_votes.keys())).all()
+        poll_ids.update(poll_id for _, poll_id in option_polls)
+        if len(option_polls) != len(option_votes):
+            raise VoteExceptionWrongId
+    if len(poll_ids) != 1:
+        raise VoteExceptionWrongId
+    poll = session.query(Poll).filter_by(poll_id=poll_ids.pop()).first()
+    if poll is None:
+        raise VoteExceptionWrongId
+    _check_can_vote(voter, poll, time)
+    _record_votes(voter, [(poll, option_votes, abstain)], time, session)
+    session.commit()
+
+def cast_votes(voter: Voter, vote_dicts: dict,
+               time: Union[datetime, None]=None,
+               session: Union[SQLAlchemySession, None]=None) -> None:
+    """Casts votes in several polls at once. `vote_dicts` is a dictionary of
+    <poll_id>: <vote_dict>, each validated as by `cast_vote`.
+
+    The votes are written in a single transaction, and only if all of them
+    are valid. An exception for an invalid vote has the `poll_id` it is about
+    in its `poll_id` attribute. Validation takes a fixed number of queries,
+    however many polls there are.
+    """
+    session = get_session(session)
+    if time is None:
+        time = datetime.utcnow()
+    parsed = {}
+    for poll_id, vote_dict in vote_dicts.items():
+        with _about_poll(poll_id):
+            parsed[poll_id] = _parse_vote_dict(vote_dict)
+    option_ids = [option_id for option_votes, _ in parsed.values()
+                  for option_id in option_votes]
+    option_polls = dict(session.query(
+        PollOption.poll_option_id, PollOption.poll_id).filter(
+        PollOption.poll_option_id.in_(option_ids))) if option_ids else {}
+    polls = {poll.poll_id: poll for poll in session.query(Poll).filter(
+        Poll.poll_id.in_(list(parsed)))}
+    votes = []
+    for poll_id, (option_votes, abstain) in parsed.items():
+        with _about_poll(poll_id):
+            poll = polls.get(poll_id)
+            if poll is None or any(option_polls.get(option_id) != poll_id
+                                   for option_id in option_votes):
+                raise VoteExceptionWrongId
+            _check_can_vote(voter, poll, time)
+        votes.append((poll, option_votes, abstain))
+    _record_votes(voter, votes, time, session)
+    session.commit()
+
+@contextmanager
+def _about_poll(poll_id: int):
+    """Tags vote exceptions raised in the block with the poll they are
+    about.
+    """
+    try:
+        yield
+    except (VoteExceptionTooFew, VoteExceptionTooMany, VoteExceptionWrongId,
+            VoteExceptionNegative, VoteExceptionWrongTime,
+            VoteExceptionWrongEvent, VoteExceptionInvalidBallot) as e:
+        e.poll_id = poll_id
+        raise
+
+def _parse_vote_dict(vote_dict: dict):
+    """Returns ({<poll_option_id>: <number>}, abstain votes) of a vote."""
     if any(val < 0 for val in vote_dict.values()):
         raise VoteExceptionNegative
-    poll_id = None
-    for key in vote_dict.keys():
+    abstain = 0
+    option_votes = {}
+    for key, votes in vote_dict.items():
         if key == ABSTAIN_KEY or key is None:
+            abstain += votes
             continue
         try:
             key_int = int(key)
         except ValueError:
             raise VoteExceptionWrongId
-        poll_option = session.query(PollOption).filter_by(poll_option_id=key_int).first()
-        if poll_option is None:
-            raise VoteExceptionWrongId
-        if poll_id is None:
-            poll_id = poll_option.poll_id
-            continue
-        if poll_option.poll_id != poll_id:
-            raise VoteExceptionWrongId
-    poll = session.query(Poll).filter_by(poll_id=poll_id).first()
-    if not is_voter_registered_for_poll(voter, poll, session=session):
+        option_votes[key_int] = option_votes.get(key_int, 0) + votes
+    return option_votes, abstain
+
+def _check_can_vote(voter: Voter, poll: Poll, time: datetime) -> None:
+    if not is_voter_registered_for_poll(voter, poll):
         raise VoteExceptionWrongEvent
-    if has_voter_voted(voter, poll, session=session):
-        raise VoteExceptionAlreadyVoted
     if time < poll.start_time:
         raise VoteExceptionWrongTime
     elif poll.end_time is not None and time >= poll.end_time:
         raise VoteExceptionWrongTime
     elif not poll.is_open:
         raise VoteExceptionWrongTime
-    # Update vote counts
-    for key, votes in vote_dict.items():
-        if key == ABSTAIN_KEY or key is None:
-            continue
-        key_int = int(key)
-        poll_option = session.query(PollOption).filter_by(poll_option_id=key_int).first()
-        poll_option.total_votes += votes
-    _cast_vote_into_table(voter, poll, session=session)
+
+def _record_votes(voter: Voter, votes, time: datetime,
+                  session: SQLAlchemySession) -> None:
+    """Validates and adds the `VoteCast` rows and ballots of (poll, option
+    votes, abstain) `votes`, without committing.
+    """
+    poll_ids = [poll.poll_id for poll, _, _ in votes]
+    # The primary key of `votes_cast` is what stops a voter from voting
+    # twice, even if two requests race each other.
+    session.add_all([VoteCast(voter_id=voter.voter_id, poll_id=poll_id)
+                     for poll_id in poll_ids])
+    try:
+        session.flush()
+    except IntegrityError:
+        session.rollback()
+        error = VoteExceptionAlreadyVoted()
+        if len(votes) > 1:
+            voted = voted_poll_ids(voter, poll_ids, session=session)
+            error.poll_id = min(voted) if voted else None
+        raise error
+    # Read after the insert, in the same transaction, so a proxy added by
+    # another process can't change the weight before the ballots are stored
+    available_votes = votes_for_voter(voter, session=session)
+    if available_votes != voter.vote_weight:
+        # The voting pages showed an old weight, render them anew
+        _voter_contexts.pop(voter.token)
+    entries = []
+    try:
+        for poll, option_votes, abstain in votes:
+            with _about_poll(poll.poll_id):
+                entries.append((poll.poll_id, _ballot_entries(
+                    poll, option_votes, abstain, available_votes)))
+    except Exception:
+        session.rollback()
+        raise
+    ballots = []
+    for poll_id, ballot_entries in entries:
+        # Each vote gets its own cast_id, also when cast together
+        cast_id = gen_token()
+        ballots.extend(
+            {'poll_id': poll_id, 'poll_option_id': option_id,
+             'weight': weight, 'rank': rank, 'cast_time': time,
+             'cast_id': cast_id}
+            for option_id, weight, rank in ballot_entries)
+    if len(ballots) > 0:
+        session.execute(Ballot.__table__.insert(), ballots)
+
+class Ballot(Base):
+    """One row per option that received votes in a cast vote, or that was
+    approved or ranked on it.
+
+    The table is append-only. `cast_id` groups the rows of one vote without
+    saying who cast it.
+    """
+    __tablename__ = 'ballots'
+    __table_args__ = (
+        Index('ix_ballots_poll_option_ballot', 'poll_option_id', 'ballot_id'),
+        Index('ix_ballots_poll_ballot', 'poll_id', 'ballot_id'),
+        # Never reuse ids, the tally checkpoints rely on them increasing
+        {'sqlite_autoincrement': True},
+    )
+
+    ballot_id = Column(Integer, primary_key=True)
+    poll_id = Column(ForeignKey('polls.poll_id', ondelete="CASCADE"),
+                     nullable=False)
+    poll_option_id = Column(ForeignKey('poll_options.poll_option_id',
+                                       ondelete="CASCADE"), nullable=False)
+    weight = Column(Integer, nullable=False)
+    # Position on a ranked ballot, 1 for the first choice. None otherwise.
+    rank = Column(Integer, nullable=True)
+    cast_time = Column(DateTime, nullable=False)
+    cast_id = Column(String, nullable=False)
+
+class TallyCheckpoint(Base):
+    """Votes for an option counted over all ballots up to `last_ballot_id`."""
+    __tablename__ = 'tally_checkpoints'
+    __table_args__ = (
+        Index('ix_tally_checkpoints_poll', 'poll_id'),
+    )
+
+    poll_option_id = Column(ForeignKey('poll_options.poll_option_id',
+                                       ondelete="CASCADE"), primary_key=True)
+    poll_id = Column(ForeignKey('polls.poll_id', ondelete="CASCADE"),
+                     nullable=False)
+    votes = Column(Integer, nullable=False)
+    last_ballot_id = Column(Integer, nullable=False)
+
+# Rows counted by `recount_poll` and `tally_poll`
+_FIRST_CHOICE = func.coalesce(Ballot.rank, 1) == 1
+
+def recount_poll(poll_id: int,
+                 session: Union[SQLAlchemySession, None]=None) -> dict:
+    """Counts a poll from scratch over all of its ballots.
+
+    Returns a dictionary of <poll_option_id>: <votes>. Options without
+    ballots are left out. Ranked polls are counted by first choices; see
+    `electobot.tally` for their result.
+    """
+    session = get_session(session)
+    return dict(
+        session.query(Ballot.poll_option_id, func.sum(Ballot.weight))
+            .filter(Ballot.poll_id == poll_id, _FIRST_CHOICE)
+            .group_by(Ballot.poll_option_id)
+    )
+
+def tally_poll(poll_id: int,
+               session: Union[SQLAlchemySession, None]=None) -> dict:
+    """Counts a poll, only reading ballots added since the last tally.
+
+    Returns the same as `recount_poll`, and moves the checkpoints forward so
+    the next tally has even less to read.
+    """
+    session = get_session(session)
+    # Ballots newer than each option's checkpoint, together with the
+    # checkpoint they were counted against (one consistent read).
+    new_counts = session.query(
+        Ballot.poll_option_id,
+        func.sum(Ballot.weight),
+        func.max(Ballot.ballot_id),
+        func.max(func.coalesce(TallyCheckpoint.votes, 0)),
+        func.max(func.coalesce(TallyCheckpoint.last_ballot_id, 0)),
+    ).outerjoin(
+        TallyCheckpoint,
+        TallyCheckpoint.poll_option_id == Ballot.poll_option_id
+    ).filter(
+        Ballot.poll_id == poll_id, _FIRST_CHOICE,
+        Ballot.ballot_id > func.coalesce(TallyCheckpoint.last_ballot_id, 0)
+    ).group_by(Ballot.poll_option_id).all()
+    counts = {
+        checkpoint.poll_option_id: checkpoint.votes
+        for checkpoint in
+        session.query(TallyCheckpoint).filter_by(poll_id=poll_id)
+    }
+    for option_id, new_votes, _, votes, _ in new_counts:
+        counts[option_id] = votes + new_votes
+    if len(new_counts) > 0:
+        _save_checkpoints(poll_id, new_counts, session=session)
+    return counts
+
+def _save_checkpoints(poll_id, new_counts,
+                      session: SQLAlchemySession) -> None:
+    # Another tally may have moved a checkpoint in the meantime. Both results
+    # are correct, so checkpoints only ever move forward, and losing the race
+    # just means the next tally reads a few more ballots.
+    try:
+        for option_id, new_votes, last_ballot_id, votes, previous_id in new_counts:
+            if previous_id == 0:
+                session.add(TallyCheckpoint(poll_option_id=option_id,
+                                            poll_id=poll_id,
+                                            votes=votes + new_votes,
+                                            last_ballot_id=last_ballot_id))
+            else:
+                session.query(TallyCheckpoint).filter(
+                    TallyCheckpoint.poll_option_id == option_id,
+                    TallyCheckpoint.last_ballot_id < last_ballot_id
+                ).update({TallyCheckpoint.votes: votes + new_votes,
+                          TallyCheckpoint.last_ballot_id: last_ballot_id},
+                         synchronize_session=False)
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+
+class OutboxMessage(Base):
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_next_attempt_time', 'next_attempt_time'),
+    )
+
+    message_id = Column(Integer, primary_key=True)
+    address = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    body = Column(String, nullable=False)
+    create_time = Column(DateTime, nullable=False)
+    # NULL once the message is sent or has run out of attempts
+    next_attempt_time = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    claim_token = Column(String, nullable=True)
+    sent_time = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+
+def enqueue_message(address: str, subject: str, body: str,
+                    session: Union[SQLAlchemySession, None]=None) -> OutboxMessage:
+    """Stores a message in the outbox. It is sent later by the mail worker."""
+    now = datetime.utcnow()
+    message = OutboxMessage(address=address, subject=subject, body=body,
+                            create_time=now, next_attempt_time=now,
+                            attempts=0)
+    add_and_commit(message, session)
+    return message
+
+def claim_due_messages(limit: int, lease: timedelta,
+                       time: Union[datetime, None]=None,
+                       session: Union[SQLAlchemySession, None]=None):
+    """Claims up to `limit` messages that are due to be sent.
+
+    Claimed messages are hidden from other workers for the `lease` duration,
+    so several worker processes can share an outbox. If a worker dies while
+    holding a claim, the messages become due again once the lease expires.
+    """
+    session = get_session(session)
+    if time is None:
+        time = datetime.utcnow()
+    due_ids = [
+        message_id for (message_id,) in
+        session.query(OutboxMessage.message_id)
+            .filter(OutboxMessage.next_attempt_time <= time)
+            .order_by(OutboxMessage.next_attempt_time)
+            .limit(limit)
+    ]
+    if len(due_ids) == 0:
+        session.commit()
+        return []
+    claim_token = gen_token()
+    session.query(OutboxMessage).filter(
+        OutboxMessage.message_id.in_(due_ids),
+        OutboxMessage.next_attempt_time <= time
+    ).update({OutboxMessage.claim_token: claim_token,
+              OutboxMessage.next_attempt_time: time + lease},
+             synchronize_session=False)
+    session.commit()
+    return session.query(OutboxMessage).filter_by(
+        claim_token=claim_token).order_by(OutboxMessage.message_id).all()
+
+def mark_message_sent(message: OutboxMessage,
+                      time: Union[datetime, None]=None,
+                      session: Union[SQLAlchemySession, None]=None) -> None:
+    session = get_session(session)
+    message.attempts += 1
+    message.sent_time = time if time is not None else datetime.utcnow()
+    message.next_attempt_time = None
+    message.claim_token = None
+    session.commit()
+
+def mark_message_failed(message: OutboxMessage, error: str,
+                        retry_time: Union[datetime, None],
+                        session: Union[SQLAlchemySession, None]=None) -> None:
+    """Records a failed attempt. A `retry_time` of None gives up on it."""
+    session = get_session(session)
+    message.attempts += 1
+    message.last_error = error
+    message.next_attempt_time = retry_time
+    message.claim_token = None
     session.commit()
 
 def create_all_tables(engine):
     Base.metadata.create_all(engine)
 
+def _add_missing_columns(engine) -> list:
+    """Adds model columns that existing tables lack. Only columns that are
+    nullable or have a server default can be added. Returns the
+    "table.column" names that were added.
+    """
+    inspector = sqlalchemy_inspect(engine)
+    added = []
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name']
+                    for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table.name, column.name, column.type.compile(engine.dialect))
+            if column.server_default is not None:
+                ddl += " NOT NULL DEFAULT '{}'".format(
+                    column.server_default.arg)
+            elif not column.nullable:
+                logger.error("Cannot add column %s.%s without a default",
+                             table.name, column.name)
+                continue
+            with engine.begin() as connection:
+                connection.execute(text(ddl))
+            added.append('{}.{}'.format(table.name, column.name))
+    return added
+
+def upgrade_tables(engine) -> None:
+    """Brings an existing database up to date with the current models.
+
+    Missing tables, columns and indexes are created. Votes counted in
+    `PollOption.total_votes` before ballots existed are turned into one ballot
+    per option, and new vote weight columns are filled in from the proxies.
+
+    Raises `DBExceptionUpgradeFailed` after the rest of the upgrade if a
+    unique index can't be created because of duplicate rows. Code such as
+    `create_voter` relies on those indexes to refuse duplicates.
+    """
+    create_all_tables(engine)
+    added_columns = _add_missing_columns(engine)
+    failed_indexes = []
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except IntegrityError:
+                failed_indexes.append(
+                    "Could not create unique index {}, the {} table has "
+                    "duplicate rows".format(index.name, table.name))
+    session = create_session(engine)
+    try:
+        legacy_options = session.query(PollOption, Poll).join(
+            Poll, Poll.poll_id == PollOption.poll_id
+        ).filter(
+            PollOption.total_votes > 0,
+            ~session.query(Ballot).filter(
+                Ballot.poll_option_id == PollOption.poll_option_id).exists()
+        ).all()
+        for poll_option, poll in legacy_options:
+            session.add(Ballot(poll_id=poll.poll_id,
+                               poll_option_id=poll_option.poll_option_id,
+                               weight=poll_option.total_votes,
+                               cast_time=poll.end_time or poll.start_time,
+                               cast_id='legacy'))
+        session.commit()
+        if 'voters.vote_weight' in added_columns:
+            check_vote_weights(repair=True, session=session)
+    finally:
+        session.close()
+    if len(failed_indexes) > 0:
+        raise DBExceptionUpgradeFailed('; '.join(failed_indexes))
+
 def render_table(table_obj, session: Union[SQLAlchemySession, None]=None,
                  **tabulate_kwargs):
-    """Renders a string representation of a table."""
+    """Renders a string representation of a table. For large tables, use
+    `electobot.export` instead, which doesn't hold the table in memory.
+    """
     session = get_session(session)
-    query = session.query(table_obj).all()
-    if len(query) == 0:
+    table = table_obj.__table__
+    result = session.execute(table.select())
+    rows = result.all()
+    if len(rows) == 0:
         return "Empty table"
-    cols = [
-        col for col in query[0].__dict__.keys()
-        if col != '_sa_instance_state'
-    ]
-    rows = [
-        [
-            getattr(elem, col) for col in cols
-        ]
-        for elem in query
-    ]
-    return tabulate(rows, headers=cols, **tabulate_kwargs)
+    return tabulate(rows, headers=list(result.keys()), **tabulate_kwargs)
 
-def votes_to_table(poll_id, session: Union[SQLAlchemySession, None]=None,
-                  **tabulate_kwargs):
+def votes_to_table(poll_id, recount=False,
+                   session: Union[SQLAlchemySession, None]=None,
+                   **tabulate_kwargs):
+    session = get_session(session)
     poll_options = poll_options_from_poll(poll_id, session=session)
-    cols = [
-        'name',
-        'total_votes'
-    ]
+    if recount:
+        counts = recount_poll(poll_id, session=session)
+    else:
+        counts = tally_poll(poll_id, session=session)
     nice_cols = ['Option', 'Votes']
     rows = []
     for poll_option in poll_options:
         rows.append([
-            getattr(poll_option, col)
-            for col in cols
+            poll_option.name,
+            counts.get(poll_option.poll_option_id, 0)
         ])
     return tabulate(rows, headers=nice_cols, **tabulate_kwargs)
@@ -0,0 +1,176 @@
+"""
+Email patterns restrict who can register for an event. They are regular
+expressions entered by organizers and matched against user input, so they are
+checked for constructs that can make matching take exponential or high
+polynomial time, and inputs are capped in length.
+"""
+import logging
+import re
+
+try:
+    from re import _parser as sre_parse, _compiler as sre_compile
+except ImportError: # Python < 3.11
+    import sre_parse, sre_compile
+
+from .cache import LRUCache
+from .exceptions import DBExceptionInvalidEmailPattern
+
+logger = logging.getLogger('email_pattern')
+
+# Longest address allowed by RFC 5321
+MAX_EMAIL_LENGTH = 254
+# Each unbounded repeat can multiply the backtracking work by the input length
+MAX_UNBOUNDED_REPEATS = 3
+# Of those, next to each other and over the same characters, like `\w*\w*`
+MAX_OVERLAPPING_REPEATS = 2
+
+_REPEATS = tuple(op for op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                               getattr(sre_parse, 'POSSESSIVE_REPEAT', None))
+                 if op is not None)
+_BACKREFERENCES = (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS)
+# Items that match exactly one character
+_SINGLE_CHARACTERS = (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.IN,
+                      sre_parse.ANY)
+# Characters tried to see whether two repeats can match the same text
+_SAMPLE_CHARACTERS = [chr(i) for i in range(0x100)] + ['\u0101', '\u03b1',
+                                                        '\u0430', '\u4e00']
+
+def _repeat(op, av):
+    """The (max, body) of a repeat, also when it is alone in a group, or
+    None.
+    """
+    while op == sre_parse.SUBPATTERN and len(av[-1]) == 1:
+        op, av = av[-1][0]
+    if op in _REPEATS and av[1] > 1:
+        return av[1], av[2]
+    return None
+
+def _overlap(body, other_body) -> bool:
+    """Whether the bodies of two repeats match some character in common."""
+    first = sre_compile.compile(body)
+    second = sre_compile.compile(other_body)
+    return any(first.fullmatch(c) and second.fullmatch(c)
+               for c in _SAMPLE_CHARACTERS)
+
+def _repeat_bodies(parsed):
+    """Yields the bodies of all repeats in a pattern, also nested ones."""
+    for op, av in parsed:
+        if op in _REPEATS:
+            yield av[2]
+        for subpattern in _subpatterns(op, av):
+            yield from _repeat_bodies(subpattern)
+
+def _delimited(body) -> bool:
+    """Whether every pass of a repeated `body` must match a character that
+    none of the repeats inside it can, like the dot in `(\w+\.)+`. The text
+    can then be split between the passes in one way only.
+    """
+    while len(body) == 1 and body[0][0] == sre_parse.SUBPATTERN:
+        body = body[0][1][-1]
+    inner = list(_repeat_bodies(body))
+    return any(
+        op in _SINGLE_CHARACTERS and not any(
+            _overlap(sre_parse.SubPattern(body.state, [(op, av)]), other)
+            for other in inner)
+        for op, av in body)
+
+def _subpatterns(op, av):
+    """Yields the nested patterns of one parsed regex item."""
+    if op in _REPEATS:
+        yield av[2]
+    elif op == sre_parse.SUBPATTERN:
+        yield av[-1]
+    elif op == sre_parse.BRANCH:
+        yield from av[1]
+    elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        yield av[1]
+    elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+        yield av
+
+def _check(parsed, inside_repeat: bool, delimited=False) -> int:
+    """Raises if the pattern is unsafe, returns its number of unbounded
+    repeats.
+    """
+    unbounded = 0
+    previous = None
+    # Unbounded repeats in a row that match the same characters, like
+    # `\w*\w*\w*`: every way of splitting the text between them is tried,
+    # which multiplies the work by the input length per repeat
+    overlapping = 0
+    for op, av in parsed:
+        repeat = _repeat(op, av)
+        if (repeat is None or previous is None
+                or not _overlap(previous[1], repeat[1])):
+            overlapping = 0
+        if repeat is not None and repeat[0] == sre_parse.MAXREPEAT:
+            overlapping += 1
+            if overlapping > MAX_OVERLAPPING_REPEATS:
+                raise DBExceptionInvalidEmailPattern(
+                    "At most {} adjacent repeats that match the same "
+                    "characters are allowed".format(MAX_OVERLAPPING_REPEATS))
+        previous = repeat
+        if op in _BACKREFERENCES:
+            raise DBExceptionInvalidEmailPattern(
+                "Backreferences are not allowed")
+        if op == sre_parse.BRANCH and inside_repeat:
+            raise DBExceptionInvalidEmailPattern(
+                "Alternatives inside a repeated group are not allowed")
+        repeats = op in _REPEATS and av[1] > 1
+        if repeats:
+            if inside_repeat and not delimited:
+                raise DBExceptionInvalidEmailPattern(
+                    "Nested quantifiers are not allowed")
+            if av[1] == sre_parse.MAXREPEAT:
+                unbounded += 1
+        for subpattern in _subpatterns(op, av):
+            unbounded += _check(
+                subpattern, inside_repeat or repeats,
+                _delimited(av[2]) if repeats else delimited)
+    return unbounded
+
+def compile_email_pattern(pattern: str):
+    """Compiles an email pattern, raising `DBExceptionInvalidEmailPattern` if
+    it is not a valid regex or could be slow to match.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+        compiled = re.compile(pattern)
+    except re.error as e:
+        raise DBExceptionInvalidEmailPattern(
+            "Not a valid regular expression: {}".format(e))
+    if _check(parsed, inside_repeat=False) > MAX_UNBOUNDED_REPEATS:
+        raise DBExceptionInvalidEmailPattern(
+            "At most {} unbounded repeats (*, +) are allowed".format(
+                MAX_UNBOUNDED_REPEATS))
+    return compiled
+
+# (event_id, pattern) -> compiled pattern, or None if it is unsafe
+_compiled_patterns = LRUCache(maxsize=256)
+
+def email_allowed(event, email: str) -> bool:
+    """Whether `email` may register for `event`.
+
+    Compiled patterns are cached per event. Patterns stored before they were
+    validated are still used if unsafe, so registration keeps working; `setup`
+    reports them.
+    """
+    if email is None or len(email) > MAX_EMAIL_LENGTH:
+        return False
+    key = (event.event_id, event.email_pattern)
+    compiled = _compiled_patterns.get(key, False)
+    if compiled is False:
+        try:
+            compiled = compile_email_pattern(event.email_pattern)
+        except DBExceptionInvalidEmailPattern as e:
+            logger.warning("Email pattern of event %s is unsafe: %s",
+                           event.event_id, e)
+            try:
+                compiled = re.compile(event.email_pattern)
+            except re.error:
+                compiled = None
+        _compiled_patterns.set(key, compiled)
+    return compiled is not None and compiled.search(email) is not None
+
+def forget_event_pattern(event_id: int) -> None:
+    """Drops the cached pattern of a deleted event."""
+    _compiled_patterns.discard_keys_where(lambda key: key[0] == event_id)
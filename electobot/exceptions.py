@@ -21,5 +21,22 @@ class VoteExceptionWrongEvent(Exception):
 class VoteExceptionAlreadyVoted(Exception):
     """Raised when a voter tries to vote again."""
 
+class VoteExceptionInvalidBallot(Exception):
+    """Raised when an approval or ranked ballot is malformed, e.g. ranks that
+    repeat or skip a number."""
+
 class DBExceptionEmailAlreadyUsed(Exception):
     """Email already used."""
+
+class DBExceptionInvalidEmailPattern(Exception):
+    """Email pattern is not a valid regex, or could take too long to match."""
+
+class DBExceptionInvalidTallyMethod(Exception):
+    """Unknown tally method, or a number of seats it can't fill."""
+
+class DBExceptionInvalidSchedule(Exception):
+    """A poll scheduled to close before it opens."""
+
+class DBExceptionUpgradeFailed(Exception):
+    """The database can't be fully upgraded, e.g. because duplicate rows keep
+    a unique index from being created."""
@@ -0,0 +1,78 @@
+"""
+Exports tables and the ballots of a poll as CSV or JSON Lines.
+
+Rows are selected as plain columns, without building ORM objects, fetched in
+batches (from a server-side cursor on databases that have them) and written
+as they arrive, so memory use stays the same however large the table is.
+"""
+import csv
+import json
+from datetime import date, datetime
+from typing import Union
+
+from sqlalchemy import select
+from sqlalchemy.orm.session import Session as SQLAlchemySession
+
+from .database import get_session, Ballot, PollOption
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+BATCH_SIZE = 1000
+
+def _plain_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def write_rows(columns, rows, file_, format='csv') -> int:
+    """Writes `rows` of `columns` to `file_` one by one. Returns how many
+    rows were written.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: {}".format(format))
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(file_)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_plain_value(value) for value in row])
+            count += 1
+    else:
+        for row in rows:
+            file_.write(json.dumps(dict(zip(columns, map(_plain_value, row))))
+                        + '\n')
+            count += 1
+    return count
+
+def export_query(statement, file_, format='csv', batch_size=BATCH_SIZE,
+                 session: Union[SQLAlchemySession, None]=None) -> int:
+    """Streams the rows of a Core select to `file_`."""
+    session = get_session(session)
+    result = session.execute(statement,
+                             execution_options={'stream_results': True})
+    rows = (row for batch in result.partitions(batch_size) for row in batch)
+    return write_rows(list(result.keys()), rows, file_, format=format)
+
+def export_table(table_obj, file_, format='csv', batch_size=BATCH_SIZE,
+                 session: Union[SQLAlchemySession, None]=None) -> int:
+    """Streams every row of a model's table, in primary key order."""
+    table = table_obj.__table__
+    statement = select(*table.c).order_by(*table.primary_key.columns)
+    return export_query(statement, file_, format=format,
+                        batch_size=batch_size, session=session)
+
+def export_poll(poll_id: int, file_, format='csv', batch_size=BATCH_SIZE,
+                session: Union[SQLAlchemySession, None]=None) -> int:
+    """Streams the ballots of a poll with the names of their options, for
+    auditing a result. Ballots don't say who cast them.
+    """
+    ballots = Ballot.__table__.c
+    options = PollOption.__table__.c
+    statement = select(
+        ballots.ballot_id, ballots.cast_id, ballots.poll_option_id,
+        options.name.label('option_name'), ballots.weight, ballots.rank,
+        ballots.cast_time
+    ).join_from(Ballot.__table__, PollOption.__table__,
+                ballots.poll_option_id == options.poll_option_id).where(
+        ballots.poll_id == poll_id).order_by(ballots.ballot_id)
+    return export_query(statement, file_, format=format,
+                        batch_size=batch_size, session=session)
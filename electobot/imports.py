@@ -0,0 +1,33 @@
+"""
+Reading member lists and proxy forms from CSV files.
+"""
+import csv
+
+def read_csv_rows(file_, columns):
+    """Yields a tuple with the values of `columns` for every row of a CSV file.
+
+    If the first row names all of `columns` (in any order, ignoring case), it
+    is used as the header. Otherwise every row is taken to have exactly these
+    columns in this order. Values are stripped and blank rows are skipped.
+    """
+    reader = csv.reader(file_)
+    first_row = next(reader, None)
+    if first_row is None:
+        return
+    header = [cell.strip().lower() for cell in first_row]
+    if all(column in header for column in columns):
+        indices = [header.index(column) for column in columns]
+        rows = reader
+    else:
+        indices = list(range(len(columns)))
+        rows = _prepend(first_row, reader)
+    for row in rows:
+        if not any(cell.strip() for cell in row):
+            continue
+        if len(row) <= max(indices):
+            raise ValueError("Row has too few columns: {}".format(row))
+        yield tuple(row[index].strip() for index in indices)
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
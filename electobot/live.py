@@ -0,0 +1,177 @@
+"""
+Live poll results for organizers. All clients watching a poll share one
+`PollWatcher`, which checks a cheap change counter at most once per interval
+and only recounts when it moved. A watcher is dropped when its last client
+leaves.
+"""
+import logging
+import threading
+import time
+from typing import Union
+
+from sqlalchemy import func
+
+from .database import (create_default_session, create_session, get_engine,
+                       tally_poll, Poll, PollOption, Voter, VoteCast, Ballot)
+
+logger = logging.getLogger('live')
+
+def poll_change_counter(poll_id: int, session):
+    """Returns a value that changes whenever a vote is cast in the poll, a
+    voter registers for its event or the poll opens or closes.
+    """
+    poll = session.query(Poll.event_id, Poll.is_open).filter_by(
+        poll_id=poll_id).first()
+    if poll is None:
+        return None
+    votes_cast = session.query(func.count()).select_from(VoteCast).filter(
+        VoteCast.poll_id == poll_id).scalar_subquery()
+    last_ballot = session.query(func.max(Ballot.ballot_id)).filter(
+        Ballot.poll_id == poll_id).scalar_subquery()
+    registered = session.query(func.count()).select_from(Voter).filter(
+        Voter.event_id == poll.event_id).scalar_subquery()
+    return (poll.is_open,) + tuple(
+        session.query(votes_cast, last_ballot, registered).one())
+
+def poll_snapshot(poll_id: int, session) -> dict:
+    """Current turnout and results of a poll, ready to be sent as JSON."""
+    poll = session.query(Poll).filter_by(poll_id=poll_id).first()
+    # First choices for ranked polls, whose rounds are only counted at the end
+    counts = tally_poll(poll_id, session=session)
+    options = session.query(PollOption.poll_option_id, PollOption.name).filter_by(
+        poll_id=poll_id).order_by(PollOption.poll_option_id)
+    turnout = session.query(func.count()).select_from(VoteCast).filter(
+        VoteCast.poll_id == poll_id).scalar()
+    registered = session.query(func.count()).select_from(Voter).filter(
+        Voter.event_id == poll.event_id).scalar()
+    return {
+        'poll_id': poll.poll_id,
+        'name': poll.name,
+        'is_open': bool(poll.is_open),
+        'tally_method': poll.tally_method,
+        'turnout': turnout,
+        'registered': registered,
+        'options': [
+            {'poll_option_id': option_id, 'name': name,
+             'votes': counts.get(option_id, 0)}
+            for option_id, name in options
+        ],
+    }
+
+class PollWatcher:
+    """Keeps the latest snapshot of one poll for any number of clients.
+
+    There is no background thread: whichever client is waiting when the
+    interval has passed checks the change counter for everybody, and the
+    others wait for its result.
+    """
+
+    def __init__(self, poll_id: int, interval=1.0,
+                 session_factory=create_default_session):
+        self.poll_id = poll_id
+        self.interval = interval
+        self.session_factory = session_factory
+        self.version = 0
+        self.snapshot = None
+        # Clients between `watch_poll` and `stop_watching`
+        self.subscribers = 0
+        self._counter = None
+        self._last_check = None
+        self._checking = False
+        self._condition = threading.Condition()
+
+    def _check(self):
+        session = self.session_factory()
+        try:
+            counter = poll_change_counter(self.poll_id, session)
+            if counter is None or counter == self._counter:
+                return
+            snapshot = poll_snapshot(self.poll_id, session)
+        finally:
+            session.close()
+        with self._condition:
+            self._counter = counter
+            self.snapshot = snapshot
+            self.version += 1
+
+    def changed(self):
+        """Makes the next wait check the database right away."""
+        with self._condition:
+            self._last_check = None
+            self._condition.notify_all()
+
+    def wait(self, seen_version: int, timeout: float):
+        """Returns (version, snapshot) once the version differs from
+        `seen_version`, or after `timeout` seconds with the version unchanged.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self.version != seen_version:
+                    return self.version, self.snapshot
+                now = time.monotonic()
+                if now >= deadline:
+                    return self.version, self.snapshot
+                check_due = not self._checking and (
+                    self._last_check is None
+                    or now - self._last_check >= self.interval)
+                if check_due:
+                    self._checking = True
+                else:
+                    self._condition.wait(min(deadline - now, self.interval))
+                    continue
+            try:
+                self._check()
+            except Exception:
+                logger.exception("Checking poll %s failed", self.poll_id)
+            finally:
+                with self._condition:
+                    self._checking = False
+                    self._last_check = time.monotonic()
+                    self._condition.notify_all()
+
+# (database url, poll_id) -> PollWatcher, while anyone watches the poll
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+def poll_changed(poll_id: int) -> None:
+    """Makes the watchers of a poll check it right away, e.g. after it
+    opened or closed.
+    """
+    with _watchers_lock:
+        watchers = [watcher for (_, watched_id), watcher in _watchers.items()
+                    if watched_id == poll_id]
+    for watcher in watchers:
+        watcher.changed()
+
+def watch_poll(poll_id: int, interval=1.0,
+               max_subscribers: Union[int, None]=None
+               ) -> Union[PollWatcher, None]:
+    """Returns the shared watcher of a poll in the current database. Call
+    `stop_watching` with it when done.
+
+    Returns None if `max_subscribers` clients are watching polls already.
+    """
+    engine = get_engine()
+    key = (str(engine.url), poll_id)
+    with _watchers_lock:
+        if max_subscribers is not None and sum(
+                watcher.subscribers
+                for watcher in _watchers.values()) >= max_subscribers:
+            return None
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = PollWatcher(poll_id, interval=interval,
+                                  session_factory=lambda: create_session(engine))
+            _watchers[key] = watcher
+        watcher.subscribers += 1
+        return watcher
+
+def stop_watching(watcher: PollWatcher) -> None:
+    """Drops the watcher once its last client stopped watching."""
+    with _watchers_lock:
+        watcher.subscribers -= 1
+        if watcher.subscribers == 0:
+            for key, kept in list(_watchers.items()):
+                if kept is watcher:
+                    del _watchers[key]
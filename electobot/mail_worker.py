@@ -0,0 +1,130 @@
+"""
+Background delivery of the outbox. Requests only enqueue messages; a
+`MailWorker` sends them in batches over one SMTP connection and retries
+failures with exponential backoff.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .database import (create_default_session, claim_due_messages,
+                       mark_message_sent, mark_message_failed)
+from .send_email import MailSender, read_credentials
+from .metrics import EMAILS
+
+logger = logging.getLogger('mail_worker')
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+RETRY_BASE = timedelta(seconds=5)
+RETRY_MAX = timedelta(minutes=10)
+CLAIM_LEASE = timedelta(minutes=5)
+
+def retry_delay(attempts: int) -> timedelta:
+    """Backoff before the next attempt, after `attempts` failed ones."""
+    exponent = min(max(attempts - 1, 0), 16)
+    return min(RETRY_BASE * 2 ** exponent, RETRY_MAX)
+
+def default_sender():
+    return MailSender(read_credentials())
+
+class MailWorker(threading.Thread):
+    """Sends queued outbox messages until stopped.
+
+    `sender_factory` returns an object with `send(address, subject, message)`
+    and `close()`, normally a `MailSender`. The sender is kept between batches,
+    so the SMTP connection stays open while there is mail to send. It is
+    closed after a failed send or `idle_timeout` seconds without mail.
+    """
+
+    def __init__(self, session_factory=create_default_session,
+                 sender_factory=default_sender, batch_size=BATCH_SIZE,
+                 poll_interval=2.0, idle_timeout=30.0,
+                 max_attempts=MAX_ATTEMPTS):
+        super().__init__(name='electobot-mail-worker', daemon=True)
+        self.session_factory = session_factory
+        self.sender_factory = sender_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.max_attempts = max_attempts
+        self._sender = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def notify(self):
+        """Wakes the worker up, e.g. right after a message was enqueued."""
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def _close_sender(self):
+        if self._sender is not None:
+            self._sender.close()
+            self._sender = None
+
+    def process_batch(self, now=None) -> int:
+        """Sends one batch of due messages. Returns how many were claimed."""
+        session = self.session_factory()
+        try:
+            messages = claim_due_messages(self.batch_size, CLAIM_LEASE,
+                                          time=now, session=session)
+            for message in messages:
+                try:
+                    if self._sender is None:
+                        self._sender = self.sender_factory()
+                    self._sender.send(message.address, message.subject,
+                                      message.body)
+                except Exception as e:
+                    logger.warning("Sending message %s to %s failed: %s",
+                                   message.message_id, message.address, e)
+                    self._close_sender()
+                    EMAILS.inc(result='failed')
+                    attempts = message.attempts + 1
+                    if attempts >= self.max_attempts:
+                        logger.error("Giving up on message %s",
+                                     message.message_id)
+                        retry_time = None
+                    else:
+                        retry_time = datetime.utcnow() + retry_delay(attempts)
+                    mark_message_failed(message, repr(e), retry_time,
+                                        session=session)
+                else:
+                    EMAILS.inc(result='sent')
+                    mark_message_sent(message, session=session)
+            return len(messages)
+        finally:
+            session.close()
+
+    def flush(self) -> None:
+        """Sends everything that is currently due, then disconnects."""
+        try:
+            while self.process_batch() == self.batch_size:
+                pass
+        finally:
+            self._close_sender()
+
+    def run(self):
+        idle_since = None
+        try:
+            while not self._stopped.is_set():
+                try:
+                    claimed = self.process_batch()
+                except Exception:
+                    logger.exception("Mail worker batch failed")
+                    claimed = 0
+                if claimed > 0:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since > self.idle_timeout:
+                    # The server would drop an idle session anyway
+                    self._close_sender()
+                if claimed < self.batch_size:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+        finally:
+            self._close_sender()
@@ -8,7 +8,9 @@ from sqlalchemy.orm.session import Session as SQLAlchemySession
 from .database import (event_from_identifier, get_session, Voter,
                        polls_from_event, voter_from_token, polls_from_event,
                        Poll, proxies_from_voter, votes_for_voter,
-                       poll_options_from_poll)
+                       poll_options_from_poll, voter_context_from_token,
+                       VoterContext, open_polls_from_event, options_from_poll,
+                       PollSummary, poll_from_id, ABSTAIN_KEY)
 
 # TODO: Implement things
 
@@ -39,27 +41,51 @@ def event_register_url(event_identifier: Union[int, str, None],
 def voting_url(voter: Voter,
                session: Union[SQLAlchemySession, None]=None):
     session = get_session(session)
-    token = voter.token
+    return voting_url_from_token(voter.token)
+
+def voting_url_from_token(token: str):
     return form_url('vote', {'token': token})
 
 def poll_url(voter_token, poll_id):
     return form_url('vote', {'token': voter_token,
                              'poll_id': poll_id})
 
+def ballot_url(voter_token):
+    """The page to vote in all open polls at once."""
+    return form_url('ballot', {'token': voter_token})
+
 def poll_list(voter_token,
                    session: Union[SQLAlchemySession, None]=None):
     # list of polls in the event that the voter is taking part in
     session = get_session(session)
-    voter = voter_from_token(voter_token, session=session)
+    voter = voter_context_from_token(voter_token, session=session)
     # whether this voter exists should have been validated already
-    polls = polls_from_event(voter.event_id, session=session)
+    polls = open_polls_from_event(voter.event_id, session=session)
     list_entries = [{"href": poll_url(voter_token, poll.poll_id),
                           "name": poll.name}
         for poll in polls
-        if poll.is_open
     ]
     return list_entries
 
+def voter_poll(voter: VoterContext, poll_id,
+               session: Union[SQLAlchemySession, None]=None):
+    """Returns the poll with id `poll_id` in the voter's event, or None.
+
+    Open polls come from the poll cache; only other polls are queried.
+    """
+    session = get_session(session)
+    try:
+        int_id = int(poll_id)
+    except (TypeError, ValueError):
+        return None
+    for poll in open_polls_from_event(voter.event_id, session=session):
+        if poll.poll_id == int_id:
+            return poll
+    poll = poll_from_id(int_id, session=session)
+    if poll is None or poll.event_id != voter.event_id:
+        return None
+    return poll
+
 def poll_list_html(voter_token,
                    session: Union[SQLAlchemySession, None]=None):
     # list of polls in the event that the voter is taking part in
@@ -82,25 +108,36 @@ def _vote_option_entry(poll_option_id_str, poll_option_name, vote_count):
 """.format(poll_option_id_str, poll_option_name, poll_option_id_str,
            poll_option_id_str, vote_count)
 
-def poll_options(voter: Voter, poll: Poll,
-                       session: Union[SQLAlchemySession, None]=None):
-    proxies = proxies_from_voter(voter, session=session)
-    if len(proxies) > 0:
-        proxy_str = "You have {} proxy votes. You are voting for yourself and for: {}. ".format(
-            len(proxies), ", ".join([
-                proxy.email for proxy in proxies
-            ]))
+def proxy_message(voter: VoterContext) -> str:
+    proxy_emails = voter.proxy_emails
+    if len(proxy_emails) > 0:
+        return "You have {} proxy votes. You are voting for yourself and for: {}. ".format(
+            len(proxy_emails), ", ".join(proxy_emails))
     else:
-        proxy_str = "You have no proxy votes. "
-    vote_count = votes_for_voter(voter, session=session)
-    if vote_count == 1:
+        return "You have no proxy votes. "
+
+def vote_count_message(voter: VoterContext,
+                       poll: Union[Poll, PollSummary]) -> str:
+    vote_count = voter.vote_weight
+    if poll.tally_method != 'plurality':
+        # The whole ballot carries the voter's weight
+        if vote_count == 1:
+            vote_count_str = "So, your ballot counts once."
+        else:
+            vote_count_str = "So, your ballot counts {} times.".format(
+                vote_count)
+    elif vote_count == 1:
         vote_count_str = "So, you have only 1 vote."
     else:
         vote_count_str = "So, you have {} votes.".format(vote_count)
-    proxy_message = proxy_str + vote_count_str
-    option_list = poll_options_from_poll(poll.poll_id, session=session)
+    return vote_count_str
+
+def poll_options(voter: VoterContext, poll: Union[Poll, PollSummary],
+                       session: Union[SQLAlchemySession, None]=None):
+    message = proxy_message(voter) + vote_count_message(voter, poll)
+    option_list = options_from_poll(poll, session=session)
     
-    return proxy_message, vote_count, option_list
+    return message, voter.vote_weight, option_list
 
 def poll_options_html(voter: Voter, poll: Poll,
                        session: Union[SQLAlchemySession, None]=None):
@@ -142,6 +179,42 @@ def _parse_vote_form_key(vote_form_key):
     else:
         raise ValueError('Invalid string form')
 
+def parse_vote_json(body):
+    """Parses a JSON ballot, `{"<poll_option_id>": votes, "abstain": votes}`,
+    into the vote dict of `cast_vote`; for approval and ranked polls the
+    values are approvals and ranks. Raises ValueError if it is malformed.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Expected a JSON object of option ids to votes")
+    vote_entries = {}
+    for key, value in body.items():
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError("Votes for {} must be an integer".format(key))
+        if key == ABSTAIN_KEY:
+            vote_entries[ABSTAIN_KEY] = value
+            continue
+        try:
+            vote_entries[int(key)] = value
+        except ValueError:
+            raise ValueError("Unknown option id: {}".format(key))
+    return vote_entries
+
+def parse_ballots_json(body):
+    """Parses `{"<poll_id>": <ballot>}`, with ballots as for
+    `parse_vote_json`, into the vote dicts of `cast_votes`. Raises
+    ValueError if it is malformed.
+    """
+    if not isinstance(body, dict) or len(body) == 0:
+        raise ValueError("Expected a JSON object of poll ids to ballots")
+    vote_dicts = {}
+    for key, ballot in body.items():
+        try:
+            poll_id = int(key)
+        except ValueError:
+            raise ValueError("Unknown poll id: {}".format(key))
+        vote_dicts[poll_id] = parse_vote_json(ballot)
+    return vote_dicts
+
 def parse_vote_form(vote_form):
     vote_entries = {}
     for key, value in vote_form.items():
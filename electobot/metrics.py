@@ -0,0 +1,251 @@
+"""
+Counters and histograms for the `/metrics` endpoint, in the Prometheus text
+format.
+
+Updating a metric only touches a dict in this process. When METRICS_DIR is
+set, every process also writes its values to its own file there (at most once
+per `flush_interval`), and the endpoint adds up the files of all processes, so
+each uWSGI worker reports the totals of all of them. Empty the directory when
+redeploying, as files of stopped processes are kept on purpose: their counts
+are still part of the totals.
+"""
+import atexit
+import bisect
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger('metrics')
+
+METRICS_DIR = os.environ.get('ELECTOBOT_METRICS_DIR')
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format_bound(le) -> str:
+    return '+Inf' if le == math.inf else repr(float(le))
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels) + '}'
+
+class Counter:
+    def __init__(self, registry, name: str, labelnames):
+        self._registry = registry
+        self.name = name
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, amount=1, **labels) -> None:
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        self._registry._add(self.name + '_total', key, amount)
+
+    @contextmanager
+    def count_exceptions(self, label: str):
+        """Counts exceptions raised in the block, labelled by their class
+        name, and re-raises them.
+        """
+        try:
+            yield
+        except Exception as e:
+            self.inc(**{label: type(e).__name__})
+            raise
+
+class Histogram:
+    def __init__(self, registry, name: str, labelnames, buckets):
+        self._registry = registry
+        self.name = name
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        # Buckets are stored per interval and only made cumulative when
+        # rendered, so an observation is three additions
+        le = self.buckets[bisect.bisect_left(self.buckets, value)]
+        self._registry._add(self.name + '_bucket', key + (('le', le),), 1)
+        self._registry._add(self.name + '_sum', key, value)
+        self._registry._add(self.name + '_count', key, 1)
+
+class Registry:
+    """Holds the metrics of this process and renders those of all processes
+    writing to `directory`.
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._file_name = None
+        self._last_flush = time.monotonic()
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        metric = Counter(self, name, labelnames)
+        self._metrics[name] = ('counter', documentation, metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames=(),
+                  buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(self, name, labelnames, buckets)
+        self._metrics[name] = ('histogram', documentation, metric)
+        return metric
+
+    def _add(self, sample: str, labels: tuple, amount: float) -> None:
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._forked()
+            self._values[(sample, labels)] += amount
+            flush_due = (self.directory is not None and time.monotonic()
+                         - self._last_flush >= self.flush_interval)
+        if flush_due:
+            self.flush()
+
+    def _forked(self) -> None:
+        """A forked worker starts from zero, in a file of its own; what the
+        parent counted is in the parent's file.
+        """
+        self._pid = os.getpid()
+        self._file_name = None
+        self._values = defaultdict(float)
+
+    def _path(self) -> str:
+        if self._file_name is None:
+            self._file_name = '{}-{}.json'.format(self._pid,
+                                                  uuid.uuid4().hex[:8])
+        return os.path.join(self.directory, self._file_name)
+
+    def flush(self) -> None:
+        """Writes the values of this process to its file."""
+        if self.directory is None:
+            return
+        with self._flush_lock:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    self._forked()
+                samples = [[sample, [list(label) for label in labels], value]
+                           for (sample, labels), value in self._values.items()]
+                path = self._path()
+                self._last_flush = time.monotonic()
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                                 suffix='.tmp')
+                with os.fdopen(fd, 'w') as file_:
+                    json.dump(samples, file_)
+                os.replace(temp_path, path)
+            except OSError:
+                logger.exception("Writing metrics to %s failed", path)
+
+    def collect(self) -> dict:
+        """(sample, labels) -> value, summed over all processes."""
+        if self.directory is None:
+            with self._lock:
+                return dict(self._values)
+        self.flush()
+        totals = defaultdict(float)
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as file_:
+                    samples = json.load(file_)
+            except (OSError, ValueError):
+                logger.warning("Skipping unreadable metrics file %s", name)
+                continue
+            for sample, labels, value in samples:
+                totals[(sample, tuple(tuple(label) for label in labels))] += value
+        return totals
+
+    def exposition(self) -> str:
+        """All metrics in the Prometheus text format."""
+        totals = _by_sample(self.collect())
+        lines = []
+        for name, (kind, documentation, metric) in sorted(self._metrics.items()):
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == 'counter':
+                for labels, value in totals.get(name + '_total', []):
+                    lines.append('{}_total{} {}'.format(
+                        name, _format_labels(labels), _format_value(value)))
+            else:
+                lines.extend(_histogram_lines(metric, totals))
+        return '\n'.join(lines) + '\n'
+
+def _by_sample(values: dict) -> dict:
+    """sample -> [(labels, value)], sorted by labels."""
+    by_sample = defaultdict(list)
+    for (sample, labels), value in values.items():
+        by_sample[sample].append((labels, value))
+    for samples in by_sample.values():
+        samples.sort(key=lambda item: [(name, str(value))
+                                       for name, value in item[0]])
+    return by_sample
+
+def _histogram_lines(metric: Histogram, totals: dict):
+    buckets = defaultdict(dict)
+    for labels, value in totals.get(metric.name + '_bucket', []):
+        buckets[labels[:-1]][labels[-1][1]] = value
+    sums = dict(totals.get(metric.name + '_sum', []))
+    for labels, value in totals.get(metric.name + '_count', []):
+        cumulative = 0
+        for le in metric.buckets:
+            cumulative += buckets[labels].get(le, 0)
+            yield '{}_bucket{} {}'.format(
+                metric.name,
+                _format_labels(labels + (('le', _format_bound(le)),)),
+                _format_value(cumulative))
+        yield '{}_sum{} {}'.format(metric.name, _format_labels(labels),
+                                   _format_value(sums[labels]))
+        yield '{}_count{} {}'.format(metric.name, _format_labels(labels),
+                                     _format_value(value))
+
+REGISTRY = Registry()
+atexit.register(REGISTRY.flush)
+
+REQUEST_DURATION = REGISTRY.histogram(
+    'electobot_http_request_duration_seconds',
+    "Time to handle a request, by route", ['route', 'method', 'status'])
+REQUEST_DB_DURATION = REGISTRY.histogram(
+    'electobot_http_request_db_duration_seconds',
+    "Time spent in database queries per request, by route", ['route'])
+REGISTRATIONS = REGISTRY.counter(
+    'electobot_registrations',
+    "Registration attempts, by result", ['result'])
+EMAILS = REGISTRY.counter(
+    'electobot_emails', "Emails handed to the SMTP server, by result",
+    ['result'])
+SMTP_DURATION = REGISTRY.histogram(
+    'electobot_smtp_send_duration_seconds',
+    "Time to send one email over SMTP, including connecting if needed")
+VOTES_CAST = REGISTRY.counter(
+    'electobot_votes_cast', "Accepted votes, by poll", ['poll_id'])
+REQUESTS_SHED = REGISTRY.counter(
+    'electobot_requests_shed', "Requests turned away as busy, by route",
+    ['route'])
+BALLOTS_REJECTED = REGISTRY.counter(
+    'electobot_ballots_rejected', "Rejected votes, by reason", ['reason'])
@@ -0,0 +1,151 @@
+"""
+Counts and times SQL queries per request or CLI command.
+
+Query time is always tracked, as it feeds the request metrics. With
+ELECTOBOT_PROFILE=1, every request and command also logs a summary line with
+its number of queries, database time and statements that ran more than once
+(usually a query in a loop). If ELECTOBOT_PROFILE_DIR is set as well, requests
+slower than ELECTOBOT_PROFILE_SLOW seconds leave a cProfile dump and a
+tracemalloc snapshot there.
+"""
+import contextvars
+import cProfile
+import logging
+import os
+import re
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('profiling')
+
+PROFILE = os.environ.get('ELECTOBOT_PROFILE') == '1'
+PROFILE_DIR = os.environ.get('ELECTOBOT_PROFILE_DIR')
+# Seconds
+SLOW_REQUEST = float(os.environ.get('ELECTOBOT_PROFILE_SLOW', 0.5))
+
+_IN_LIST = re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r'\s+')
+
+def fingerprint(statement: str) -> str:
+    """The statement with literals and IN lists collapsed, so that the same
+    query with other values gives the same fingerprint.
+    """
+    statement = _LITERAL.sub('?', statement)
+    statement = _IN_LIST.sub('(?...)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+class QueryStats:
+    """Queries run while tracking was active. Statements are only kept when
+    `fingerprints` is set, as that costs a few regex substitutions per query.
+    """
+
+    def __init__(self, fingerprints=False):
+        self.count = 0
+        self.time = 0.0
+        self.statements = Counter() if fingerprints else None
+        self._token = None
+
+    def record(self, statement: str, elapsed: float) -> None:
+        self.count += 1
+        self.time += elapsed
+        if self.statements is not None:
+            self.statements[fingerprint(statement)] += 1
+
+    def repeated(self):
+        """[(fingerprint, count)] of statements that ran more than once."""
+        if self.statements is None:
+            return []
+        return [(statement, count)
+                for statement, count in self.statements.most_common()
+                if count > 1]
+
+    def summary(self) -> str:
+        text = '{} queries in {:.1f}ms'.format(self.count, self.time * 1000)
+        for statement, count in self.repeated():
+            text += '\n  {}x {}'.format(count, statement)
+        return text
+
+# Every tracker that is active in the current context; nested trackers (a
+# test around a request) all see the queries.
+_active = contextvars.ContextVar('query_stats', default=())
+
+def start_tracking(fingerprints=False) -> QueryStats:
+    stats = QueryStats(fingerprints=fingerprints)
+    stats._token = _active.set(_active.get() + (stats,))
+    return stats
+
+def stop_tracking(stats: QueryStats) -> None:
+    _active.reset(stats._token)
+
+@contextmanager
+def track_queries(fingerprints=False):
+    stats = start_tracking(fingerprints=fingerprints)
+    try:
+        yield stats
+    finally:
+        stop_tracking(stats)
+
+# The start time is kept on the execution context rather than the connection,
+# as after_cursor_execute doesn't fire for statements that fail. There is no
+# context for a few internal statements; they are counted but not timed.
+@sqlalchemy_event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context,
+                       executemany):
+    if context is not None:
+        context._electobot_query_start = time.perf_counter()
+
+@sqlalchemy_event.listens_for(Engine, 'after_cursor_execute')
+def _stop_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    start = getattr(context, '_electobot_query_start', None)
+    elapsed = 0.0 if start is None else time.perf_counter() - start
+    for stats in _active.get():
+        stats.record(statement, elapsed)
+
+def start_profile():
+    """Starts profiling the current request if slow requests are dumped."""
+    if not (PROFILE and PROFILE_DIR):
+        return None
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def finish_profile(profiler, name: str, elapsed: float,
+                   stats: QueryStats) -> None:
+    """Logs the summary of a request or command, and dumps its profile if it
+    was slow.
+    """
+    if profiler is not None:
+        profiler.disable()
+    if not PROFILE:
+        return
+    logger.info("%s took %.1fms, %s", name, elapsed * 1000, stats.summary())
+    if profiler is None or elapsed < SLOW_REQUEST:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, '{}-{}'.format(
+        time.strftime('%Y%m%d-%H%M%S'), re.sub(r'[^A-Za-z0-9]+', '_', name)))
+    profiler.dump_stats(prefix + '.prof')
+    # Memory is traced for the whole process, not just this request
+    tracemalloc.take_snapshot().dump(prefix + '.tracemalloc')
+    logger.warning("%s was slow, profile written to %s.prof", name, prefix)
+
+@contextmanager
+def profiled(name: str):
+    """Tracks and reports everything run in the block, e.g. a CLI command."""
+    profiler = start_profile()
+    stats = start_tracking(fingerprints=PROFILE)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stop_tracking(stats)
+        finish_profile(profiler, name, time.perf_counter() - start, stats)
@@ -0,0 +1,108 @@
+"""
+Opens and closes polls at their scheduled times. A `PollScheduler` keeps the
+upcoming transitions in a heap and sleeps until the next one, instead of
+checking every poll over and over. It reloads the heap only when the polls
+changed, which one cheap query tells it, so polls added from the CLI or
+another process are picked up within `refresh_interval` seconds.
+
+Transitions are re-checked against the database when they are due, so several
+schedulers (e.g. one per uWSGI worker) can run at once.
+"""
+import heapq
+import logging
+import threading
+from datetime import datetime
+
+from .database import (create_default_session, poll_schedule,
+                       schedule_version, apply_poll_schedule)
+
+logger = logging.getLogger('scheduler')
+
+class PollScheduler(threading.Thread):
+    """Applies poll transitions until stopped.
+
+    `on_change` is called with the (poll_id, is_open) pairs of the polls that
+    opened or closed, after they were committed.
+    """
+
+    def __init__(self, session_factory=create_default_session,
+                 refresh_interval=5.0, on_change=None,
+                 clock=datetime.utcnow):
+        super().__init__(name='electobot-scheduler', daemon=True)
+        self.session_factory = session_factory
+        self.refresh_interval = refresh_interval
+        self.on_change = on_change
+        self.clock = clock
+        self._heap = []
+        self._version = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def notify(self):
+        """Reloads the schedule right away, e.g. after adding a poll."""
+        self._version = None
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def refresh(self, session) -> None:
+        """Rebuilds the heap if any poll changed since it was built."""
+        version = schedule_version(session=session)
+        if version == self._version:
+            return
+        self._heap = poll_schedule(session=session)
+        heapq.heapify(self._heap)
+        self._version = version
+
+    def run_due(self, now=None) -> list:
+        """Applies the transitions that are due. Returns the (poll_id,
+        is_open) of the polls that changed.
+        """
+        if now is None:
+            now = self.clock()
+        session = self.session_factory()
+        try:
+            self.refresh(session)
+            due = set()
+            while self._heap and self._heap[0][0] <= now:
+                due.add(heapq.heappop(self._heap)[1])
+            try:
+                changed = apply_poll_schedule(due, time=now, session=session)
+            except Exception:
+                # e.g. the database was locked: rebuild the heap next time,
+                # so the popped transitions are retried
+                self._version = None
+                raise
+            if changed:
+                # e.g. the end of a poll that just opened
+                self.refresh(session)
+        finally:
+            session.close()
+        for poll_id, is_open in changed:
+            logger.info("Poll %s %s", poll_id,
+                        'opened' if is_open else 'closed')
+        if changed and self.on_change is not None:
+            self.on_change(changed)
+        return changed
+
+    def seconds_until_next(self, now=None) -> float:
+        """Time to sleep: until the next transition, but no longer than
+        `refresh_interval`.
+        """
+        if not self._heap:
+            return self.refresh_interval
+        if now is None:
+            now = self.clock()
+        wait = (self._heap[0][0] - now).total_seconds()
+        return min(max(wait, 0.0), self.refresh_interval)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_due()
+            except Exception:
+                logger.exception("Poll scheduler run failed")
+            self._wakeup.wait(self.seconds_until_next())
+            self._wakeup.clear()
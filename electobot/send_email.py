@@ -1,29 +1,92 @@
+import logging
 import smtplib
 import ssl
+import time
+from collections import namedtuple
 from email.mime.text import MIMEText
 
+from .metrics import SMTP_DURATION
 
+logger = logging.getLogger('send_email')
 
-def send_message(address, subject, message):
-    # Create a secure SSL context
-    context = ssl.create_default_context()
+MAIL_CREDENTIALS_PATH = 'mail_credentials'
 
-    # Define the message
+MailCredentials = namedtuple('MailCredentials', ['server_address', 'port',
+                                                 'username', 'password',
+                                                 'sender_email'])
 
-    receivers = [address]
-
-    with open('mail_credentials') as file_:
+def read_credentials(path=MAIL_CREDENTIALS_PATH) -> MailCredentials:
+    """Reads the `mail_credentials` file, one value per line."""
+    with open(path) as file_:
         server_address, port, username, password, sender_email = file_.read().splitlines()
-    
+    return MailCredentials(server_address, int(port), username, password,
+                           sender_email)
+
+def build_message(address, subject, message) -> MIMEText:
     msg = MIMEText(message)
 
     msg['Subject'] = subject
     msg['From'] = "Electobot"
     msg['To'] = address
+    return msg
+
+def connect_ssl(credentials: MailCredentials):
+    # Create a secure SSL context
+    context = ssl.create_default_context()
+    return smtplib.SMTP_SSL(credentials.server_address, credentials.port,
+                            context=context)
+
+class MailSender:
+    """Sends messages over a single authenticated SMTP connection.
 
-    
-    port = int(port)
-    with smtplib.SMTP_SSL(server_address, port, context=context) as server:
-        server.login(username, password)
-        server.sendmail(sender_email, address,
-                        msg.as_string())
+    The connection is opened on the first message and kept open, so TLS and
+    login happen once per batch instead of once per message. If the server
+    drops the connection in the meantime, it is reopened once.
+    """
+
+    def __init__(self, credentials: MailCredentials, connect=connect_ssl):
+        self.credentials = credentials
+        self._connect = connect
+        self._server = None
+
+    def _connection(self):
+        if self._server is None:
+            server = self._connect(self.credentials)
+            server.login(self.credentials.username, self.credentials.password)
+            self._server = server
+        return self._server
+
+    def send(self, address, subject, message):
+        msg = build_message(address, subject, message).as_string()
+        start = time.perf_counter()
+        try:
+            self._connection().sendmail(self.credentials.sender_email,
+                                        address, msg)
+        except smtplib.SMTPServerDisconnected:
+            logger.info("SMTP connection dropped, reconnecting")
+            self._server = None
+            self._connection().sendmail(self.credentials.sender_email,
+                                        address, msg)
+        finally:
+            SMTP_DURATION.observe(time.perf_counter() - start)
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def send_message(address, subject, message):
+    """Sends a single message over a fresh connection."""
+    with MailSender(read_credentials()) as sender:
+        sender.send(address, subject, message)
@@ -0,0 +1,277 @@
+"""
+Results of polls, for every tally method.
+
+Plurality and approval polls are sums of ballot weights, which `tally_poll`
+keeps up to date incrementally. Ranked polls are counted in rounds:
+`irv` (instant-runoff) eliminates the option with the fewest votes until one
+has a majority of the ballots still in the count, and `stv` (single
+transferable vote) elects every option that reaches the Droop quota and
+passes on the part of its votes above the quota, for polls with several
+seats.
+
+Identical rankings are merged before counting, so a round costs at most one
+step per distinct ranking. With NumPy installed, rounds are counted over
+arrays; otherwise only the ballots whose current choice left the count are
+looked at again.
+"""
+import math
+from collections import defaultdict, namedtuple
+from typing import Union
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sqlalchemy import select
+from sqlalchemy.orm.session import Session as SQLAlchemySession
+from tabulate import tabulate
+
+from .database import (get_session, poll_from_id, poll_options_from_poll,
+                       recount_poll, tally_poll, Ballot, RANKED_METHODS,
+                       TALLY_METHODS)
+
+TallyRound = namedtuple('TallyRound', ['votes', 'elected', 'eliminated'])
+TallyRound.__doc__ = """Votes per option still in the count at the start of a
+round, and the options that were elected or eliminated in it.
+"""
+TallyResult = namedtuple('TallyResult', ['method', 'seats', 'rounds',
+                                         'elected'])
+
+def merge_rankings(rows) -> dict:
+    """Turns (cast_id, rank, poll_option_id, weight) ballot rows into a
+    dictionary of <ranking>: <total weight>, where a ranking is a tuple of
+    `poll_option_id`s, first choice first.
+    """
+    ballots = defaultdict(dict)
+    weights = {}
+    for cast_id, rank, option_id, weight in rows:
+        ballots[cast_id][rank] = option_id
+        weights[cast_id] = weight
+    rankings = defaultdict(int)
+    for cast_id, ranks in ballots.items():
+        rankings[tuple(ranks[rank] for rank in sorted(ranks))] += \
+            weights[cast_id]
+    return rankings
+
+class _ListCounter:
+    """Keeps, for every option, the rankings currently counting for it."""
+
+    def __init__(self, rankings, weights, n_options: int):
+        self.rankings = rankings
+        self.weights = [float(weight) for weight in weights]
+        self.continuing = [True] * n_options
+        self.positions = [0] * len(rankings)
+        self.holding = [[] for _ in range(n_options)]
+        self.totals = [0.0] * n_options
+        for i, ranking in enumerate(rankings):
+            self.holding[ranking[0]].append(i)
+            self.totals[ranking[0]] += self.weights[i]
+
+    def remove(self, option: int, keep: float) -> None:
+        """Takes `option` out of the count. Its ballots move on to their next
+        choice still in the count, with `keep` of their weight.
+        """
+        self.continuing[option] = False
+        held, self.holding[option] = self.holding[option], []
+        self.totals[option] = 0.0
+        for i in held:
+            self.weights[i] *= keep
+            ranking = self.rankings[i]
+            position = self.positions[i] + 1
+            while (position < len(ranking)
+                   and not self.continuing[ranking[position]]):
+                position += 1
+            self.positions[i] = position
+            if position < len(ranking):
+                self.holding[ranking[position]].append(i)
+                self.totals[ranking[position]] += self.weights[i]
+
+class _ArrayCounter:
+    """The same as `_ListCounter`, over a rankings x ranks matrix of option
+    indexes. Rankings are padded with an extra option that is never in the
+    count.
+    """
+
+    def __init__(self, rankings, weights, n_options: int):
+        lengths = numpy.fromiter((len(ranking) for ranking in rankings),
+                                 dtype=numpy.int64, count=len(rankings))
+        flat = numpy.fromiter((option for ranking in rankings
+                               for option in ranking),
+                              dtype=numpy.int64, count=int(lengths.sum()))
+        rows = numpy.repeat(numpy.arange(len(rankings)), lengths)
+        starts = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        self.matrix = numpy.full((len(rankings), int(lengths.max())),
+                                 n_options, dtype=numpy.int64)
+        self.matrix[rows, numpy.arange(len(flat)) - starts] = flat
+        self.weights = numpy.asarray(weights, dtype=float)
+        self.n_options = n_options
+        self.continuing = numpy.ones(n_options + 1, dtype=bool)
+        self.continuing[n_options] = False
+        self.top = self.matrix[:, 0].copy()
+        self._count()
+
+    def _count(self) -> None:
+        self.totals = numpy.bincount(self.top, weights=self.weights,
+                                     minlength=self.n_options + 1).tolist()
+
+    def remove(self, option: int, keep: float) -> None:
+        self.continuing[option] = False
+        moved = numpy.flatnonzero(self.top == option)
+        self.weights[moved] *= keep
+        choices = self.matrix[moved]
+        in_count = self.continuing[choices]
+        first = in_count.argmax(axis=1)
+        self.top[moved] = numpy.where(
+            in_count.any(axis=1),
+            choices[numpy.arange(len(moved)), first], self.n_options)
+        self._count()
+
+def _lowest(continuing, history) -> int:
+    """The option to eliminate: the fewest votes, ties broken by the fewest
+    votes in the latest earlier round where they differ, and then by the
+    option listed last.
+    """
+    candidates = sorted(continuing)
+    for totals in reversed(history):
+        fewest = min(totals[i] for i in candidates)
+        candidates = [i for i in candidates if totals[i] == fewest]
+        if len(candidates) == 1:
+            break
+    return candidates[-1]
+
+def count_ranked(option_ids, rankings: dict, method='irv', seats=1,
+                 use_numpy: Union[bool, None]=None) -> TallyResult:
+    """Counts ranked ballots, given as from `merge_rankings`, in rounds.
+
+    `use_numpy` picks the array counter, by default when NumPy is installed.
+    """
+    if method not in RANKED_METHODS:
+        raise ValueError("Not a ranked tally method: {}".format(method))
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    index = {option_id: i for i, option_id in enumerate(option_ids)}
+    ranked = [tuple(index[option_id] for option_id in ranking)
+              for ranking in rankings if len(ranking) > 0]
+    weights = [weight for ranking, weight in rankings.items()
+               if len(ranking) > 0]
+    seats = min(seats, len(option_ids))
+    total = sum(weights)
+    if total == 0:
+        return TallyResult(method, seats, [], [])
+    counter = (_ArrayCounter if use_numpy else _ListCounter)(
+        ranked, weights, len(option_ids))
+    # Droop quota
+    quota = math.floor(total / (seats + 1)) + 1
+    continuing = set(range(len(option_ids)))
+    elected = []
+    rounds = []
+    history = []
+    while len(elected) < seats:
+        # Rounded, so both counters break ties the same way
+        totals = {i: round(counter.totals[i], 9) for i in continuing}
+        history.append(totals)
+        if method == 'irv':
+            # A majority of the ballots that aren't exhausted yet
+            quota = math.floor(sum(totals.values()) / 2) + 1
+        if len(elected) + len(continuing) <= seats:
+            winners = sorted(continuing, key=lambda i: -totals[i])
+        else:
+            winners = sorted((i for i in continuing if totals[i] >= quota),
+                             key=lambda i: -totals[i])
+        winners = winners[:seats - len(elected)]
+        eliminated = []
+        if len(winners) > 0:
+            continuing.difference_update(winners)
+            elected.extend(winners)
+            # Surpluses skip every option elected in this round, not just
+            # the ones whose surplus was already passed on
+            for i in winners:
+                counter.continuing[i] = False
+            for i in winners:
+                surplus = max(0.0, totals[i] - quota)
+                counter.remove(i, keep=surplus / totals[i] if totals[i] else 0)
+        else:
+            eliminated = [_lowest(continuing, history)]
+            continuing.discard(eliminated[0])
+            counter.remove(eliminated[0], keep=1.0)
+        rounds.append(TallyRound(
+            votes={option_ids[i]: votes for i, votes in totals.items()},
+            elected=[option_ids[i] for i in winners],
+            eliminated=[option_ids[i] for i in eliminated]))
+    return TallyResult(method, seats, rounds,
+                       [option_ids[i] for i in elected])
+
+def _ballot_kind(method: str) -> str:
+    return 'ranked' if method in RANKED_METHODS else method
+
+def count_poll(poll_id: int, method: Union[str, None]=None,
+               seats: Union[int, None]=None, recount=False,
+               session: Union[SQLAlchemySession, None]=None) -> TallyResult:
+    """Counts a poll with its own tally method, or with `method`, which has
+    to take the same kind of ballots (e.g. `stv` for an `irv` poll).
+    `recount` counts plurality and approval polls from scratch; ranked polls
+    are always counted from all of their ballots.
+    """
+    session = get_session(session)
+    poll = poll_from_id(poll_id, session=session)
+    method = method or poll.tally_method
+    seats = seats or poll.seats
+    if method not in TALLY_METHODS:
+        raise ValueError("Unknown tally method: {}".format(method))
+    if _ballot_kind(method) != _ballot_kind(poll.tally_method):
+        raise ValueError("Ballots of {} poll {} can't be counted with {}"
+                         .format(poll.tally_method, poll_id, method))
+    option_ids = [option.poll_option_id for option in
+                  poll_options_from_poll(poll_id, session=session)]
+    if method in RANKED_METHODS:
+        # Table columns rather than ORM attributes: plain rows load about
+        # twice as fast, which matters with hundreds of thousands of them
+        ballots = Ballot.__table__.c
+        rows = session.execute(
+            select(ballots.cast_id, ballots.rank, ballots.poll_option_id,
+                   ballots.weight).where(ballots.poll_id == poll_id))
+        return count_ranked(option_ids, merge_rankings(rows), method=method,
+                            seats=seats)
+    if recount:
+        counts = recount_poll(poll_id, session=session)
+    else:
+        counts = tally_poll(poll_id, session=session)
+    votes = {option_id: counts.get(option_id, 0) for option_id in option_ids}
+    # Ties go to the option listed first
+    elected = sorted(option_ids, key=lambda option_id: -votes[option_id])
+    return TallyResult(method, seats,
+                       [TallyRound(votes, elected[:seats], [])],
+                       elected[:seats])
+
+def _format_votes(votes) -> str:
+    if float(votes).is_integer():
+        return str(int(votes))
+    return '{:.2f}'.format(votes)
+
+def tally_to_table(poll_id: int, method: Union[str, None]=None,
+                   seats: Union[int, None]=None, recount=False,
+                   session: Union[SQLAlchemySession, None]=None,
+                   **tabulate_kwargs) -> str:
+    """The result of `count_poll` as a table with a column per round."""
+    session = get_session(session)
+    result = count_poll(poll_id, method=method, seats=seats, recount=recount,
+                        session=session)
+    headers = ['Option'] + ['Round {}'.format(i + 1)
+                            for i in range(len(result.rounds))] + ['Result']
+    rows = []
+    for option in poll_options_from_poll(poll_id, session=session):
+        option_id = option.poll_option_id
+        row = [option.name]
+        outcome = ''
+        for i, tally_round in enumerate(result.rounds):
+            votes = tally_round.votes.get(option_id)
+            row.append('' if votes is None else _format_votes(votes))
+            if option_id in tally_round.elected:
+                outcome = 'elected in round {}'.format(i + 1)
+            elif option_id in tally_round.eliminated:
+                outcome = 'eliminated in round {}'.format(i + 1)
+        if len(result.rounds) == 1:
+            outcome = 'elected' if option_id in result.elected else ''
+        rows.append(row + [outcome])
+    return tabulate(rows, headers=headers, **tabulate_kwargs)
@@ -1,5 +1,65 @@
+import hashlib
+import hmac
+import secrets
 import uuid
+from collections import namedtuple
+
+SIGNED_TOKEN_VERSION = 'v1'
+# Hex characters of the HMAC kept in a token, i.e. 128 bits
+SIGNATURE_LENGTH = 32
+
+SignedToken = namedtuple('SignedToken', ['voter_id', 'event_id', 'key_version',
+                                         'signature'])
 
 def gen_token() -> str:
     """Returns a random token."""
     return str(uuid.uuid4())
+
+def gen_secret() -> str:
+    """Returns a random secret for signing tokens."""
+    return secrets.token_hex(32)
+
+def is_random_token(token: str) -> bool:
+    """Whether `token` has the form of a token from `gen_token`."""
+    try:
+        return str(uuid.UUID(token)) == token
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+def _signature(voter_id: int, event_id: int, key_version: int,
+               secret: str) -> str:
+    message = '{}.{}.{}.{}'.format(SIGNED_TOKEN_VERSION, voter_id, event_id,
+                                   key_version)
+    return hmac.new(secret.encode(), message.encode(),
+                    hashlib.sha256).hexdigest()[:SIGNATURE_LENGTH]
+
+def sign_voter_token(voter_id: int, event_id: int, key_version: int,
+                     secret: str) -> str:
+    """Returns a token that proves who the voter is to anyone with the
+    secret of the event, without looking it up.
+    """
+    return '{}.{}.{}.{}.{}'.format(
+        SIGNED_TOKEN_VERSION, voter_id, event_id, key_version,
+        _signature(voter_id, event_id, key_version, secret))
+
+def parse_signed_token(token: str):
+    """Returns the `SignedToken` fields of a signed token, or None if it
+    isn't one. The signature is not checked.
+    """
+    if not isinstance(token, str):
+        return None
+    parts = token.split('.')
+    if len(parts) != 5 or parts[0] != SIGNED_TOKEN_VERSION:
+        return None
+    try:
+        voter_id, event_id, key_version = (int(part) for part in parts[1:4])
+    except ValueError:
+        return None
+    if len(parts[4]) != SIGNATURE_LENGTH:
+        return None
+    return SignedToken(voter_id, event_id, key_version, parts[4])
+
+def check_signature(signed: SignedToken, secret: str) -> bool:
+    expected = _signature(signed.voter_id, signed.event_id,
+                          signed.key_version, secret)
+    return hmac.compare_digest(expected, signed.signature)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Simulates a General Assembly against the Flask app, without any network.
+
+Voters register through `/register`, the organizers open a few polls, then
+every voter opens the poll list and ballot pages and votes on each poll,
+from several threads at once. With `--combined`, voters cast all of their
+votes on the `/ballot` page in one request instead. Prints throughput and
+latency per route, error counts and whether the final tallies match the votes
+that were sent.
+"""
+import argparse
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from tabulate import tabulate
+
+from electobot.database import (create_engine, create_all_tables,
+                                create_session, create_event, create_poll,
+                                create_poll_option, open_poll, tally_poll,
+                                set_engine, OutboxMessage)
+from app import app
+
+TOKEN_PATTERN = re.compile(r'token=([0-9A-Za-z.-]+)')
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return float('nan')
+    index = min(int(round(fraction * (len(sorted_values) - 1))),
+                len(sorted_values) - 1)
+    return sorted_values[index]
+
+class LoadTestResult:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # Requests turned away as busy and retried
+        self.shed = defaultdict(int)
+        self.durations = {}
+        self.tally_mismatches = []
+        self._lock = threading.Lock()
+
+    def record(self, route, latency, ok):
+        with self._lock:
+            self.latencies[route].append(latency)
+            if not ok:
+                self.errors[route] += 1
+
+    def record_shed(self, route):
+        with self._lock:
+            self.shed[route] += 1
+
+    @property
+    def total_errors(self):
+        return sum(self.errors.values())
+
+    def rows(self):
+        rows = []
+        for route, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            phase = 'register' if 'register' in route else 'vote'
+            rows.append([
+                route, len(latencies),
+                len(latencies) / self.durations[phase],
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                self.shed[route],
+                self.errors[route],
+            ])
+        return rows
+
+    def report(self):
+        headers = ['Route', 'Requests', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                   'Busy', 'Errors']
+        lines = [tabulate(self.rows(), headers=headers, floatfmt='.1f')]
+        if self.tally_mismatches:
+            lines.append('Tally mismatches: {}'.format(self.tally_mismatches))
+        else:
+            lines.append('All tallies correct.')
+        return '\n'.join(lines)
+
+def _timed(result, route, request, ok=lambda response: True,
+           retry_pause=None):
+    """Sends a request, retrying it while the app says it is busy. The
+    latency includes the retries, as a voter would experience it.
+    """
+    start = time.perf_counter()
+    response = request()
+    while response.status_code == 503 and 'Retry-After' in response.headers:
+        result.record_shed(route)
+        time.sleep(int(response.headers['Retry-After'])
+                   if retry_pause is None else retry_pause)
+        response = request()
+    latency = time.perf_counter() - start
+    result.record(route, latency,
+                  response.status_code == 200
+                  and b'class="error"' not in response.data
+                  and ok(response))
+    return response
+
+def _register(result, event_token, email, retry_pause=None):
+    client = app.test_client()
+    _timed(result, 'POST /register',
+           lambda: client.post('/register', data={'event_token': event_token,
+                                                  'email': email}),
+           lambda response: b'Voting email sent' in response.data,
+           retry_pause=retry_pause)
+
+def _vote_all_polls(result, token, ballots, retry_pause=None):
+    client = app.test_client()
+    _timed(result, 'GET /vote',
+           lambda: client.get('/vote?token={}'.format(token)),
+           retry_pause=retry_pause)
+    for poll_id, vote_dict in ballots:
+        url = '/vote?token={}&poll_id={}'.format(token, poll_id)
+        _timed(result, 'GET /vote?poll_id', lambda: client.get(url),
+               retry_pause=retry_pause)
+        form = {'vote${}'.format(option_id): str(votes)
+                for option_id, votes in vote_dict.items()}
+        _timed(result, 'POST /vote?poll_id',
+               lambda: client.post(url, data=form),
+               lambda response: b'Successfully voted' in response.data,
+               retry_pause=retry_pause)
+
+def _vote_combined(result, token, ballots, retry_pause=None):
+    client = app.test_client()
+    url = '/ballot?token={}'.format(token)
+    _timed(result, 'GET /ballot', lambda: client.get(url),
+           retry_pause=retry_pause)
+    form = {'vote${}'.format(option_id): str(votes)
+            for _, vote_dict in ballots
+            for option_id, votes in vote_dict.items()}
+    form['poll_ids'] = [str(poll_id) for poll_id, _ in ballots]
+    _timed(result, 'POST /ballot', lambda: client.post(url, data=form),
+           lambda response: b'Successfully voted' in response.data,
+           retry_pause=retry_pause)
+
+def run_load_test(n_voters=200, n_polls=3, n_options=3, concurrency=8,
+                  seed=0, data_dir=None, admission=None,
+                  retry_pause=None, combined=False) -> LoadTestResult:
+    """Runs one simulated assembly on a fresh database in `data_dir`.
+    `combined` votes in all polls with one request per voter.
+
+    `admission` replaces the app's ADMISSION setting for the run. Clients
+    turned away as busy retry after Retry-After, or `retry_pause` seconds.
+    """
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='electobot-load-')
+    rng = random.Random(seed)
+    engine = create_engine(path=os.path.join(data_dir, 'db.sqlite'))
+    create_all_tables(engine)
+    set_engine(engine)
+    # Put back when the run is over
+    saved_config = {key: app.config[key]
+                    for key in ('MAIL_WORKER', 'SCHEDULER', 'ADMISSION')}
+    # Registration emails stay in the outbox, nothing is sent
+    app.config['MAIL_WORKER'] = 'off'
+    app.config['SCHEDULER'] = 'off'
+    if admission is not None:
+        app.config['ADMISSION'] = admission
+    session = create_session(engine)
+    result = LoadTestResult()
+    try:
+        event = create_event("Load test assembly {}".format(seed),
+                             r".*@.*\..*", session=session)
+        event_id, event_token = event.event_id, event.token
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(
+                lambda i: _register(result, event_token,
+                                    'member{}@someplace.eu'.format(i),
+                                    retry_pause=retry_pause),
+                range(n_voters)))
+        result.durations['register'] = time.perf_counter() - start
+        tokens = [
+            TOKEN_PATTERN.search(body).group(1)
+            for (body,) in session.query(OutboxMessage.body)
+        ]
+
+        polls = {}
+        for i in range(n_polls):
+            poll = create_poll(event_id, "Motion {}".format(i),
+                               start_time=datetime.utcnow()
+                               - timedelta(minutes=1),
+                               session=session)
+            polls[poll.poll_id] = [
+                create_poll_option(poll.poll_id, "Option {}".format(j),
+                                   session=session).poll_option_id
+                for j in range(n_options)
+            ]
+            open_poll(poll.poll_id, session=session)
+
+        expected = {poll_id: defaultdict(int) for poll_id in polls}
+        voter_ballots = []
+        for token in tokens:
+            ballots = []
+            for poll_id, option_ids in polls.items():
+                choice = rng.choice(option_ids)
+                ballots.append((poll_id, {option_id: int(option_id == choice)
+                                          for option_id in option_ids}))
+                expected[poll_id][choice] += 1
+            voter_ballots.append((token, ballots))
+
+        vote = _vote_combined if combined else _vote_all_polls
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(
+                lambda args: vote(result, *args,
+                                  retry_pause=retry_pause),
+                voter_ballots))
+        result.durations['vote'] = time.perf_counter() - start
+
+        for poll_id in polls:
+            counts = tally_poll(poll_id, session=session)
+            if counts != dict(expected[poll_id]):
+                result.tally_mismatches.append(poll_id)
+    finally:
+        session.close()
+        set_engine(None)
+        app.config.update(saved_config)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate a General Assembly.')
+    parser.add_argument('--voters', type=int, default=400)
+    parser.add_argument('--polls', type=int, default=3)
+    parser.add_argument('--options', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--combined', action='store_true',
+                        help='Vote in all polls with one request per voter')
+    parser.add_argument('--data_dir', default=None,
+                        help='Where to put the database (default: a temporary '
+                             'directory)')
+    args = parser.parse_args()
+    result = run_load_test(n_voters=args.voters, n_polls=args.polls,
+                           n_options=args.options,
+                           concurrency=args.concurrency, seed=args.seed,
+                           data_dir=args.data_dir, combined=args.combined)
+    print(result.report())
+    if result.total_errors or result.tally_mismatches:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
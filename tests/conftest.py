@@ -0,0 +1,37 @@
+from contextlib import contextmanager
+
+import pytest
+
+from electobot.database import (create_engine, create_all_tables,
+                                create_session, set_engine)
+from electobot.profiling import track_queries
+
+@pytest.fixture
+def engine(tmp_path):
+    """A fresh database file, also used as the process-wide engine."""
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'))
+    create_all_tables(engine)
+    set_engine(engine)
+    yield engine
+    set_engine(None)
+
+@pytest.fixture
+def session():
+    """A session on a fresh in-memory database."""
+    engine = create_engine(path=":memory:")
+    create_all_tables(engine)
+    return create_session(engine)
+
+@pytest.fixture
+def max_queries():
+    """Fails the test if the block runs more than `limit` SQL queries.
+
+        with max_queries(3):
+            client.get('/vote?token=...')
+    """
+    @contextmanager
+    def check(limit: int):
+        with track_queries(fingerprints=True) as stats:
+            yield stats
+        assert stats.count <= limit, stats.summary()
+    return check
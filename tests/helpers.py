@@ -0,0 +1,2 @@
+# Accepts any address that looks like an email
+EMAIL_PATTERN = r".*@.*\..*"
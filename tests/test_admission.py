@@ -0,0 +1,73 @@
+import threading
+
+from electobot.admission import (TokenBucket, ConcurrencyLimit, Admission,
+                                 admission_from_env, BUSY_RETRY_AFTER)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_token_bucket_allows_bursts_then_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, burst=3, clock=clock)
+    assert [bucket.reserve(0)[0] for _ in range(4)] == [True] * 3 + [False]
+    # A request may wait for its token
+    admitted, wait = bucket.reserve(max_wait=0.5)
+    assert admitted and abs(wait - 0.1) < 1e-9
+    # Now the next token is 0.2s away
+    admitted, retry = bucket.reserve(max_wait=0.05)
+    assert not admitted and abs(retry - 0.15) < 1e-9
+    clock.now = 10
+    assert bucket.reserve(0) == (True, 0.0)
+
+def test_concurrency_limit_queues_and_refuses():
+    limit = ConcurrencyLimit(limit=1, max_queue=1)
+    assert limit.acquire(timeout=0)
+    assert not limit.acquire(timeout=0.01)
+
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(
+        limit.acquire(timeout=5)))
+    waiter.start()
+    while limit.waiting == 0:
+        pass
+    # The queue is full
+    assert not limit.acquire(timeout=5)
+    limit.release()
+    waiter.join()
+    assert acquired == [True] and limit.active == 1
+
+def test_admission_only_limits_rate_of_writes():
+    slept = []
+    admission = Admission(rate=1, burst=1, max_wait=0, sleep=slept.append)
+    assert admission.enter(write=True) is None
+    assert admission.enter(write=True) == 1
+    assert admission.enter(write=False) is None
+    assert slept == []
+
+    admission = Admission(concurrency=1, max_queue=0)
+    assert admission.enter(write=False) is None
+    assert admission.enter(write=False) == BUSY_RETRY_AFTER
+    admission.leave()
+    assert admission.enter(write=False) is None
+
+def test_busy_requests_keep_their_rate_budget():
+    admission = Admission(concurrency=1, max_queue=0, rate=0.01, burst=2,
+                          max_wait=0)
+    assert admission.enter(write=True) is None
+    assert admission.enter(write=True) == BUSY_RETRY_AFTER
+    admission.leave()
+    # The refused request gave its token back
+    assert admission.enter(write=True) is None
+    admission.leave()
+    assert admission.enter(write=True) == 100
+
+def test_admission_from_env(monkeypatch):
+    monkeypatch.setenv('ELECTOBOT_REGISTER_CONCURRENCY', '0')
+    monkeypatch.setenv('ELECTOBOT_REGISTER_RATE', '5')
+    admission = admission_from_env('register', concurrency=8, rate=50)
+    assert admission.limit is None
+    assert admission.bucket.rate == 5 and admission.bucket.burst == 5
@@ -0,0 +1,410 @@
+import json
+import subprocess
+import sys
+import pytest
+from datetime import datetime, timedelta
+
+from sqlalchemy import event as sqlalchemy_event
+
+from electobot.database import (create_session, create_event, create_voter,
+                                create_poll, create_poll_option, open_poll,
+                                get_engine, tally_poll, OutboxMessage)
+
+flask = pytest.importorskip('flask')
+from app import app
+from electobot.live import _watchers
+from .helpers import EMAIL_PATTERN
+
+@pytest.fixture
+def client(engine):
+    app.config['TESTING'] = True
+    app.config['MAIL_WORKER'] = 'off'
+    app.config['SCHEDULER'] = 'off'
+    app.config['ADMIN_TOKEN'] = 'organizer-secret'
+    app.config['LIVE_TALLY_INTERVAL'] = 0.01
+    with app.test_client() as client:
+        yield client
+
+@pytest.fixture
+def open_poll_setup(engine):
+    session = create_session(engine)
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    voter = create_voter(event.event_id, 'someone@someplace.eu',
+                         session=session)
+    poll = create_poll(event.event_id, "Is the new board elected?",
+                       start_time=datetime.utcnow() - timedelta(minutes=1),
+                       session=session)
+    options = [create_poll_option(poll.poll_id, name, session=session)
+               for name in ["Yes", "No"]]
+    open_poll(poll.poll_id, session=session)
+    setup = {
+        'event_token': event.token,
+        'voter_token': voter.token,
+        'poll_id': poll.poll_id,
+        'option_ids': [option.poll_option_id for option in options],
+    }
+    session.close()
+    return setup
+
+def _count_checkouts(engine):
+    checkouts = []
+    sqlalchemy_event.listen(engine, 'checkout',
+                            lambda *args: checkouts.append(1))
+    return checkouts
+
+def test_default_engine_is_shared(engine):
+    assert get_engine() is engine
+    assert get_engine() is get_engine()
+
+def test_vote_page_uses_one_connection(client, engine, open_poll_setup):
+    checkouts = _count_checkouts(engine)
+    response = client.get('/vote?token={}&poll_id={}'.format(
+        open_poll_setup['voter_token'], open_poll_setup['poll_id']))
+    assert response.status_code == 200
+    assert b'Cast your votes' in response.data
+    assert len(checkouts) == 1
+
+def test_vote_post(client, open_poll_setup):
+    yes_id, no_id = open_poll_setup['option_ids']
+    response = client.post(
+        '/vote?token={}&poll_id={}'.format(open_poll_setup['voter_token'],
+                                           open_poll_setup['poll_id']),
+        data={'vote${}'.format(yes_id): '1', 'vote${}'.format(no_id): '0'})
+    assert response.status_code == 200
+    assert b'Successfully voted' in response.data
+
+def test_register_queues_email(client, engine, open_poll_setup):
+    response = client.post('/register', data={
+        'event_token': open_poll_setup['event_token'],
+        'email': 'newcomer@someplace.eu'})
+    assert response.status_code == 200
+    assert b'Voting email sent' in response.data
+    session = create_session(engine)
+    message, = session.query(OutboxMessage).all()
+    assert message.address == 'newcomer@someplace.eu'
+    assert message.sent_time is None
+    assert '/vote?token=' in message.body
+
+def test_vote_page_is_served_from_caches(client, engine, open_poll_setup):
+    url = '/vote?token={}&poll_id={}'.format(open_poll_setup['voter_token'],
+                                             open_poll_setup['poll_id'])
+    client.get(url)
+    statements = []
+    sqlalchemy_event.listen(engine, 'before_cursor_execute',
+                            lambda *args: statements.append(args[2]))
+    response = client.get(url)
+    assert b'Cast your votes' in response.data
+    assert not any('FROM voters' in statement for statement in statements)
+    assert not any('FROM proxies' in statement for statement in statements)
+    assert not any('FROM polls' in statement for statement in statements)
+    assert not any('FROM poll_options' in statement for statement in statements)
+
+def test_vote_weight_changed_by_another_process(client, engine,
+                                                open_poll_setup):
+    yes_id, no_id = open_poll_setup['option_ids']
+    url = '/vote?token={}&poll_id={}'.format(open_poll_setup['voter_token'],
+                                             open_poll_setup['poll_id'])
+    assert b'only 1 vote' in client.get(url).data
+    # The CLI adds a proxy; this process's cached page doesn't know
+    subprocess.run([sys.executable, '-c', (
+        "from electobot.database import create_engine, create_session, "
+        "create_proxy\n"
+        "session = create_session(create_engine(path={!r}))\n"
+        "create_proxy(1, 'someone@someplace.eu', 'proxy@someplace.eu', "
+        "session=session)").format(engine.url.database)], check=True)
+    response = client.post(url, data={'vote${}'.format(yes_id): '1',
+                                      'vote${}'.format(no_id): '0'})
+    assert b'Not all possible votes assigned' in response.data
+    assert b'Successfully voted' not in response.data
+    assert b'2 votes' in client.get(url).data
+    response = client.post(url, data={'vote${}'.format(yes_id): '2',
+                                      'vote${}'.format(no_id): '0'})
+    assert b'Successfully voted' in response.data
+    session = create_session(engine)
+    assert tally_poll(open_poll_setup['poll_id'], session=session) == {
+        yes_id: 2}
+    session.close()
+
+def _read_event(response):
+    for chunk in response.response:
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if chunk.startswith('event: tally'):
+            return json.loads(chunk.split('data: ', 1)[1])
+
+def test_live_tally_requires_admin_token(client, open_poll_setup):
+    url = '/admin/polls/{}/stream'.format(open_poll_setup['poll_id'])
+    assert client.get(url).status_code == 403
+    assert client.get(url + '?admin_token=wrong').status_code == 403
+    # Unknown polls don't get a stream, nor a watcher kept for them
+    for unknown in ['/admin/polls/999/stream', '/admin/polls/999']:
+        assert client.get(unknown + '?admin_token=organizer-secret'
+                          ).status_code == 404
+    assert not any(poll_id == 999 for _, poll_id in _watchers)
+    app.config['ADMIN_TOKEN'] = None
+    assert client.get(url + '?admin_token=organizer-secret').status_code == 404
+
+def test_live_tally_streams_changes(client, open_poll_setup):
+    response = client.get(
+        '/admin/polls/{}/stream'.format(open_poll_setup['poll_id']),
+        headers={'Authorization': 'Bearer organizer-secret'})
+    assert response.mimetype == 'text/event-stream'
+    tally = _read_event(response)
+    assert tally['turnout'] == 0
+    assert tally['registered'] == 1
+    assert [option['votes'] for option in tally['options']] == [0, 0]
+
+    yes_id, no_id = open_poll_setup['option_ids']
+    client.post(
+        '/vote?token={}&poll_id={}'.format(open_poll_setup['voter_token'],
+                                           open_poll_setup['poll_id']),
+        data={'vote${}'.format(yes_id): '1', 'vote${}'.format(no_id): '0'})
+    tally = _read_event(response)
+    assert tally['turnout'] == 1
+    assert [option['votes'] for option in tally['options']] == [1, 0]
+    assert len(_watchers) == 1
+    response.close()
+    # Nobody watches anymore
+    assert _watchers == {}
+
+def test_live_tally_streams_are_bounded(client, open_poll_setup,
+                                        monkeypatch):
+    monkeypatch.setitem(app.config, 'LIVE_TALLY_MAX_STREAMS', 1)
+    monkeypatch.setitem(app.config, 'LIVE_TALLY_MAX_STREAM_SECONDS', 0.2)
+    monkeypatch.setitem(app.config, 'LIVE_TALLY_KEEPALIVE', 0.05)
+    url = '/admin/polls/{}/stream?admin_token=organizer-secret'.format(
+        open_poll_setup['poll_id'])
+    response = client.get(url)
+    busy = client.get(url)
+    assert busy.status_code == 503 and busy.headers['Retry-After'] == '1'
+    # The stream ends by itself; the browser then opens a new one
+    chunks = list(response.response)
+    assert chunks[0].startswith(b'event: tally')
+    response.close()
+    assert _watchers == {}
+    response = client.get(url)
+    assert response.status_code == 200
+    response.close()
+
+def test_metrics(client, open_poll_setup):
+    assert client.get('/metrics').status_code == 403
+    yes_id, no_id = open_poll_setup['option_ids']
+    url = '/vote?token={}&poll_id={}'.format(open_poll_setup['voter_token'],
+                                             open_poll_setup['poll_id'])
+    form = {'vote${}'.format(yes_id): '1', 'vote${}'.format(no_id): '0'}
+    client.post(url, data=form)
+    client.post(url, data=form)
+
+    response = client.get('/metrics',
+                          headers={'Authorization': 'Bearer organizer-secret'})
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert any(line.startswith(
+        'electobot_votes_cast_total{{poll_id="{}"}}'.format(
+            open_poll_setup['poll_id'])) for line in lines)
+    assert any(line.startswith(
+        'electobot_ballots_rejected_total{reason="VoteExceptionAlreadyVoted"}')
+        for line in lines)
+    assert any(line.startswith(
+        'electobot_http_request_duration_seconds_count{route="/vote",'
+        'method="POST",status="200"}') for line in lines)
+    assert any(line.startswith(
+        'electobot_http_request_db_duration_seconds_sum{route="/vote"}')
+        for line in lines)
+
+def test_query_counts_are_bounded(client, open_poll_setup, max_queries):
+    token, poll_id = open_poll_setup['voter_token'], open_poll_setup['poll_id']
+    yes_id, no_id = open_poll_setup['option_ids']
+    url = '/vote?token={}&poll_id={}'.format(token, poll_id)
+    with max_queries(3):
+        client.get('/vote?token={}'.format(token))
+    with max_queries(2) as stats:
+        client.get(url)
+    assert stats.repeated() == []
+    with max_queries(6):
+        client.post(url, data={'vote${}'.format(yes_id): '1',
+                               'vote${}'.format(no_id): '0'})
+    with max_queries(7):
+        client.post('/register',
+                    data={'event_token': open_poll_setup['event_token'],
+                          'email': 'new@someplace.eu'})
+
+def test_api_voter_and_polls(client, open_poll_setup):
+    assert client.get('/api/v1/voter').status_code == 401
+    headers = {'Authorization': 'Bearer ' + open_poll_setup['voter_token']}
+    voter = client.get('/api/v1/voter', headers=headers).get_json()
+    assert voter['vote_weight'] == 1 and voter['proxies'] == []
+
+    polls = client.get('/api/v1/polls', headers=headers).get_json()['polls']
+    poll, = polls
+    assert poll['poll_id'] == open_poll_setup['poll_id']
+    assert not poll['voted']
+    assert [option['poll_option_id'] for option in poll['options']] \
+        == open_poll_setup['option_ids']
+
+def test_ranked_poll(client, engine, open_poll_setup):
+    session = create_session(engine)
+    poll = create_poll(1, "Board election",
+                       start_time=datetime.utcnow() - timedelta(minutes=1),
+                       tally_method='irv', session=session)
+    poll_id = poll.poll_id
+    option_ids = [create_poll_option(poll_id, name,
+                                     session=session).poll_option_id
+                  for name in ["Anna", "Bob", "Carol"]]
+    open_poll(poll_id, session=session)
+    session.close()
+    token = open_poll_setup['voter_token']
+    url = '/vote?token={}&poll_id={}'.format(token, poll_id)
+    page = client.get(url).get_data(as_text=True)
+    assert 'Rank the options' in page and 'max="3"' in page
+
+    form = {'vote${}'.format(option_id): rank
+            for option_id, rank in zip(option_ids, ['1', '1', '0'])}
+    assert b'Invalid ballot' in client.post(url, data=form).data
+    headers = {'Authorization': 'Bearer ' + token}
+    polls = client.get('/api/v1/polls', headers=headers).get_json()['polls']
+    assert {poll['tally_method'] for poll in polls} == {'plurality', 'irv'}
+    response = client.post('/api/v1/polls/{}/ballot'.format(poll_id),
+                           json={str(option_ids[2]): 1,
+                                 str(option_ids[0]): 2},
+                           headers=headers)
+    assert response.get_json() == {'poll_id': poll_id, 'voted': True}
+
+def test_busy_routes_are_shed(client, open_poll_setup):
+    from electobot.admission import Admission
+    default_admission = app.config['ADMISSION']
+    app.config['ADMISSION'] = {'vote': Admission(rate=1, burst=1, max_wait=0)}
+    try:
+        headers = {'Authorization': 'Bearer ' + open_poll_setup['voter_token']}
+        url = '/api/v1/polls/{}/ballot'.format(open_poll_setup['poll_id'])
+        yes_id, no_id = open_poll_setup['option_ids']
+        body = {str(yes_id): 1, str(no_id): 0}
+        assert client.post(url, json=body, headers=headers).status_code == 200
+        response = client.post(url, json=body, headers=headers)
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        assert response.get_json()['error']['code'] == 'busy'
+        # Registration has no limits configured here
+        response = client.post('/register', data={
+            'event_token': open_poll_setup['event_token'],
+            'email': 'other@someplace.eu'})
+        assert response.status_code == 200
+    finally:
+        app.config['ADMISSION'] = default_admission
+
+def test_api_ballot(client, engine, open_poll_setup):
+    headers = {'Authorization': 'Bearer ' + open_poll_setup['voter_token']}
+    poll_id = open_poll_setup['poll_id']
+    yes_id, no_id = open_poll_setup['option_ids']
+    url = '/api/v1/polls/{}/ballot'.format(poll_id)
+
+    def post(body):
+        response = client.post(url, json=body, headers=headers)
+        return response.status_code, response.get_json()
+
+    assert post({str(yes_id): 0})[1]['error']['code'] == 'too_few_votes'
+    assert post({str(yes_id): 'one'})[0] == 400
+    # An option of another poll in the same event
+    session = create_session(engine)
+    other = create_poll(1, "Another motion", session=session)
+    other_id = create_poll_option(other.poll_id, "Yes",
+                                  session=session).poll_option_id
+    session.close()
+    status, body = post({str(other_id): 1})
+    assert (status, body['error']['code']) == (422, 'wrong_option')
+
+    response = client.post(url, json={str(yes_id): 1}, headers=headers)
+    assert response.status_code == 200
+    assert response.get_json() == {'poll_id': poll_id, 'voted': True}
+    html = client.post('/vote?token={}&poll_id={}'.format(
+        open_poll_setup['voter_token'], poll_id),
+        data={'vote${}'.format(yes_id): '1'})
+    assert len(response.data) < len(html.data) / 10
+
+    status, body = post({str(yes_id): 1})
+    assert (status, body['error']['code']) == (409, 'already_voted')
+    polls = client.get('/api/v1/polls', headers=headers).get_json()['polls']
+    assert polls[0]['voted']
+
+def test_rendered_fragments_are_cached_per_poll_version(client, engine,
+                                                         open_poll_setup):
+    token, poll_id = open_poll_setup['voter_token'], open_poll_setup['poll_id']
+    pages = ['/vote?token={}'.format(token),
+             '/vote?token={}&poll_id={}'.format(token, poll_id)]
+    app.config['RENDER_CACHE'] = False
+    uncached = [client.get(page).data for page in pages]
+    app.config['RENDER_CACHE'] = True
+    try:
+        assert [client.get(page).data for page in pages] == uncached
+        assert [client.get(page).data for page in pages] == uncached
+
+        # Opening a poll shows up right away; escaped names never look
+        # like the per-voter markers
+        session = create_session(engine)
+        poll = create_poll(1, "Motion <voter-token/>",
+                           start_time=datetime.utcnow() - timedelta(minutes=1),
+                           session=session)
+        new_poll_id = poll.poll_id
+        create_poll_option(new_poll_id, "Yes", session=session)
+        open_poll(new_poll_id, session=session)
+        session.close()
+        data = client.get(pages[0]).get_data(as_text=True)
+        assert 'Motion &lt;voter-token/&gt;' in data
+        assert 'token={}&amp;poll_id={}'.format(token, new_poll_id) in data
+    finally:
+        app.config['RENDER_CACHE'] = True
+
+def _add_poll(engine, name, option_names):
+    session = create_session(engine)
+    poll = create_poll(1, name,
+                       start_time=datetime.utcnow() - timedelta(minutes=1),
+                       session=session)
+    poll_id = poll.poll_id
+    option_ids = [create_poll_option(poll_id, option_name,
+                                     session=session).poll_option_id
+                  for option_name in option_names]
+    open_poll(poll_id, session=session)
+    session.close()
+    return poll_id, option_ids
+
+def test_combined_ballot(client, engine, open_poll_setup, max_queries):
+    token = open_poll_setup['voter_token']
+    yes_id, no_id = open_poll_setup['option_ids']
+    other_id, (for_id, against_id) = _add_poll(engine, "Budget",
+                                               ["For", "Against"])
+    assert b'/ballot?token=' in client.get('/vote?token={}'.format(token)).data
+    url = '/ballot?token={}'.format(token)
+    page = client.get(url).get_data(as_text=True)
+    assert 'Budget' in page and 'Submit all votes' in page
+    assert page.count('name="poll_ids"') == 2
+
+    form = {'poll_ids': [open_poll_setup['poll_id'], other_id],
+            'vote${}'.format(yes_id): '1', 'vote${}'.format(for_id): '0'}
+    response = client.post(url, data=form)
+    assert b'Budget: Not all possible votes assigned.' in response.data
+    # Casting in two polls takes as many queries as in one would
+    form['vote${}'.format(against_id)] = '1'
+    with max_queries(6):
+        response = client.post(url, data=form)
+    assert b'Successfully voted for' in response.data
+    assert b'already voted in every open poll' in client.get(url).data
+
+def test_api_ballots(client, engine, open_poll_setup):
+    headers = {'Authorization': 'Bearer ' + open_poll_setup['voter_token']}
+    poll_id = open_poll_setup['poll_id']
+    yes_id, no_id = open_poll_setup['option_ids']
+    other_id, (for_id, against_id) = _add_poll(engine, "Budget",
+                                               ["For", "Against"])
+    assert client.post('/api/v1/ballots', json=[],
+                       headers=headers).status_code == 400
+    response = client.post('/api/v1/ballots', headers=headers, json={
+        str(poll_id): {str(yes_id): 1}, str(other_id): {str(yes_id): 1}})
+    assert response.status_code == 422
+    assert response.get_json()['error']['code'] == 'wrong_option'
+    assert response.get_json()['error']['poll_id'] == other_id
+
+    response = client.post('/api/v1/ballots', headers=headers, json={
+        str(poll_id): {str(yes_id): 1}, str(other_id): {str(for_id): 1}})
+    assert response.get_json() == {'poll_ids': sorted([poll_id, other_id]),
+                                   'voted': True}
+    polls = client.get('/api/v1/polls', headers=headers).get_json()['polls']
+    assert all(poll['voted'] for poll in polls)
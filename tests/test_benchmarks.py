@@ -0,0 +1,338 @@
+"""
+Timing benchmarks. They assert only coarse relations between timings so they
+stay stable on slow machines; run with `pytest -s tests/test_benchmarks.py` to
+see the numbers. Timings that are too close to compare reliably are only
+checked with `ELECTOBOT_STRICT_BENCHMARKS=1`.
+"""
+import os
+import random
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pytest
+
+from electobot.database import (create_engine, create_all_tables,
+                                create_session, create_event,
+                                voter_from_email, Voter, create_voter,
+                                create_voters, create_poll,
+                                create_poll_option, open_poll, cast_vote,
+                                voter_from_token, tally_poll, SQLITE_PROFILES,
+                                event_from_token, set_engine, Ballot)
+from electobot.email_pattern import email_allowed
+from electobot.metrics import Registry
+from electobot.token import gen_token
+from .helpers import EMAIL_PATTERN
+
+STRICT = os.environ.get('ELECTOBOT_STRICT_BENCHMARKS') == '1'
+
+def report(name, **timings):
+    print('\n{}: {}'.format(name, ', '.join(
+        '{}={:.3f}ms'.format(key, value * 1000)
+        for key, value in timings.items())))
+
+def time_per_call(function, args_list):
+    start = time.perf_counter()
+    for args in args_list:
+        function(*args)
+    return (time.perf_counter() - start) / len(args_list)
+
+def test_voter_lookup_with_and_without_index(tmp_path):
+    n_voters = 50000
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'))
+    create_all_tables(engine)
+    session = create_session(engine)
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    session.execute(Voter.__table__.insert(), [
+        {'event_id': event.event_id, 'email': 'voter{}@someplace.eu'.format(i),
+         'token': gen_token()}
+        for i in range(n_voters)
+    ])
+    session.commit()
+    lookups = [(event.event_id, 'voter{}@someplace.eu'.format(i), session)
+               for i in random.Random(0).sample(range(n_voters), 200)]
+
+    indexed = time_per_call(voter_from_email, lookups)
+    session.execute('DROP INDEX uq_voters_event_email')
+    session.commit()
+    unindexed = time_per_call(voter_from_email, lookups)
+
+    report('voter_from_email at {} voters'.format(n_voters),
+           without_index=unindexed, with_index=indexed)
+    assert indexed < unindexed
+
+def test_bulk_voter_import(tmp_path):
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'))
+    create_all_tables(engine)
+    session = create_session(engine)
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    emails = ['member{}@someplace.eu'.format(i) for i in range(10000)]
+
+    start = time.perf_counter()
+    created, rejected = create_voters(event.event_id, emails, session=session)
+    bulk = time.perf_counter() - start
+
+    single_emails = ['single{}@someplace.eu'.format(i) for i in range(100)]
+    one_by_one = time_per_call(
+        create_voter, [(event.event_id, email, session)
+                       for email in single_emails])
+
+    report('voter import', bulk_10k_total=bulk, bulk_per_voter=bulk / 10000,
+           one_by_one_per_voter=one_by_one)
+    assert len(created) == 10000 and rejected == []
+    assert session.query(Voter).count() == 10100
+    assert bulk / 10000 < one_by_one
+
+def test_registration_email_check(tmp_path):
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'))
+    create_all_tables(engine)
+    session = create_session(engine)
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    usual = [(event, 'member{}@someplace.eu'.format(i)) for i in range(1000)]
+    # No dot after the @, so the pattern backtracks as far as it can
+    adversarial = [(event, '@' * 10000)] * 10
+
+    per_email = time_per_call(email_allowed, usual)
+    per_adversarial = time_per_call(email_allowed, adversarial)
+
+    report('email pattern check', usual=per_email,
+           adversarial=per_adversarial)
+    # Over-long input is refused before the regex sees it
+    assert per_adversarial < 0.001
+
+@pytest.mark.parametrize('sqlite_pool', ['null', 'queue'])
+def test_session_per_request_by_pool(tmp_path, sqlite_pool):
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'),
+                           sqlite_pool=sqlite_pool)
+    create_all_tables(engine)
+    setup_session = create_session(engine)
+    token = create_event("General Assembly", EMAIL_PATTERN,
+                         session=setup_session).token
+    setup_session.close()
+
+    def request():
+        session = create_session(engine)
+        event_from_token(token, session=session)
+        session.close()
+
+    per_request = time_per_call(request, [()] * 500)
+    report('session per request with SQLite pool {}'.format(sqlite_pool),
+           per_request=per_request)
+
+def test_metric_update_overhead(tmp_path):
+    registry = Registry(directory=str(tmp_path))
+    counter = registry.counter('votes', "Votes", ['poll_id'])
+    histogram = registry.histogram('latency_seconds', "Latency", ['route'])
+    calls = [()] * 20000
+
+    per_inc = time_per_call(lambda: counter.inc(poll_id=1), calls)
+    per_observe = time_per_call(
+        lambda: histogram.observe(0.02, route='/vote'), calls)
+
+    report('metric update', counter_inc=per_inc,
+           histogram_observe=per_observe)
+    # Well under a millisecond, even with a flush to disk every second
+    assert per_inc < 0.0001 and per_observe < 0.0001
+
+def test_vote_page_render_cache(tmp_path):
+    pytest.importorskip('flask')
+    from app import app
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'))
+    create_all_tables(engine)
+    set_engine(engine)
+    session = create_session(engine)
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    token = create_voter(event.event_id, 'someone@someplace.eu',
+                         session=session).token
+    for i in range(20):
+        poll = create_poll(event.event_id, "Motion {}".format(i),
+                           start_time=datetime.utcnow() - timedelta(minutes=1),
+                           session=session)
+        for j in range(8):
+            create_poll_option(poll.poll_id, "Candidate {}".format(j),
+                               session=session)
+        open_poll(poll.poll_id, session=session)
+    poll_id = poll.poll_id
+    session.close()
+    client = app.test_client()
+    pages = [('/vote?token={}'.format(token),),
+             ('/vote?token={}&poll_id={}'.format(token, poll_id),)] * 100
+    timings = {'uncached': [], 'cached': []}
+    try:
+        # Alternate and keep the best round, so a hiccup of the machine
+        # doesn't decide the comparison
+        for _ in range(3):
+            for render_cache in (False, True):
+                app.config['RENDER_CACHE'] = render_cache
+                client.get(pages[0][0])
+                timings['cached' if render_cache else 'uncached'].append(
+                    time_per_call(client.get, pages))
+        timings = {name: min(rounds) for name, rounds in timings.items()}
+    finally:
+        app.config['RENDER_CACHE'] = True
+        set_engine(None)
+    report('vote pages, 20 polls of 8 options', **timings)
+    assert timings['cached'] < timings['uncached']
+
+def _concurrent_vote_throughput(path, profile, n_voters=300, n_threads=8):
+    engine = create_engine(path=path, profile=profile)
+    create_all_tables(engine)
+    session = create_session(engine)
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    poll = create_poll(event.event_id, "Motion",
+                       start_time=datetime.utcnow() - timedelta(minutes=1),
+                       session=session)
+    yes_id = create_poll_option(poll.poll_id, "Yes",
+                                session=session).poll_option_id
+    open_poll(poll.poll_id, session=session)
+    created, _ = create_voters(event.event_id,
+                               ['voter{}@someplace.eu'.format(i)
+                                for i in range(n_voters)], session=session)
+    tokens = [token for _, token in created]
+    errors = []
+
+    def vote(tokens):
+        thread_session = create_session(engine)
+        for token in tokens:
+            try:
+                cast_vote(voter_from_token(token, session=thread_session),
+                          {yes_id: 1}, session=thread_session)
+            except Exception as e:
+                errors.append(e)
+        thread_session.close()
+
+    threads = [threading.Thread(target=vote, args=(tokens[i::n_threads],))
+               for i in range(n_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    assert errors == []
+    assert tally_poll(poll.poll_id, session=session) == {yes_id: n_voters}
+    return n_voters / duration
+
+def test_concurrent_cast_vote_by_profile(tmp_path):
+    # Best of alternating rounds, so a slow moment hurts all profiles alike
+    best = dict.fromkeys(SQLITE_PROFILES, 0.0)
+    for round_ in range(3):
+        for profile in sorted(SQLITE_PROFILES):
+            path = tmp_path / '{}-{}.sqlite'.format(profile, round_)
+            best[profile] = max(best[profile], _concurrent_vote_throughput(
+                str(path), profile, n_voters=200))
+    print('\ncast_vote by SQLite profile: {}'.format(', '.join(
+        '{}={:.0f} votes/s'.format(profile, votes_per_second)
+        for profile, votes_per_second in best.items())))
+    if STRICT:
+        assert best['throughput'] > best['legacy']
+        assert best['throughput'] > best['safe']
+        # Full fsyncs cost about what the rollback journal does
+        assert best['safe'] > 0.8 * best['legacy']
+
+def _naive_irv(option_ids, ballots):
+    """IRV the straightforward way: every round looks at every ballot."""
+    continuing = set(option_ids)
+    while True:
+        totals = dict.fromkeys(continuing, 0)
+        for weight, ranking in ballots:
+            for option_id in ranking:
+                if option_id in continuing:
+                    totals[option_id] += weight
+                    break
+        leader = max(totals, key=totals.get)
+        if totals[leader] * 2 > sum(totals.values()) or len(continuing) == 1:
+            return leader
+        continuing.discard(min(totals, key=totals.get))
+
+def test_ranked_count_of_100k_ballots():
+    from electobot.tally import merge_rankings, count_ranked, numpy
+    rng = random.Random(0)
+    option_ids = list(range(1, 9))
+    # Some candidates are more popular, so rankings repeat as they would
+    popularity = {option_id: 1 + option_id / 4 for option_id in option_ids}
+    ballots = []
+    rows = []
+    for i in range(100000):
+        ranking = sorted(option_ids,
+                         key=lambda o: rng.random() * popularity[o])
+        ranking = ranking[:rng.randint(1, 8)]
+        weight = 1 if rng.random() < 0.9 else 2
+        ballots.append((weight, ranking))
+        rows.extend((i, rank, option_id, weight)
+                    for rank, option_id in enumerate(ranking, start=1))
+
+    start = time.perf_counter()
+    naive_winner = _naive_irv(option_ids, ballots)
+    timings = {'per_ballot': time.perf_counter() - start}
+    start = time.perf_counter()
+    rankings = merge_rankings(rows)
+    timings['merge'] = time.perf_counter() - start
+    for use_numpy in [False] + ([True] if numpy is not None else []):
+        start = time.perf_counter()
+        result = count_ranked(option_ids, rankings, method='irv',
+                              use_numpy=use_numpy)
+        timings['arrays' if use_numpy else 'lists'] = \
+            time.perf_counter() - start
+        assert result.elected == [naive_winner]
+    start = time.perf_counter()
+    count_ranked(option_ids, rankings, method='stv', seats=3)
+    timings['stv_3_seats'] = time.perf_counter() - start
+    report('100k ranked ballots, {} distinct'.format(len(rankings)),
+           **timings)
+    assert timings['lists'] < timings['per_ballot']
+
+class _NullFile:
+    def write(self, text):
+        return len(text)
+
+def _peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def test_export_memory_does_not_grow_with_table(tmp_path):
+    from electobot.export import export_table
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'))
+    create_all_tables(engine)
+    session = create_session(engine)
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    poll_id = create_poll(event.event_id, "Motion", session=session).poll_id
+    option_id = create_poll_option(poll_id, "Yes",
+                                   session=session).poll_option_id
+    now = datetime.utcnow()
+
+    def add_ballots(n):
+        if n <= 0:
+            return
+        session.execute(Ballot.__table__.insert(), [
+            {'poll_id': poll_id, 'poll_option_id': option_id,
+             'weight': 1, 'cast_time': now, 'cast_id': gen_token()}
+            for _ in range(n)])
+        session.commit()
+
+    peaks = {}
+    add_ballots(5000)
+    # What print_table used to hold: every row as an ORM object
+    peaks['orm_5k'] = _peak_memory(lambda: session.query(Ballot).all())
+    session.expunge_all()
+    for n in (5000, 20000):
+        add_ballots(n - session.query(Ballot).count())
+        for format in ('csv', 'jsonl'):
+            peaks['{}_{}k'.format(format, n // 1000)] = _peak_memory(
+                lambda: export_table(Ballot, _NullFile(), format=format,
+                                     session=session))
+    start = time.perf_counter()
+    export_table(Ballot, _NullFile(), session=session)
+    export_time = time.perf_counter() - start
+    session.close()
+    print('\nExport peak memory: {}; 20k rows in {:.3f}s'.format(
+        ', '.join('{}={:.0f}kB'.format(key, value / 1024)
+                  for key, value in peaks.items()), export_time))
+    for format in ('csv', 'jsonl'):
+        assert peaks[format + '_20k'] < 2 * peaks[format + '_5k']
+        assert peaks[format + '_20k'] < peaks['orm_5k'] / 5
@@ -0,0 +1,38 @@
+from electobot.cache import LRUCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_least_recently_used_is_evicted():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+def test_entries_expire():
+    clock = FakeClock()
+    cache = LRUCache(ttl=10, clock=clock)
+    cache.set('a', 1)
+    clock.now = 9.9
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a', 'gone') == 'gone'
+
+def test_invalidation():
+    cache = LRUCache()
+    for key in range(6):
+        cache.set(key, key % 3)
+    cache.discard_where(lambda value: value == 0)
+    cache.pop(1)
+    assert sorted(key for key in range(6) if cache.get(key) is not None) == [2, 4, 5]
+    cache.clear()
+    assert len(cache) == 0
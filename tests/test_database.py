@@ -1,6 +1,11 @@
 import pytest
+import threading
 from datetime import datetime, timedelta
 
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy import inspect
+from sqlalchemy.pool import NullPool, QueuePool, SingletonThreadPool
+
 from electobot.database import (create_engine, create_all_tables,
                                 create_session, create_event,
                                 most_recent_event, event_from_identifier,
@@ -9,8 +14,23 @@ from electobot.database import (create_engine, create_all_tables,
                                 create_proxy, votes_for_voter, create_poll,
                                 polls_from_event, create_poll_option,
                                 poll_options_from_poll, cast_vote,
-                                render_table, Event)
-from electobot.exceptions import VoteExceptionTooFew, VoteExceptionNegative
+                                render_table, Event, open_poll, PollOption,
+                                VoteCast, Ballot, tally_poll, recount_poll,
+                                upgrade_tables, votes_to_table,
+                                voter_context_from_token, delete_event,
+                                open_polls_from_event, options_from_poll,
+                                close_poll, poll_version, Poll, create_voters,
+                                create_proxies, rotate_voter_tokens,
+                                clear_voter_contexts, delete_proxy,
+                                check_vote_weights, Proxy, cast_votes,
+                                VoterContext)
+from electobot import database
+from electobot.exceptions import (VoteExceptionTooFew, VoteExceptionNegative,
+                                  VoteExceptionAlreadyVoted,
+                                  VoteExceptionWrongId,
+                                  DBExceptionEmailAlreadyUsed,
+                                  DBExceptionUpgradeFailed)
+from .helpers import EMAIL_PATTERN
 
 def create_test_engine():
     return create_engine(path=":memory:", echo=True)
@@ -44,7 +64,7 @@ def test_create_and_query_event(clean_session):
     expected_simple_postfix = "general_assembly_20202021"
     expected_simple_name = (_expected_date_prefix()
                               + '-' + expected_simple_postfix)
-    create_event(name, session=clean_session)
+    create_event(name, EMAIL_PATTERN, session=clean_session)
     event = most_recent_event(session=clean_session)
     assert event is not None
     assert event.simple_name == expected_simple_name
@@ -53,7 +73,7 @@ def test_create_and_query_event(clean_session):
     expected_simple_postfix_2 = "general_reassembly_20202021"
     expected_simple_name_2 = (_expected_date_prefix()
                               + '-' + expected_simple_postfix_2)
-    create_event(name_2, session=clean_session)
+    create_event(name_2, EMAIL_PATTERN, session=clean_session)
     event = most_recent_event(session=clean_session)
     assert event is not None
     assert event.simple_name == expected_simple_name_2
@@ -67,7 +87,7 @@ def test_create_and_query_event(clean_session):
 
 def test_create_and_query_voter(clean_session):
     name = "General Assembly 2020/2021"
-    create_event(name, session=clean_session)
+    create_event(name, EMAIL_PATTERN, session=clean_session)
     event = most_recent_event(session=clean_session)
     identifier = event.simple_name
 
@@ -81,7 +101,7 @@ def test_create_and_query_voter(clean_session):
 
 def test_create_proxy(clean_session):
     name = "General Assembly 2020/2021"
-    create_event(name, session=clean_session)
+    create_event(name, EMAIL_PATTERN, session=clean_session)
     event = most_recent_event(session=clean_session)
     identifier = event.simple_name
 
@@ -97,10 +117,14 @@ def test_create_proxy(clean_session):
     create_proxy(identifier, email, 'proxygirl@someplace.eu',
                  session=clean_session)
     assert votes_for_voter(voter, session=clean_session) == 3
+    # A context cached before the proxies were added
+    stale = VoterContext(voter_id=voter.voter_id, event_id=voter.event_id,
+                         token=voter.token, vote_weight=1, proxy_emails=())
+    assert votes_for_voter(stale, session=clean_session) == 3
 
 def test_create_and_query_poll(clean_session):
     name = "General Assembly 2020/2021"
-    create_event(name, session=clean_session)
+    create_event(name, EMAIL_PATTERN, session=clean_session)
     event = most_recent_event(session=clean_session)
     identifier = event.simple_name
 
@@ -137,7 +161,7 @@ def test_create_and_query_poll(clean_session):
 
 def perform_vote(clean_session):
     event_name = "General Assembly 2020/2021"
-    event = create_event(event_name, session=clean_session)
+    event = create_event(event_name, EMAIL_PATTERN, session=clean_session)
     identifier = event.simple_name
 
     poll_name = "Is the new board elected?"
@@ -201,5 +225,460 @@ def perform_vote(clean_session):
 
 def test_render_table(clean_session):
     # Just test for crash
-    create_event("Anything", session=clean_session)
+    create_event("Anything", EMAIL_PATTERN, session=clean_session)
     print(render_table(Event, clean_session))
+
+def _open_poll_with_options(session, option_names, event=None):
+    if event is None:
+        event = create_event("General Assembly", EMAIL_PATTERN,
+                             session=session)
+    poll = create_poll(event.event_id, "Is the new board elected?",
+                       start_time=datetime.utcnow() - timedelta(minutes=1),
+                       session=session)
+    option_ids = [
+        create_poll_option(poll.poll_id, name, session=session).poll_option_id
+        for name in option_names
+    ]
+    open_poll(poll.poll_id, session=session)
+    return event, poll, option_ids
+
+def _totals(session, poll_id):
+    counts = tally_poll(poll_id, session=session)
+    return {
+        option.poll_option_id: counts.get(option.poll_option_id, 0)
+        for option in poll_options_from_poll(poll_id, session=session)
+    }
+
+def test_cast_vote(clean_session):
+    event, poll, (yes_id, no_id) = _open_poll_with_options(clean_session,
+                                                           ["Yes", "No"])
+    email = 'someone@someplace.eu'
+    voter = create_voter(event.event_id, email, session=clean_session)
+    create_proxy(event.event_id, email, 'proxyboi@someplace.eu',
+                 session=clean_session)
+    with pytest.raises(VoteExceptionTooFew):
+        cast_vote(voter, {yes_id: 1}, session=clean_session)
+    with pytest.raises(VoteExceptionWrongId):
+        cast_vote(voter, {yes_id: 1, 12345: 1}, session=clean_session)
+    cast_vote(voter, {yes_id: 2, no_id: 0, 'abstain': 0},
+              session=clean_session)
+    with pytest.raises(VoteExceptionAlreadyVoted):
+        cast_vote(voter, {yes_id: 2}, session=clean_session)
+    assert _totals(clean_session, poll.poll_id) == {yes_id: 2, no_id: 0}
+
+def _count_statements(engine):
+    statements = []
+    sqlalchemy_event.listen(engine, 'before_cursor_execute',
+                            lambda *args: statements.append(args[2]))
+    return statements
+
+def test_cast_vote_query_count_is_constant(clean_session):
+    event, _, two_options = _open_poll_with_options(clean_session,
+                                                    ["Yes", "No"])
+    _, _, ten_options = _open_poll_with_options(
+        clean_session, ["Candidate {}".format(i) for i in range(10)],
+        event=event)
+    voter = create_voter(event.event_id, 'someone@someplace.eu',
+                         session=clean_session)
+
+    statements = _count_statements(clean_session.get_bind())
+    cast_vote(voter, {two_options[0]: 1, two_options[1]: 0},
+              session=clean_session)
+    two_option_count = len(statements)
+    del statements[:]
+    vote_dict = {option_id: 0 for option_id in ten_options}
+    vote_dict[ten_options[3]] = 1
+    cast_vote(voter, vote_dict, session=clean_session)
+    assert len(statements) == two_option_count
+
+def test_concurrent_votes_are_counted_exactly(tmp_path):
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'))
+    create_all_tables(engine)
+    session = create_session(engine)
+    event, poll, (yes_id, no_id) = _open_poll_with_options(session,
+                                                           ["Yes", "No"])
+    voters = [
+        create_voter(event.event_id, 'voter{}@someplace.eu'.format(i),
+                     session=session)
+        for i in range(120)
+    ]
+    # Each voter submits twice; only one submission per voter may count
+    jobs = [(voter.token, i) for i, voter in enumerate(voters)] * 2
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        thread_session = create_session(engine)
+        while True:
+            with lock:
+                if not jobs:
+                    break
+                token, i = jobs.pop()
+            voter = voter_from_token(token, session=thread_session)
+            option = yes_id if i % 3 else no_id
+            try:
+                cast_vote(voter, {yes_id: 0, no_id: 0, option: 1},
+                          session=thread_session)
+            except VoteExceptionAlreadyVoted:
+                pass
+            except Exception as e:
+                errors.append(e)
+        thread_session.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    expected_no = len([i for i in range(len(voters)) if i % 3 == 0])
+    check_session = create_session(engine)
+    assert _totals(check_session, poll.poll_id) == {
+        yes_id: len(voters) - expected_no,
+        no_id: expected_no,
+    }
+    assert check_session.query(VoteCast).count() == len(voters)
+
+def test_tally_continues_from_checkpoint(clean_session):
+    event, poll, (yes_id, no_id) = _open_poll_with_options(clean_session,
+                                                           ["Yes", "No"])
+    voters = [
+        create_voter(event.event_id, 'voter{}@someplace.eu'.format(i),
+                     session=clean_session)
+        for i in range(6)
+    ]
+    for voter in voters[:3]:
+        cast_vote(voter, {yes_id: 1, no_id: 0}, session=clean_session)
+    assert tally_poll(poll.poll_id, session=clean_session) == {yes_id: 3}
+
+    for voter in voters[3:]:
+        cast_vote(voter, {yes_id: 0, no_id: 1}, session=clean_session)
+    statements = _count_statements(clean_session.get_bind())
+    assert tally_poll(poll.poll_id, session=clean_session) == {yes_id: 3,
+                                                               no_id: 3}
+    # Only the new ballots are aggregated
+    aggregate, = [statement for statement in statements
+                  if 'FROM ballots' in statement]
+    assert 'tally_checkpoints.last_ballot_id' in aggregate
+    assert (tally_poll(poll.poll_id, session=clean_session)
+            == recount_poll(poll.poll_id, session=clean_session))
+    # Ballots don't know who cast them
+    ballot_columns = set(Ballot.__table__.columns.keys())
+    assert 'voter_id' not in ballot_columns
+
+def test_upgrade_turns_counters_into_ballots(clean_session):
+    _, poll, (yes_id, no_id) = _open_poll_with_options(clean_session,
+                                                       ["Yes", "No"])
+    clean_session.query(PollOption).filter_by(poll_option_id=yes_id).update(
+        {PollOption.total_votes: 7})
+    clean_session.commit()
+    engine = clean_session.get_bind()
+    upgrade_tables(engine)
+    upgrade_tables(engine)
+    assert recount_poll(poll.poll_id, session=clean_session) == {yes_id: 7}
+    assert 'Yes' in votes_to_table(poll.poll_id, session=clean_session)
+
+def test_duplicate_voter_email_is_rejected(clean_session):
+    event = create_event("General Assembly", EMAIL_PATTERN,
+                         session=clean_session)
+    create_voter(event.event_id, 'someone@someplace.eu', session=clean_session)
+    with pytest.raises(DBExceptionEmailAlreadyUsed):
+        create_voter(event.event_id, 'someone@someplace.eu',
+                     session=clean_session)
+    # The session is still usable afterwards
+    assert voter_from_email(event.event_id, 'someone@someplace.eu',
+                            session=clean_session) is not None
+
+def test_upgrade_adds_missing_indexes(clean_session):
+    engine = clean_session.get_bind()
+    with engine.connect() as connection:
+        connection.execute('DROP INDEX uq_voters_event_email')
+        connection.execute('DROP INDEX ix_polls_event_start_time')
+    upgrade_tables(engine)
+    inspector = inspect(engine)
+    voter_indexes = {index['name']: index
+                     for index in inspector.get_indexes('voters')}
+    assert voter_indexes['uq_voters_event_email']['unique']
+    assert 'ix_polls_event_start_time' in [
+        index['name'] for index in inspector.get_indexes('polls')]
+
+def test_upgrade_fails_on_duplicate_voters(clean_session):
+    event = create_event("General Assembly", EMAIL_PATTERN,
+                         session=clean_session)
+    create_voter(event.event_id, 'someone@someplace.eu', session=clean_session)
+    engine = clean_session.get_bind()
+    with engine.connect() as connection:
+        connection.execute('DROP INDEX uq_voters_event_email')
+        connection.execute('DROP INDEX ix_polls_event_start_time')
+        # Registered twice by a version without the index
+        connection.execute(
+            "INSERT INTO voters (event_id, email, token, vote_weight) "
+            "VALUES ({}, 'someone@someplace.eu', 'other-token', 1)".format(
+                event.event_id))
+    with pytest.raises(DBExceptionUpgradeFailed):
+        upgrade_tables(engine)
+    # The rest of the upgrade went through
+    assert 'ix_polls_event_start_time' in [
+        index['name'] for index in inspect(engine).get_indexes('polls')]
+
+def test_voter_context_is_cached_until_proxy_added(clean_session):
+    event = create_event("General Assembly", EMAIL_PATTERN,
+                         session=clean_session)
+    email = 'someone@someplace.eu'
+    voter = create_voter(event.event_id, email, session=clean_session)
+    context = voter_context_from_token(voter.token, session=clean_session)
+    assert context.voter_id == voter.voter_id
+    assert context.vote_weight == 1
+
+    statements = _count_statements(clean_session.get_bind())
+    assert voter_context_from_token(voter.token,
+                                    session=clean_session) is context
+    assert statements == []
+
+    create_proxy(event.event_id, email, 'proxyboi@someplace.eu',
+                 session=clean_session)
+    context = voter_context_from_token(voter.token, session=clean_session)
+    assert context.vote_weight == 2
+    assert context.proxy_emails == ('proxyboi@someplace.eu',)
+
+    token = voter.token
+    delete_event(event.event_id, session=clean_session)
+    assert voter_context_from_token(token, session=clean_session) is None
+
+def test_open_polls_are_cached_per_version(clean_session):
+    event, poll, option_ids = _open_poll_with_options(clean_session,
+                                                      ["Yes", "No"])
+    polls = open_polls_from_event(event.event_id, session=clean_session)
+    assert [p.poll_id for p in polls] == [poll.poll_id]
+    options = options_from_poll(polls[0], session=clean_session)
+    assert [o.poll_option_id for o in options] == option_ids
+
+    statements = _count_statements(clean_session.get_bind())
+    assert open_polls_from_event(event.event_id,
+                                 session=clean_session) is polls
+    assert options_from_poll(polls[0], session=clean_session) is options
+    # Only the version is checked
+    assert all('poll_versions' in statement for statement in statements)
+
+    version = poll_version(event.event_id, session=clean_session)
+    create_poll_option(poll.poll_id, "Maybe", session=clean_session)
+    assert poll_version(event.event_id, session=clean_session) == version + 1
+    assert len(options_from_poll(polls[0], session=clean_session)) == 3
+    close_poll(poll.poll_id, session=clean_session)
+    assert open_polls_from_event(event.event_id, session=clean_session) == ()
+
+def test_create_voters_in_bulk(clean_session):
+    event = create_event("General Assembly", r"@someplace\.eu$",
+                         session=clean_session)
+    create_voter(event.event_id, 'existing@someplace.eu', session=clean_session)
+    emails = ['a@someplace.eu', 'b@elsewhere.eu', 'a@someplace.eu',
+              'existing@someplace.eu', 'c@someplace.eu']
+    created, rejected = create_voters(event.event_id, emails,
+                                      session=clean_session)
+    assert [email for email, _ in created] == ['a@someplace.eu',
+                                               'c@someplace.eu']
+    assert [email for email, _ in rejected] == ['b@elsewhere.eu',
+                                                'a@someplace.eu',
+                                                'existing@someplace.eu']
+    for email, token in created:
+        assert voter_from_token(token, session=clean_session).email == email
+
+def test_create_proxies_in_bulk(clean_session):
+    event = create_event("General Assembly", EMAIL_PATTERN,
+                         session=clean_session)
+    anna = create_voter(event.event_id, 'anna@someplace.eu',
+                        session=clean_session)
+    create_voter(event.event_id, 'bob@someplace.eu', session=clean_session)
+    create_proxy(event.event_id, 'bob@someplace.eu', 'carol@someplace.eu',
+                 session=clean_session)
+    # Cache anna's context, the import must invalidate it
+    assert voter_context_from_token(anna.token,
+                                    session=clean_session).vote_weight == 1
+    pairs = [
+        ('anna@someplace.eu', 'dave@someplace.eu'),
+        ('anna@someplace.eu', 'erin@someplace.eu'),
+        ('anna@someplace.eu', 'frank@someplace.eu'),
+        ('nobody@someplace.eu', 'gina@someplace.eu'),
+        ('anna@someplace.eu', 'bob@someplace.eu'),
+        ('anna@someplace.eu', 'carol@someplace.eu'),
+        ('bob@someplace.eu', 'dave@someplace.eu'),
+    ]
+    created, rejected = create_proxies(event.event_id, pairs,
+                                       max_proxies_per_voter=2,
+                                       session=clean_session)
+    assert created == pairs[:2]
+    assert [pair[:2] for pair in rejected] == pairs[2:]
+    context = voter_context_from_token(anna.token, session=clean_session)
+    assert context.vote_weight == 3
+    assert set(context.proxy_emails) == {'dave@someplace.eu',
+                                         'erin@someplace.eu'}
+
+def test_sqlite_profiles(tmp_path):
+    with pytest.raises(ValueError):
+        create_engine(path=str(tmp_path / 'db.sqlite'), profile='fastest')
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'),
+                           profile='throughput')
+    with engine.connect() as connection:
+        assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+        # NORMAL
+        assert connection.execute('PRAGMA synchronous').scalar() == 1
+        assert connection.execute('PRAGMA busy_timeout').scalar() == 10000
+        assert connection.execute('PRAGMA foreign_keys').scalar() == 1
+
+def test_database_url_and_pools(tmp_path):
+    path = str(tmp_path / 'db.sqlite')
+    engine = create_engine(url='sqlite:///' + path, sqlite_pool='queue')
+    assert isinstance(engine.pool, QueuePool)
+    create_all_tables(engine)
+    create_event("General Assembly", EMAIL_PATTERN,
+                 session=create_session(engine))
+    # The same file, opened by path
+    other = create_engine(path=path, sqlite_pool='null')
+    assert isinstance(other.pool, NullPool)
+    assert create_session(other).query(Event).count() == 1
+
+    # Every connection to :memory: is a new database, so it is never
+    # pooled per checkout
+    memory = create_engine(path=':memory:', sqlite_pool='null')
+    assert isinstance(memory.pool, SingletonThreadPool)
+    with pytest.raises(ValueError):
+        create_engine(path=path, sqlite_pool='bottomless')
+
+def test_signed_voter_tokens(clean_session, monkeypatch, max_queries):
+    monkeypatch.setattr(database, 'SIGNED_VOTER_TOKENS', True)
+    event = create_event("General Assembly", EMAIL_PATTERN,
+                         session=clean_session)
+    voter = create_voter(event.event_id, 'someone@someplace.eu',
+                         session=clean_session)
+    (_, bulk_token), = create_voters(event.event_id, ['other@someplace.eu'],
+                                     session=clean_session)[0]
+    assert voter.token.startswith('v1.{}.{}.'.format(voter.voter_id,
+                                                     event.event_id))
+    clear_voter_contexts()
+    # The voter and their proxies in one query
+    with max_queries(1):
+        context = voter_context_from_token(voter.token, session=clean_session)
+    assert context.voter_id == voter.voter_id
+    assert voter_context_from_token(bulk_token, session=clean_session)
+
+    # Forged or malformed tokens never reach the database
+    forged = voter.token[:-4] + '0000'
+    other_voter = voter.token.replace('v1.{}.'.format(voter.voter_id),
+                                      'v1.{}.'.format(voter.voter_id + 1), 1)
+    with max_queries(0):
+        for token in [forged, other_voter, 'v1.1.1', 'not-a-token', '']:
+            assert voter_context_from_token(token,
+                                            session=clean_session) is None
+
+def test_rotation_revokes_tokens(clean_session):
+    event = create_event("General Assembly", EMAIL_PATTERN,
+                         session=clean_session)
+    old_token = create_voter(event.event_id, 'someone@someplace.eu',
+                             session=clean_session).token
+    # Random tokens from before signing still work
+    assert voter_context_from_token(old_token, session=clean_session)
+
+    (email, token), = rotate_voter_tokens(event.event_id,
+                                          session=clean_session)
+    assert email == 'someone@someplace.eu'
+    assert voter_context_from_token(old_token, session=clean_session) is None
+    assert voter_context_from_token(token, session=clean_session)
+
+    (_, newest), = rotate_voter_tokens(event.event_id, session=clean_session)
+    assert voter_context_from_token(token, session=clean_session) is None
+    assert voter_context_from_token(newest, session=clean_session)
+
+def test_vote_weight_follows_proxies(clean_session):
+    event = create_event("General Assembly", EMAIL_PATTERN,
+                         session=clean_session)
+    anna = create_voter(event.event_id, 'anna@someplace.eu',
+                        session=clean_session)
+    bob = create_voter(event.event_id, 'bob@someplace.eu',
+                       session=clean_session)
+    create_proxy(event.event_id, 'anna@someplace.eu', 'carol@someplace.eu',
+                 session=clean_session)
+    create_proxies(event.event_id, [('anna@someplace.eu', 'dave@someplace.eu'),
+                                    ('bob@someplace.eu', 'erin@someplace.eu')],
+                   session=clean_session)
+    assert (anna.vote_weight, bob.vote_weight) == (3, 2)
+    assert delete_proxy(event.event_id, 'dave@someplace.eu',
+                        session=clean_session)
+    assert not delete_proxy(event.event_id, 'dave@someplace.eu',
+                            session=clean_session)
+    assert anna.vote_weight == 2
+    assert voter_context_from_token(anna.token,
+                                    session=clean_session).vote_weight == 2
+    assert check_vote_weights(session=clean_session) == []
+
+    # Proxies changed behind our back
+    clean_session.query(Proxy).filter_by(email='erin@someplace.eu').delete()
+    clean_session.commit()
+    assert check_vote_weights(event.event_id, session=clean_session) == [
+        ('bob@someplace.eu', 2, 1)]
+    check_vote_weights(repair=True, session=clean_session)
+    assert bob.vote_weight == 1
+    assert check_vote_weights(session=clean_session) == []
+
+def test_ballot_validation_does_not_count_proxies(clean_session):
+    event, poll, option_ids = _open_poll_with_options(clean_session,
+                                                      ["Yes", "No"])
+    voter = create_voter(event.event_id, 'anna@someplace.eu',
+                         session=clean_session)
+    create_proxy(event.event_id, 'anna@someplace.eu', 'bob@someplace.eu',
+                 session=clean_session)
+    statements = _count_statements(clean_session.get_bind())
+    cast_vote(voter, {option_ids[0]: 2}, session=clean_session)
+    assert not any('proxies' in statement for statement in statements)
+
+def test_upgrade_adds_vote_weight(tmp_path):
+    engine = create_engine(path=str(tmp_path / 'db.sqlite'))
+    create_all_tables(engine)
+    session = create_session(engine)
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    voter = create_voter(event.event_id, 'anna@someplace.eu', session=session)
+    create_proxy(event.event_id, 'anna@someplace.eu', 'bob@someplace.eu',
+                 session=session)
+    token = voter.token
+    session.close()
+    with engine.begin() as connection:
+        connection.execute('ALTER TABLE voters DROP COLUMN vote_weight')
+
+    upgrade_tables(engine)
+    clear_voter_contexts()
+    session = create_session(engine)
+    assert voter_from_token(token, session=session).vote_weight == 2
+    session.close()
+
+def test_cast_votes_in_several_polls(clean_session):
+    event, first, (yes_id, no_id) = _open_poll_with_options(clean_session,
+                                                            ["Yes", "No"])
+    _, second, (for_id, against_id) = _open_poll_with_options(
+        clean_session, ["For", "Against"], event=event)
+    first_id, second_id = first.poll_id, second.poll_id
+    voter = create_voter(event.event_id, 'anna@someplace.eu',
+                         session=clean_session)
+    # Nothing is written if one of the votes is invalid
+    with pytest.raises(VoteExceptionTooFew) as error:
+        cast_votes(voter, {first_id: {yes_id: 1}, second_id: {for_id: 0}},
+                   session=clean_session)
+    assert error.value.poll_id == second_id
+    with pytest.raises(VoteExceptionWrongId) as error:
+        cast_votes(voter, {first_id: {for_id: 1}}, session=clean_session)
+    assert error.value.poll_id == first_id
+    assert clean_session.query(VoteCast).count() == 0
+
+    cast_votes(voter, {first_id: {yes_id: 1}, second_id: {against_id: 1}},
+               session=clean_session)
+    assert _totals(clean_session, first_id) == {yes_id: 1, no_id: 0}
+    assert _totals(clean_session, second_id) == {for_id: 0, against_id: 1}
+    cast_ids = {cast_id for (cast_id,) in clean_session.query(Ballot.cast_id)}
+    assert len(cast_ids) == 2
+
+    _, third, (maybe_id,) = _open_poll_with_options(clean_session, ["Maybe"],
+                                                    event=event)
+    with pytest.raises(VoteExceptionAlreadyVoted) as error:
+        cast_votes(voter, {third.poll_id: {maybe_id: 1},
+                           second_id: {for_id: 1}}, session=clean_session)
+    assert error.value.poll_id == second_id
+    assert _totals(clean_session, third.poll_id) == {maybe_id: 0}
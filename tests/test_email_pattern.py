@@ -0,0 +1,67 @@
+import pytest
+
+from electobot.database import (create_event, delete_event,
+                                unsafe_email_patterns, Event)
+from electobot.email_pattern import (compile_email_pattern, email_allowed,
+                                     MAX_EMAIL_LENGTH, _compiled_patterns)
+from electobot.exceptions import DBExceptionInvalidEmailPattern
+
+@pytest.mark.parametrize('pattern', [
+    r".*@.*\..*",
+    r"^[a-z.]+@msvincognito\.nl$",
+    r".*@(student\.)?tue\.nl",
+    r"[^@]+@[^@]+\.(nl|eu)",
+    r"[a-z]+[0-9]*@x\.nl",
+    r"^[a-z]+[a-z0-9]*@x\.nl$",
+    r"^(\w+\.)+\w+@x$",
+    r"\w+(\w*)@x",
+    r"[a-z]+\w{0,9}@x",
+])
+def test_usual_patterns_are_accepted(pattern):
+    compile_email_pattern(pattern)
+
+@pytest.mark.parametrize('pattern', [
+    r"(a+)+@x",
+    r"(a|aa)*@x",
+    r"(.*)@\1",
+    r"(\w+\.?)*@x",
+    r".*.*.*.*@x",
+    r"\w*\w*\w*@x",
+    r"[a-z]*[a-z]*[a-z]*@x",
+    r"\w+\w{0,9}\w*(\w+)@x",
+    r"(\w+\w)+@x",
+    r"((a+)+\.)+@x",
+    r"[unclosed",
+])
+def test_unsafe_patterns_are_rejected(pattern):
+    with pytest.raises(DBExceptionInvalidEmailPattern):
+        compile_email_pattern(pattern)
+
+def test_create_event_rejects_unsafe_pattern(session):
+    with pytest.raises(DBExceptionInvalidEmailPattern):
+        create_event("General Assembly", r"(a+)+$", session=session)
+    assert session.query(Event).count() == 0
+
+def test_email_allowed(session):
+    event = create_event("General Assembly", r".*@someplace\.eu",
+                         session=session)
+    assert email_allowed(event, 'member@someplace.eu')
+    assert not email_allowed(event, 'member@elsewhere.eu')
+    long_email = 'a' * MAX_EMAIL_LENGTH + '@someplace.eu'
+    assert not email_allowed(event, long_email)
+
+    key = (event.event_id, event.email_pattern)
+    assert _compiled_patterns.get(key) is not None
+    delete_event(event.event_id, session=session)
+    assert _compiled_patterns.get(key, False) is False
+
+def test_unsafe_stored_pattern_is_reported(session):
+    # Stored before patterns were validated
+    event = create_event("General Assembly", r".*", session=session)
+    event.email_pattern = r"\w*\w*\w*@someplace\.eu"
+    session.commit()
+    assert email_allowed(event, 'member@someplace.eu')
+    assert unsafe_email_patterns(session=session) == [
+        (event.event_id, "General Assembly", event.email_pattern,
+         "At most 2 adjacent repeats that match the same characters are "
+         "allowed")]
@@ -0,0 +1,57 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from electobot.database import (create_event, create_voter,
+                                create_proxy, create_poll, create_poll_option,
+                                open_poll, cast_vote, Voter)
+from electobot.export import export_table, export_poll, write_rows
+from .helpers import EMAIL_PATTERN
+
+def test_export_table(session):
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    for i in range(5):
+        create_voter(event.event_id, 'member{}@someplace.eu'.format(i),
+                     session=session)
+    output = io.StringIO()
+    assert export_table(Voter, output, batch_size=2, session=session) == 5
+    rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+    assert [row['email'] for row in rows] == [
+        'member{}@someplace.eu'.format(i) for i in range(5)]
+    assert rows[0]['vote_weight'] == '1'
+
+    output = io.StringIO()
+    export_table(Voter, output, format='jsonl', session=session)
+    first = json.loads(output.getvalue().splitlines()[0])
+    assert first['voter_id'] == 1 and first['event_id'] == event.event_id
+
+def test_export_poll_ballots(session):
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    poll = create_poll(event.event_id, "Board election",
+                       start_time=datetime.utcnow() - timedelta(minutes=1),
+                       tally_method='irv', session=session)
+    a, b = [create_poll_option(poll.poll_id, name,
+                               session=session).poll_option_id
+            for name in ["Anna", "Bob"]]
+    open_poll(poll.poll_id, session=session)
+    voter = create_voter(event.event_id, 'anna@someplace.eu', session=session)
+    create_proxy(event.event_id, 'anna@someplace.eu', 'bob@someplace.eu',
+                 session=session)
+    cast_vote(voter, {a: 2, b: 1}, session=session)
+
+    output = io.StringIO()
+    assert export_poll(poll.poll_id, output, format='jsonl',
+                       session=session) == 2
+    ballots = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [(ballot['option_name'], ballot['rank'], ballot['weight'])
+            for ballot in ballots] == [('Bob', 1, 2), ('Anna', 2, 2)]
+    assert len({ballot['cast_id'] for ballot in ballots}) == 1
+    # Plain ISO times
+    datetime.fromisoformat(ballots[0]['cast_time'])
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        write_rows(['a'], [], io.StringIO(), format='xml')
@@ -0,0 +1,20 @@
+import io
+
+import pytest
+
+from electobot.imports import read_csv_rows
+
+def test_header_selects_columns():
+    file_ = io.StringIO("Name,Email\nAnna,anna@someplace.eu\n\nBob, bob@someplace.eu \n")
+    assert list(read_csv_rows(file_, ['email'])) == [('anna@someplace.eu',),
+                                                     ('bob@someplace.eu',)]
+
+def test_without_header_columns_are_positional():
+    file_ = io.StringIO("anna@someplace.eu,proxy@someplace.eu\n")
+    assert list(read_csv_rows(file_, ['present_voter_email', 'proxy_email'])) == [
+        ('anna@someplace.eu', 'proxy@someplace.eu')]
+
+def test_short_rows_are_an_error():
+    file_ = io.StringIO("anna@someplace.eu\n")
+    with pytest.raises(ValueError):
+        list(read_csv_rows(file_, ['present_voter_email', 'proxy_email']))
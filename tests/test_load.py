@@ -0,0 +1,41 @@
+import pytest
+
+flask = pytest.importorskip('flask')
+from load_test import run_load_test
+
+def test_simulated_assembly(tmp_path):
+    from app import app
+    config = (app.config['MAIL_WORKER'], app.config['SCHEDULER'])
+    result = run_load_test(n_voters=40, n_polls=2, n_options=3,
+                           concurrency=4, data_dir=str(tmp_path))
+    assert (app.config['MAIL_WORKER'], app.config['SCHEDULER']) == config
+    print(result.report())
+    assert result.total_errors == 0
+    assert result.tally_mismatches == []
+    assert len(result.latencies['POST /vote?poll_id']) == 80
+
+def test_combined_ballots(tmp_path):
+    result = run_load_test(n_voters=40, n_polls=3, n_options=3,
+                           concurrency=4, data_dir=str(tmp_path),
+                           combined=True)
+    print(result.report())
+    assert result.total_errors == 0
+    assert result.tally_mismatches == []
+    assert len(result.latencies['POST /ballot']) == 40
+
+def test_burst_is_shed_and_retried(tmp_path):
+    from electobot.admission import Admission
+    admission = {
+        'register': Admission(concurrency=2, rate=200, burst=5, max_queue=2,
+                              max_wait=0.01),
+        'vote': Admission(concurrency=2, max_queue=2, max_wait=0.01),
+    }
+    result = run_load_test(n_voters=40, n_polls=1, n_options=2,
+                           concurrency=16, data_dir=str(tmp_path),
+                           admission=admission, retry_pause=0.01)
+    print(result.report())
+    assert result.shed['POST /register'] > 0
+    # Everyone got through in the end
+    assert result.total_errors == 0
+    assert result.tally_mismatches == []
+    assert len(result.latencies['POST /vote?poll_id']) == 40
@@ -0,0 +1,159 @@
+import smtplib
+import socketserver
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from electobot.database import (create_session, enqueue_message,
+                                claim_due_messages, OutboxMessage)
+from electobot.mail_worker import MailWorker, retry_delay
+from electobot.send_email import MailSender, MailCredentials
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP for smtplib: EHLO, AUTH, MAIL, RCPT, DATA."""
+
+    def _reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply('220 localhost ready')
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            if not line:
+                return
+            command = line.split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self._reply('250-localhost')
+                self._reply('250 AUTH PLAIN LOGIN')
+            elif command == 'AUTH':
+                self.server.logins += 1
+                self._reply('235 Authentication successful')
+            elif command in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                if command == 'RCPT' and self.server.reject_next > 0:
+                    self.server.reject_next -= 1
+                    self._reply('550 Mailbox unavailable')
+                    continue
+                self._reply('250 OK')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    data_line = self.rfile.readline().decode()
+                    if data_line.rstrip('\r\n') == '.':
+                        break
+                    data.append(data_line)
+                self.server.messages.append(''.join(data))
+                self._reply('250 OK')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Not implemented')
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.logins = 0
+        self.reject_next = 0
+
+@pytest.fixture
+def smtp_server():
+    server = FakeSMTPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def sender_factory(smtp_server):
+    host, port = smtp_server.server_address
+    credentials = MailCredentials(host, port, 'electobot', 'hunter2',
+                                  'electobot@localhost')
+    return lambda: MailSender(credentials,
+                              connect=lambda c: smtplib.SMTP(c.server_address,
+                                                             c.port))
+
+def _outbox(engine):
+    session = create_session(engine)
+    messages = session.query(OutboxMessage).order_by(
+        OutboxMessage.message_id).all()
+    session.close()
+    return messages
+
+def test_batch_uses_one_connection(engine, smtp_server, sender_factory):
+    session = create_session(engine)
+    for i in range(10):
+        enqueue_message('voter{}@someplace.eu'.format(i), 'Voting link',
+                        'The URL to vote is: ...', session=session)
+    worker = MailWorker(session_factory=lambda: create_session(engine),
+                        sender_factory=sender_factory, batch_size=4)
+    worker.flush()
+
+    assert len(smtp_server.messages) == 10
+    assert smtp_server.connections == 1
+    assert smtp_server.logins == 1
+    assert all(message.sent_time is not None for message in _outbox(engine))
+
+def test_failed_message_is_retried_with_backoff(engine, smtp_server,
+                                                sender_factory):
+    session = create_session(engine)
+    enqueue_message('someone@someplace.eu', 'Voting link', 'Hi',
+                    session=session)
+    smtp_server.reject_next = 1
+    worker = MailWorker(session_factory=lambda: create_session(engine),
+                        sender_factory=sender_factory)
+    before = datetime.utcnow()
+    assert worker.process_batch() == 1
+    message, = _outbox(engine)
+    assert message.sent_time is None
+    assert message.attempts == 1
+    assert message.next_attempt_time >= before + retry_delay(1)
+
+    # Not due yet, so nothing is claimed
+    assert worker.process_batch() == 0
+    # Once the backoff has passed it goes through
+    assert worker.process_batch(now=message.next_attempt_time) == 1
+    message, = _outbox(engine)
+    assert message.sent_time is not None
+    assert len(smtp_server.messages) == 1
+
+def test_claimed_messages_are_hidden_from_other_workers(engine):
+    session = create_session(engine)
+    for i in range(3):
+        enqueue_message('voter{}@someplace.eu'.format(i), 'Voting link', 'Hi',
+                        session=session)
+    lease = timedelta(minutes=5)
+    other_session = create_session(engine)
+    assert len(claim_due_messages(2, lease, session=session)) == 2
+    assert len(claim_due_messages(10, lease, session=other_session)) == 1
+    assert len(claim_due_messages(10, lease, session=other_session)) == 0
+
+def test_retry_delay_is_capped():
+    assert retry_delay(1) < retry_delay(2) < retry_delay(3)
+    assert retry_delay(100) == retry_delay(101)
+
+def test_background_worker_sends_on_notify(engine, smtp_server,
+                                           sender_factory):
+    worker = MailWorker(session_factory=lambda: create_session(engine),
+                        sender_factory=sender_factory, poll_interval=10)
+    worker.start()
+    try:
+        enqueue_message('someone@someplace.eu', 'Voting link', 'Hi',
+                        session=create_session(engine))
+        worker.notify()
+        for _ in range(100):
+            if smtp_server.messages:
+                break
+            threading.Event().wait(0.05)
+    finally:
+        worker.stop()
+        worker.join(timeout=5)
+    assert len(smtp_server.messages) == 1
@@ -0,0 +1,48 @@
+from electobot.metrics import Registry
+
+def test_counters_and_histograms():
+    registry = Registry(directory=None)
+    votes = registry.counter('votes', "Votes", ['poll_id'])
+    latency = registry.histogram('latency_seconds', "Latency", ['route'],
+                                 buckets=(0.1, 1.0))
+    votes.inc(poll_id=1)
+    votes.inc(2, poll_id=1)
+    votes.inc(poll_id=2)
+    for value in (0.05, 0.5, 0.5, 3.0):
+        latency.observe(value, route='/vote')
+
+    lines = registry.exposition().splitlines()
+    assert '# TYPE votes counter' in lines
+    assert 'votes_total{poll_id="1"} 3' in lines
+    assert 'votes_total{poll_id="2"} 1' in lines
+    assert '# TYPE latency_seconds histogram' in lines
+    assert 'latency_seconds_bucket{route="/vote",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/vote",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{route="/vote",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{route="/vote"} 4.05' in lines
+    assert 'latency_seconds_count{route="/vote"} 4' in lines
+
+def test_count_exceptions():
+    registry = Registry(directory=None)
+    rejected = registry.counter('rejected', "Rejected", ['reason'])
+    try:
+        with rejected.count_exceptions('reason'):
+            raise KeyError('poll_option_id')
+    except KeyError:
+        pass
+    assert 'rejected_total{reason="KeyError"} 1' in registry.exposition()
+
+def test_processes_are_added_up(tmp_path):
+    # Two workers of the same app, writing to a shared directory
+    workers = [Registry(directory=str(tmp_path)) for _ in range(2)]
+    for i, registry in enumerate(workers):
+        counter = registry.counter('registrations', "Registrations",
+                                   ['result'])
+        counter.inc(i + 1, result='created')
+        registry.histogram('smtp_seconds', "SMTP", buckets=(1.0,)).observe(0.5)
+        registry.flush()
+
+    for registry in workers:
+        lines = registry.exposition().splitlines()
+        assert 'registrations_total{result="created"} 3' in lines
+        assert 'smtp_seconds_count 2' in lines
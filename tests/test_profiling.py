@@ -0,0 +1,50 @@
+import copy
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from electobot.database import (create_engine, create_all_tables,
+                                create_session, create_event, create_voter,
+                                Event)
+from electobot.profiling import fingerprint, track_queries
+
+def test_fingerprint():
+    assert fingerprint("SELECT * FROM voters\n WHERE voter_id IN (?, ?, ?)") \
+        == fingerprint("SELECT * FROM voters WHERE voter_id IN (?)")
+    assert fingerprint("SELECT * FROM polls WHERE name = 'a' LIMIT 1") \
+        == "SELECT * FROM polls WHERE name = ? LIMIT ?"
+
+def test_nested_tracking_and_repeats():
+    engine = create_engine(path=":memory:")
+    create_all_tables(engine)
+    session = create_session(engine)
+    with track_queries(fingerprints=True) as outer:
+        for event_id in range(3):
+            session.query(Event).filter_by(event_id=event_id).first()
+        with track_queries() as inner:
+            session.query(Event).count()
+    assert inner.count == 1
+    assert outer.count == 4
+    (statement, count), = outer.repeated()
+    assert count == 3 and statement.startswith('SELECT events.')
+
+def test_failed_statements_leave_nothing_on_the_connection():
+    engine = create_engine(path=":memory:")
+    create_all_tables(engine)
+    session = create_session(engine)
+    event = create_event("General Assembly", r".*", session=session)
+    create_voter(event.event_id, 'anna@someplace.eu', session=session)
+    connection = session.connection()
+    def snapshot():
+        return {key: copy.copy(value)
+                for key, value in connection.info.items()}
+    info = snapshot()
+    for _ in range(3):
+        with pytest.raises(IntegrityError):
+            connection.exec_driver_sql(
+                "INSERT INTO voters (voter_id, event_id, email, token) "
+                "VALUES (1, 1, 'anna@someplace.eu', 'x')")
+    assert snapshot() == info
+    with track_queries() as stats:
+        session.query(Event).count()
+    assert stats.count == 1 and stats.time > 0
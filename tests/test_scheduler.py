@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from electobot.database import (create_session, create_event, create_poll,
+                                open_poll, close_poll, open_polls_from_event,
+                                poll_schedule, poll_from_id)
+from electobot.exceptions import DBExceptionInvalidSchedule
+from electobot import scheduler as scheduler_module
+from electobot.scheduler import PollScheduler
+from .helpers import EMAIL_PATTERN
+
+def _open_poll_ids(engine, event_id):
+    session = create_session(engine)
+    try:
+        return [poll.poll_id for poll in
+                open_polls_from_event(event_id, session=session)]
+    finally:
+        session.close()
+
+def test_scheduled_polls_open_and_close(engine):
+    now = datetime(2021, 5, 1, 14, 0)
+    session = create_session(engine)
+    event_id = create_event("General Assembly", EMAIL_PATTERN,
+                            session=session).event_id
+    first = create_poll(event_id, "Budget", start_time=now,
+                        end_time=now + timedelta(minutes=10), scheduled=True,
+                        session=session).poll_id
+    second = create_poll(event_id, "Board", start_time=now
+                         + timedelta(minutes=5), scheduled=True,
+                         session=session).poll_id
+    # Opened by hand; never touched by the scheduler
+    manual = create_poll(event_id, "Motion", start_time=now,
+                         session=session).poll_id
+    with pytest.raises(DBExceptionInvalidSchedule):
+        create_poll(event_id, "Backwards", start_time=now, end_time=now,
+                    session=session)
+    session.close()
+
+    changes = []
+    scheduler = PollScheduler(session_factory=lambda: create_session(engine),
+                              on_change=changes.extend)
+    assert scheduler.run_due(now - timedelta(minutes=1)) == []
+    assert scheduler.seconds_until_next(now - timedelta(seconds=2)) == 2
+    assert scheduler.run_due(now) == [(first, True)]
+    assert _open_poll_ids(engine, event_id) == [first]
+    # The end of the poll that just opened is on the heap
+    assert scheduler.seconds_until_next(now) == 5
+    assert scheduler.run_due(now + timedelta(minutes=5)) == [(second, True)]
+    assert scheduler.run_due(now + timedelta(minutes=10)) == [(first, False)]
+    assert _open_poll_ids(engine, event_id) == [second]
+    assert changes == [(first, True), (second, True), (first, False)]
+    assert scheduler.run_due(now + timedelta(minutes=20)) == []
+    assert manual not in _open_poll_ids(engine, event_id)
+
+def test_schedule_follows_manual_changes(engine):
+    now = datetime.utcnow()
+    session = create_session(engine)
+    event_id = create_event("General Assembly", EMAIL_PATTERN,
+                            session=session).event_id
+    poll_id = create_poll(event_id, "Budget", start_time=now,
+                          end_time=now + timedelta(hours=1), scheduled=True,
+                          session=session).poll_id
+    scheduler = PollScheduler(session_factory=lambda: create_session(engine))
+    scheduler.run_due(now - timedelta(minutes=1))
+    # Opening by hand keeps the scheduled end
+    open_poll(poll_id, session=session)
+    assert poll_schedule(session=session) == [(now + timedelta(hours=1),
+                                               poll_id)]
+    # Closed early by hand: not opened again
+    close_poll(poll_id, session=session)
+    assert poll_schedule(session=session) == []
+    assert scheduler.run_due(now + timedelta(minutes=1)) == []
+    session.expire_all()
+    assert not poll_from_id(poll_id, session=session).is_open
+    session.close()
+
+def test_failed_transitions_are_retried(engine, monkeypatch):
+    now = datetime(2021, 5, 1, 14, 0)
+    session = create_session(engine)
+    event_id = create_event("General Assembly", EMAIL_PATTERN,
+                            session=session).event_id
+    poll_id = create_poll(event_id, "Budget", start_time=now, scheduled=True,
+                          session=session).poll_id
+    session.close()
+    scheduler = PollScheduler(session_factory=lambda: create_session(engine))
+    apply_poll_schedule = scheduler_module.apply_poll_schedule
+
+    def locked(*args, **kwargs):
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(scheduler_module, 'apply_poll_schedule', locked)
+    with pytest.raises(RuntimeError):
+        scheduler.run_due(now)
+    monkeypatch.setattr(scheduler_module, 'apply_poll_schedule',
+                        apply_poll_schedule)
+    assert scheduler.run_due(now) == [(poll_id, True)]
@@ -0,0 +1,167 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from electobot.database import (create_event, create_voter,
+                                create_proxy, create_poll, create_poll_option,
+                                open_poll, cast_vote, tally_poll, Ballot)
+from electobot.exceptions import (VoteExceptionInvalidBallot,
+                                  VoteExceptionWrongId,
+                                  DBExceptionInvalidTallyMethod)
+from electobot.tally import (count_ranked, count_poll, merge_rankings,
+                             tally_to_table, numpy)
+from .helpers import EMAIL_PATTERN
+
+COUNTERS = [False] + ([True] if numpy is not None else [])
+
+def _open_poll(session, names, method, seats=1):
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    poll = create_poll(event.event_id, "Board election",
+                       start_time=datetime.utcnow() - timedelta(minutes=1),
+                       tally_method=method, seats=seats, session=session)
+    option_ids = [create_poll_option(poll.poll_id, name,
+                                     session=session).poll_option_id
+                  for name in names]
+    open_poll(poll.poll_id, session=session)
+    return event, poll, option_ids
+
+@pytest.mark.parametrize('use_numpy', COUNTERS)
+def test_irv_eliminates_until_majority(use_numpy):
+    # The Tennessee capital example
+    memphis, nashville, chattanooga, knoxville = 1, 2, 3, 4
+    rankings = {
+        (memphis, nashville, chattanooga, knoxville): 42,
+        (nashville, chattanooga, knoxville, memphis): 26,
+        (chattanooga, knoxville, nashville, memphis): 15,
+        (knoxville, chattanooga, nashville, memphis): 17,
+    }
+    result = count_ranked([1, 2, 3, 4], rankings, method='irv',
+                          use_numpy=use_numpy)
+    assert result.elected == [knoxville]
+    assert [r.eliminated for r in result.rounds] == [[chattanooga],
+                                                     [nashville], []]
+    assert result.rounds[1].votes == {memphis: 42, nashville: 26,
+                                      knoxville: 32}
+
+@pytest.mark.parametrize('use_numpy', COUNTERS)
+def test_stv_transfers_surplus(use_numpy):
+    orange, pear, chocolate, strawberry, bonbon = 1, 2, 3, 4, 5
+    rankings = {
+        (orange,): 4,
+        (pear, orange): 2,
+        (chocolate, strawberry): 8,
+        (chocolate, bonbon): 4,
+        (strawberry,): 1,
+        (bonbon,): 1,
+    }
+    result = count_ranked([1, 2, 3, 4, 5], rankings, method='stv', seats=3,
+                          use_numpy=use_numpy)
+    assert result.elected == [chocolate, orange, strawberry]
+    # Half of chocolate's 12 votes were above the quota of 6
+    assert result.rounds[1].votes == {orange: 4, pear: 2, strawberry: 5,
+                                      bonbon: 3}
+
+@pytest.mark.parametrize('use_numpy', COUNTERS)
+def test_stv_surplus_skips_options_elected_in_the_same_round(use_numpy):
+    a, b, c, d, e = 1, 2, 3, 4, 5
+    rankings = {(a, b, c): 50, (b, d): 40, (c,): 5, (d,): 5}
+    result = count_ranked([a, b, c, d, e], rankings, method='stv', seats=3,
+                          use_numpy=use_numpy)
+    # a and b both reach the quota of 26 in round 1; a's surplus of 24
+    # goes past b to c
+    assert result.rounds[0].elected == [a, b]
+    assert result.rounds[1].votes[c] == 29
+    assert result.elected == [a, b, c]
+
+@pytest.mark.parametrize('use_numpy', COUNTERS)
+def test_elimination_ties_look_at_earlier_rounds(use_numpy):
+    a, b, c, d = 1, 2, 3, 4
+    rankings = {(a,): 5, (b,): 4, (c,): 3, (d, b): 1}
+    result = count_ranked([a, b, c, d], rankings, use_numpy=use_numpy)
+    # b and c both have 4 votes after d is out; c had fewer before
+    assert [r.eliminated for r in result.rounds[:2]] == [[d], [c]]
+
+def test_counters_agree_on_random_ballots():
+    if numpy is None:
+        pytest.skip("NumPy is not installed")
+    rng = random.Random(1)
+    options = list(range(1, 9))
+    rankings = {}
+    for _ in range(2000):
+        ranking = tuple(rng.sample(options, rng.randint(1, 8)))
+        rankings[ranking] = rankings.get(ranking, 0) + rng.randint(1, 3)
+    for method, seats in [('irv', 1), ('stv', 3)]:
+        with_lists = count_ranked(options, rankings, method=method,
+                                  seats=seats, use_numpy=False)
+        with_arrays = count_ranked(options, rankings, method=method,
+                                   seats=seats, use_numpy=True)
+        assert with_lists == with_arrays
+
+def test_merge_rankings():
+    rows = [('b', 2, 11, 1), ('a', 1, 10, 2), ('b', 1, 12, 1),
+            ('a', 2, 11, 2), ('c', 2, 11, 1), ('c', 1, 12, 1)]
+    assert merge_rankings(rows) == {(10, 11): 2, (12, 11): 2}
+
+def test_ranked_ballots(session):
+    event, poll, (a, b, c) = _open_poll(session, ["A", "B", "C"], 'irv')
+    anna = create_voter(event.event_id, 'anna@someplace.eu', session=session)
+    create_proxy(event.event_id, 'anna@someplace.eu', 'bob@someplace.eu',
+                 session=session)
+    for ballot in [{a: 1, b: 1}, {a: 2}, {a: 1, b: 3}, {a: 1, b: 2, c: 1}]:
+        with pytest.raises(VoteExceptionInvalidBallot):
+            cast_vote(anna, ballot, session=session)
+    cast_vote(anna, {a: 2, b: 0, c: 1}, session=session)
+    ranks = session.query(Ballot.poll_option_id, Ballot.rank,
+                          Ballot.weight).order_by(Ballot.rank).all()
+    assert ranks == [(c, 1, 2), (a, 2, 2)]
+    # Live results show first choices
+    assert tally_poll(poll.poll_id, session=session) == {c: 2}
+
+    carol = create_voter(event.event_id, 'carol@someplace.eu',
+                         session=session)
+    cast_vote(carol, {a: 1, b: 2}, session=session)
+    dave = create_voter(event.event_id, 'dave@someplace.eu', session=session)
+    cast_vote(dave, {b: 1, c: 2}, session=session)
+    # Abstaining, without options to find the poll by
+    erin = create_voter(event.event_id, 'erin@someplace.eu', session=session)
+    with pytest.raises(VoteExceptionWrongId):
+        cast_vote(erin, {}, session=session)
+    cast_vote(erin, {}, poll_id=poll.poll_id, session=session)
+
+    result = count_poll(poll.poll_id, session=session)
+    assert [r.votes for r in result.rounds] == [{a: 1, b: 1, c: 2},
+                                                {a: 1, c: 3}]
+    assert result.elected == [c]
+    with pytest.raises(ValueError):
+        count_poll(poll.poll_id, method='approval', session=session)
+    table = tally_to_table(poll.poll_id, method='stv', seats=2,
+                           session=session)
+    assert 'elected in round 1' in table
+
+def test_approval_ballots(session):
+    event, poll, (a, b, c) = _open_poll(session, ["A", "B", "C"], 'approval',
+                                        seats=2)
+    anna = create_voter(event.event_id, 'anna@someplace.eu', session=session)
+    create_proxy(event.event_id, 'anna@someplace.eu', 'bob@someplace.eu',
+                 session=session)
+    with pytest.raises(VoteExceptionInvalidBallot):
+        cast_vote(anna, {a: 2}, session=session)
+    with pytest.raises(VoteExceptionInvalidBallot):
+        cast_vote(anna, {a: 1, 'abstain': 1}, session=session)
+    cast_vote(anna, {a: 1, b: 1, c: 0}, session=session)
+    carol = create_voter(event.event_id, 'carol@someplace.eu',
+                         session=session)
+    cast_vote(carol, {c: 1}, session=session)
+    result = count_poll(poll.poll_id, session=session)
+    assert result.rounds[0].votes == {a: 2, b: 2, c: 1}
+    assert result.elected == [a, b]
+
+def test_invalid_tally_method(session):
+    event = create_event("General Assembly", EMAIL_PATTERN, session=session)
+    with pytest.raises(DBExceptionInvalidTallyMethod):
+        create_poll(event.event_id, "Motion", tally_method='borda',
+                    session=session)
+    with pytest.raises(DBExceptionInvalidTallyMethod):
+        create_poll(event.event_id, "Motion", tally_method='irv', seats=2,
+                    session=session)